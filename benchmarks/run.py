@@ -0,0 +1,257 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Times sftpsync operations against a local SFTP server.
+
+    python -m benchmarks.run --latency 20 --bandwidth 10 -o before.json
+    python -m benchmarks.run --latency 20 --bandwidth 10 --compare before.json
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import paramiko
+
+from sftp_sync.plan import TRANSFERS
+from sftp_sync.sync import Sync
+
+from .server import LocalSFTPServer
+from .trees import TREES
+
+__author__ = 'bluec0re'
+
+RESULT_VERSION = 1
+OPERATIONS = ('down', 'check', 'list', 'init', 'up', 'both')
+
+sync_module = sys.modules['sftp_sync.sync']
+
+
+class _Silent(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def _disable_interaction():
+    sync_module.prompt = lambda *args, **kwargs: 'y'
+    sync_module.spinner = _Silent()
+
+
+@contextlib.contextmanager
+def _quiet():
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _modify(root, fraction, rnd, half=None):
+    """
+    Appends to a fraction of the regular files below root. Returns the
+    number of modified files. If half (0 or 1) is given, only one half of
+    the files is considered, so both sides can be changed without conflicts.
+    """
+    modified = 0
+    mtime = int(time.time()) + 2
+    for dirpath, dirs, files in os.walk(root):
+        for filename in files:
+            path = os.path.join(dirpath, filename)
+            if filename.startswith('.files') or os.path.islink(path) or rnd.random() >= fraction:
+                continue
+            if half is not None and zlib.crc32(os.path.relpath(path, root).encode('utf-8')) % 2 != half:
+                continue
+            with open(path, 'ab') as fp:
+                fp.write(b'x')
+            os.utime(path, (mtime, mtime))
+            modified += 1
+    return modified
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(object):
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.sftp = server.connect()
+        self.rnd = random.Random(5)
+
+    def _sync(self, remote, local):
+        return Sync(self.sftp, remote, local, jobs=self.args.jobs, bundle_threshold=self.args.bundle,
+                    remote_scan=self.args.remote_scan)
+
+    def _execute(self, remote, local, *directions):
+        transfers = transferred = 0
+        for direction in directions:
+            sync = self._sync(remote, local)
+            plan = sync.plan(direction)
+            sync.execute(plan)
+            transfers += len(plan.by_kind(*TRANSFERS))
+            transferred += plan.download_bytes + plan.upload_bytes
+        return transfers, transferred
+
+    def measure(self, func, files):
+        self.server.counter.reset()
+        start = time.time()
+        with _quiet():
+            transfers, transferred = func() or (0, 0)
+        elapsed = time.time() - start
+        requests = self.server.counter.reset()
+        return {
+            'seconds': elapsed,
+            'files': files,
+            'files_per_s': files / elapsed if elapsed else None,
+            'transfers': transfers,
+            'bytes': transferred,
+            'mb_per_s': transferred / 1024 ** 2 / elapsed if elapsed else None,
+            'requests': requests,
+            'total_requests': sum(requests.values()),
+        }
+
+    def run_tree(self, name, generator):
+        base = os.path.join(self.args.workdir, name)
+        remote = os.path.join(base, 'remote', name)
+        local = os.path.join(base, 'local', name)
+        os.makedirs(os.path.dirname(local))
+        files, size = generator(remote, self.args.scale)
+        result = {'files': files, 'bytes': size, 'operations': {}}
+        operations = result['operations']
+
+        def report(operation):
+            r = operations[operation]
+            print("%-9s %-6s %8.3fs %9.1f files/s %8.2f MB/s %7d requests" % (
+                name, operation, r['seconds'], r['files_per_s'] or 0, r['mb_per_s'] or 0,
+                r['total_requests']))
+
+        steps = [
+            ('down', lambda: self._execute(remote, local, 'down')),
+            ('check', lambda: self._sync(remote, local).check_revision_against_remote()),
+            ('list', lambda: self._sync(remote, local).list_local_changes()),
+            ('init', lambda: self._sync(remote, local).build_rev_file()),
+        ]
+        for operation, func in steps:
+            if operation == 'down' or operation in self.args.operations:
+                # the initial download is needed by everything else
+                operations[operation] = self.measure(func, files)
+                if operation in self.args.operations:
+                    report(operation)
+                else:
+                    del operations[operation]
+
+        if 'up' in self.args.operations:
+            _modify(local, self.args.modify, self.rnd)
+            operations['up'] = self.measure(lambda: self._execute(remote, local, 'up'), files)
+            report('up')
+
+        if 'both' in self.args.operations:
+            _modify(remote, self.args.modify, self.rnd, 0)
+            _modify(local, self.args.modify, self.rnd, 1)
+            operations['both'] = self.measure(lambda: self._execute(remote, local, 'both'), files)
+            report('both')
+
+        shutil.rmtree(base)
+        return result
+
+
+def compare(old, new):
+    for tree, result in sorted(new['results'].items()):
+        for operation, r in sorted(result['operations'].items()):
+            try:
+                before = old['results'][tree]['operations'][operation]
+            except KeyError:
+                continue
+            print("%-9s %-6s %8.3fs -> %8.3fs (%+6.1f%%) %7d -> %7d requests" % (
+                tree, operation, before['seconds'], r['seconds'],
+                (r['seconds'] / before['seconds'] - 1) * 100 if before['seconds'] else 0,
+                before['total_requests'], r['total_requests']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sftpsync benchmarks')
+    parser.add_argument('-t', '--tree', action='append', choices=sorted(TREES),
+                        help='tree to benchmark (default: all)')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated list of %s' % ', '.join(OPERATIONS))
+    parser.add_argument('--latency', type=float, default=0, help='round trip time in ms')
+    parser.add_argument('--bandwidth', type=float, help='bandwidth limit in MB/s')
+    parser.add_argument('--scale', type=float, default=1.0, help='scale the size of the trees')
+    parser.add_argument('--modify', type=float, default=0.1,
+                        help='fraction of files changed before up and both')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of parallel transfers')
+    parser.add_argument('--bundle', type=int, metavar='SIZE',
+                        help='transfer files smaller than SIZE bytes as tar streams')
+    parser.add_argument('--remote-scan', action='store_true',
+                        help='list the remote tree with a python helper instead of SFTP')
+    parser.add_argument('-o', '--output', help='write the results as JSON', metavar='FILE')
+    parser.add_argument('--compare', help='compare against an earlier JSON result', metavar='FILE')
+    parser.add_argument('--workdir', help='directory for the trees (default: a temporary one)')
+    args = parser.parse_args()
+
+    args.operations = [operation.strip() for operation in args.operations.split(',')]
+    for operation in args.operations:
+        if operation not in OPERATIONS:
+            parser.error("Unknown operation %s" % operation)
+
+    _disable_interaction()
+    server = LocalSFTPServer(args.latency / 1000, args.bandwidth * 1024 ** 2 if args.bandwidth else None)
+
+    cleanup = args.workdir is None
+    if cleanup:
+        args.workdir = tempfile.mkdtemp(prefix='sftpsync-bench-')
+    try:
+        benchmark = Benchmark(server, args)
+        results = {}
+        for name in args.tree or sorted(TREES):
+            results[name] = benchmark.run_tree(name, TREES[name])
+    finally:
+        if cleanup:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    output = {
+        'version': RESULT_VERSION,
+        'timestamp': time.time(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'paramiko': paramiko.__version__,
+        'settings': {
+            'latency_ms': args.latency,
+            'bandwidth_mb': args.bandwidth,
+            'scale': args.scale,
+            'modify': args.modify,
+            'jobs': args.jobs,
+            'bundle': args.bundle,
+            'remote_scan': args.remote_scan,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), output)
+
+
+if __name__ == '__main__':
+    main()
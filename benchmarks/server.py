@@ -0,0 +1,345 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+In-process SFTP server for benchmarks.
+
+The server serves the local file system over a loopback socket. A proxy in
+front of it delays every chunk by half the configured round trip time in
+each direction and limits the bandwidth, so pipelining pays off just like
+on a real link. Every request is counted by type.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import deque
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+__author__ = 'bluec0re'
+
+BUFSIZE = 32768
+
+
+class RequestCounter(object):
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+
+class BenchServer(paramiko.ServerInterface):
+    def __init__(self, counter):
+        self.counter = counter
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.counter.count('exec')
+        thread = threading.Thread(target=_run_command, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+def _run_command(channel, command):
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        try:
+            while True:
+                data = channel.recv(BUFSIZE)
+                if not data:
+                    break
+                process.stdin.write(data)
+            process.stdin.close()
+        except (IOError, OSError):
+            # the command exited without reading all of its input
+            pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    while True:
+        data = os.read(process.stdout.fileno(), BUFSIZE)
+        if not data:
+            break
+        channel.sendall(data)
+    stderr = process.stderr.read()
+    if stderr:
+        channel.sendall_stderr(stderr)
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+def _error(e):
+    return SFTPServer.convert_errno(e.errno)
+
+
+def _chattr(path, attr):
+    try:
+        if attr._flags & attr.FLAG_PERMISSIONS:
+            os.chmod(path, attr.st_mode)
+        if attr._flags & attr.FLAG_AMTIME:
+            os.utime(path, (attr.st_atime, attr.st_mtime))
+        if attr._flags & attr.FLAG_SIZE:
+            with open(path, 'r+b') as fp:
+                fp.truncate(attr.st_size)
+    except OSError as e:
+        return _error(e)
+    return SFTP_OK
+
+
+class BenchHandle(SFTPHandle):
+    def read(self, offset, length):
+        self.counter.count('read')
+        return super(BenchHandle, self).read(offset, length)
+
+    def write(self, offset, data):
+        self.counter.count('write')
+        return super(BenchHandle, self).write(offset, data)
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return _chattr(self.filename, attr)
+
+
+class BenchSFTP(SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super(BenchSFTP, self).__init__(server, *args, **kwargs)
+        self.counter = server.counter
+
+    def list_folder(self, path):
+        self.counter.count('opendir')
+        try:
+            entries = []
+            for filename in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, filename)))
+                attr.filename = filename
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return _error(e)
+
+    def stat(self, path):
+        self.counter.count('stat')
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return _error(e)
+
+    def lstat(self, path):
+        self.counter.count('lstat')
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return _error(e)
+
+    def open(self, path, flags, attr):
+        self.counter.count('open')
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return _error(e)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = BenchHandle(flags)
+        handle.counter = self.counter
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        self.counter.count('remove')
+        try:
+            os.remove(path)
+        except OSError as e:
+            return _error(e)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.counter.count('rename')
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return _error(e)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        self.counter.count('mkdir')
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return _error(e)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        self.counter.count('rmdir')
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return _error(e)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        self.counter.count('setstat')
+        return _chattr(path, attr)
+
+    def symlink(self, target, path):
+        self.counter.count('symlink')
+        try:
+            os.symlink(target, path)
+        except OSError as e:
+            return _error(e)
+        return SFTP_OK
+
+    def readlink(self, path):
+        self.counter.count('readlink')
+        try:
+            return os.readlink(path)
+        except OSError as e:
+            return _error(e)
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join('/', path))
+
+
+class _DelayedPipe(object):
+    """
+    Copies src to dst. Every chunk is sent `delay` seconds after it was
+    received, limited to `bandwidth` bytes per second.
+    """
+    def __init__(self, src, dst, delay, bandwidth):
+        self.src = src
+        self.dst = dst
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.queue = deque()
+        self.cond = threading.Condition()
+        for target in (self._read, self._write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.src.recv(BUFSIZE)
+            except socket.error:
+                data = b''
+            with self.cond:
+                self.queue.append((time.time() + self.delay, data))
+                self.cond.notify()
+            if not data:
+                return
+
+    def _write(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                due, data = self.queue.popleft()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    self.dst.shutdown(socket.SHUT_WR)
+                    return
+                self.dst.sendall(data)
+            except socket.error:
+                return
+            if self.bandwidth:
+                time.sleep(len(data) / self.bandwidth)
+
+
+class LatencyProxy(object):
+    """
+    Forwards connections to target_port, adding `latency` seconds of round
+    trip time
+    """
+    def __init__(self, target_port, latency=0, bandwidth=None):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            client, _ = self.sock.accept()
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _DelayedPipe(client, server, self.latency / 2, self.bandwidth)
+            _DelayedPipe(server, client, self.latency / 2, self.bandwidth)
+
+
+class LocalSFTPServer(object):
+    """
+    SFTP server on a loopback socket. Connect to `port`, which goes through
+    the latency proxy.
+    """
+    def __init__(self, latency=0, bandwidth=None):
+        self.counter = RequestCounter()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        self.proxy = LatencyProxy(self.sock.getsockname()[1], latency, bandwidth)
+        self.port = self.proxy.port
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTP)
+            transport.start_server(server=BenchServer(self.counter))
+
+    def connect(self):
+        """
+        Returns a connected paramiko.SFTPClient
+        """
+        transport = paramiko.Transport(('127.0.0.1', self.port))
+        transport.connect()
+        transport.auth_none('bench')
+        return paramiko.SFTPClient.from_transport(transport)
@@ -0,0 +1,94 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Synthetic directory trees. Every generator gets the (not yet existing)
+root directory and a scale factor and returns the number of files and
+bytes it created.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import random
+
+__author__ = 'bluec0re'
+
+
+def _write(path, size):
+    with open(path, 'wb') as fp:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 ** 2)
+            fp.write(os.urandom(chunk))
+            remaining -= chunk
+    return size
+
+
+def small_files(root, scale=1.0):
+    """
+    Many small files, 100 per directory
+    """
+    rnd = random.Random(1)
+    os.makedirs(root)
+    count = int(5000 * scale)
+    total = 0
+    for i in range(count):
+        directory = os.path.join(root, 'd%03d' % (i // 100))
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        total += _write(os.path.join(directory, 'f%05d.txt' % i), rnd.randint(0, 4096))
+    return count, total
+
+
+def huge_files(root, scale=1.0):
+    """
+    A few large files
+    """
+    os.makedirs(root)
+    count = 3
+    total = 0
+    for i in range(count):
+        total += _write(os.path.join(root, 'big%d.bin' % i), int(64 * 1024 ** 2 * scale))
+    return count, total
+
+
+def deep_tree(root, scale=1.0):
+    """
+    A binary tree of directories, 10 levels deep, with a few files per
+    directory
+    """
+    rnd = random.Random(3)
+    depth = max(1, int(10 * scale ** 0.5))
+    count = total = 0
+    dirs = [root]
+    for level in range(depth):
+        children = []
+        for directory in dirs:
+            os.makedirs(directory)
+            for i in range(3):
+                total += _write(os.path.join(directory, 'f%d' % i), rnd.randint(0, 2048))
+                count += 1
+            if level < depth - 1:
+                children.extend(os.path.join(directory, name) for name in ('l', 'r'))
+        dirs = children
+    return count, total
+
+
+def symlinks(root, scale=1.0):
+    """
+    Many symlinks to a small set of files
+    """
+    os.makedirs(root)
+    total = 0
+    for i in range(10):
+        total += _write(os.path.join(root, 'target%d' % i), 1024)
+    count = int(2000 * scale)
+    for i in range(count):
+        os.symlink('target%d' % (i % 10), os.path.join(root, 'link%05d' % i))
+    return count + 10, total
+
+
+TREES = {
+    'small': small_files,
+    'huge': huge_files,
+    'deep': deep_tree,
+    'symlinks': symlinks,
+}
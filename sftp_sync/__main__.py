@@ -10,7 +10,11 @@ import argparse
 import re
 
 from .sftp import setup_sftp
+from .mux import setup_mux
 from .sync import sync
+from .stats import Stats
+from .transfer import Streaming
+from .delete import DeletePolicy, POLICIES
 import logging
 
 
@@ -21,7 +25,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('COMMAND',
                         choices=('up', 'down', 'both',
-                                 'init', 'check', 'list'))
+                                 'init', 'check', 'list', 'watch'))
     parser.add_argument('HOST')
     parser.add_argument('PATH')
     parser.add_argument('-e', '--exclude', help='exclude files based on regex', type=re.compile)
@@ -29,6 +33,40 @@ def main():
     parser.add_argument('-s', '--skip-on-error', help='skip file on error',
                         action="store_true")
     parser.add_argument('-S', '--subdir', help='restrict to subdir')
+    parser.add_argument('-j', '--jobs', help='number of parallel transfers', type=int, default=1)
+    parser.add_argument('--delta', help='only send changed blocks of files larger than SIZE bytes',
+                        type=int, metavar='SIZE')
+    parser.add_argument('--bundle', help='transfer files smaller than SIZE bytes as tar streams '
+                        '(needs GNU tar remotely)', type=int, metavar='SIZE')
+    parser.add_argument('-z', '--compress', help='compress compressible files through a remote helper',
+                        action='store_true')
+    parser.add_argument('--remote-scan', help='list the remote tree with a python helper instead of SFTP',
+                        action='store_true')
+    parser.add_argument('-c', '--checksum', help='compare file contents by sha256',
+                        action='store_true')
+    parser.add_argument('--save-plan', help='write the computed plan to a file', metavar='FILE')
+    parser.add_argument('--load-plan', help='execute a previously saved plan', metavar='FILE')
+    parser.add_argument('--control-persist', help='keep the connection open for SECONDS and reuse it '
+                        'in later invocations', type=int, metavar='SECONDS')
+    parser.add_argument('--chunk-size', help='size of read and write requests (default: 32768)',
+                        type=int, metavar='BYTES')
+    parser.add_argument('--max-requests', help='read and write requests in flight per file '
+                        '(default: from the round trip time)', type=int, metavar='N')
+    parser.add_argument('--window', help='ssh channel window (default: from the round trip time)',
+                        type=int, metavar='BYTES')
+    parser.add_argument('--debounce', help='watch: seconds without changes before uploading (default: 0.5)',
+                        type=float, default=0.5, metavar='SECONDS')
+    parser.add_argument('-b', '--batch', help='never ask, files deleted on the other side are kept '
+                        'unless --delete is given', action='store_true')
+    parser.add_argument('--delete', help='what to do with files deleted on the other side '
+                        '(default: ask, never in batch mode)', choices=POLICIES)
+    parser.add_argument('--trash-dir', help='--delete trash moves files into DIR below the root '
+                        '(default: .sftpsync-trash)', metavar='DIR')
+    parser.add_argument('--max-delete', help="don't delete anything if more than N files would be deleted",
+                        type=int, metavar='N')
+    parser.add_argument('--stats', help='print timings and counters after the sync',
+                        action='store_true')
+    parser.add_argument('--stats-json', help='write timings and counters as JSON', metavar='FILE')
     parser.add_argument('-l', '--level', help='loglevel', default='INFO',
                         choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
 
@@ -45,10 +83,19 @@ def main():
         excludes = args.exclude
         print("Excluding: {0}".format(excludes.pattern))
 
+    stats = None
+    if args.stats or args.stats_json:
+        stats = Stats()
+
     sftp = None
     client = None
     if args.COMMAND != 'list':
-        client = setup_sftp(args)
+        if args.control_persist:
+            client = setup_mux(args, interactive=not args.batch)
+        if client is None:
+            client = setup_sftp(args, interactive=not args.batch)
+        if client is False:
+            exit(1)
         sftp = client.open_sftp()
 
     try:
@@ -62,10 +109,27 @@ def main():
              excludes,
              args.dry_run,
              args.skip_on_error,
-             args.subdir)
+             args.subdir,
+             args.jobs,
+             args.load_plan,
+             args.save_plan,
+             args.delta,
+             args.checksum,
+             stats,
+             Streaming(args.chunk_size, args.max_requests, args.window),
+             args.bundle,
+             args.compress,
+             args.debounce,
+             args.remote_scan,
+             DeletePolicy(args.delete, args.trash_dir, args.max_delete),
+             args.batch)
     finally:
         if client:
             client.close()
+        if args.stats:
+            stats.report()
+        if args.stats_json:
+            stats.save(args.stats_json)
 
 if __name__ == '__main__':
     install_hook()
@@ -0,0 +1,191 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Transfers many small files as a single tar stream over an exec channel
+instead of one open/write/close/setstat sequence per file.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import logging
+import os
+import socket
+import stat
+import tarfile
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .sftp import exec_remote
+from .transfer import part_name
+
+__author__ = 'bluec0re'
+
+log = logging.getLogger(__name__)
+
+# fewer files aren't worth the extra command
+MIN_FILES = 8
+# files per archive, the revision file is updated after every archive
+MAX_FILES = 1000
+
+
+def _text(name):
+    if isinstance(name, bytes):
+        return name.decode('utf-8')
+    return name
+
+
+class _ChannelWriter(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+
+    def close(self):
+        pass
+
+
+def _finish(channel):
+    """
+    Waits for the command of channel. Returns its exit status and stderr.
+    """
+    try:
+        stderr = channel.makefile_stderr('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return status, stderr.decode('utf-8', 'replace').strip()
+
+
+def download(sftp, remote_root, local_root, files, callback=None):
+    """
+    Downloads files (dict of root relative filename -> File) with a tar
+    command on the remote side. Every file is written to a partial file
+    first and gets the mtime of its File. Like a single download, it is
+    created with the default permissions.
+
+    callback(filename) is called for every finished file. Files which
+    changed since they were listed are skipped. Returns the set of
+    downloaded filenames.
+
+    The file list is passed with --null -T -, so the remote tar has to be
+    GNU tar. Other tars fail without output and nothing is downloaded.
+    """
+    channel = exec_remote(sftp, 'tar -cf - -C %s --null -T -' % quote(remote_root))
+
+    def feed():
+        try:
+            channel.sendall(b'\0'.join(filename.encode('utf-8') for filename in files))
+            channel.shutdown_write()
+        except (IOError, EOFError, socket.error) as e:
+            # the command died, its status tells why
+            log.debug("Can't send file list: %s", e)
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    done = set()
+    stream = channel.makefile('rb')
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                filename = _text(member.name)
+                f = files.get(filename)
+                if f is None or not member.isreg() or \
+                        (member.size, int(member.mtime)) != (f.size, f.mtime):
+                    log.debug("Skipping changed or unexpected member %s", filename)
+                    continue
+
+                lpath = os.path.join(local_root, filename)
+                part = part_name(lpath, f.mtime, f.size)
+                src = tar.extractfile(member)
+                try:
+                    with open(part, 'wb') as fp:
+                        while True:
+                            data = src.read(32768)
+                            if not data:
+                                break
+                            fp.write(data)
+                    os.utime(part, (f.mtime, f.mtime))
+                    os.rename(part, lpath)
+                except BaseException:
+                    # the stream broke in this member
+                    try:
+                        os.unlink(part)
+                    except OSError:
+                        pass
+                    raise
+                done.add(filename)
+                if callback is not None:
+                    callback(filename)
+        # the padding after the end of the archive
+        stream.read()
+    except tarfile.TarError as e:
+        # a broken or empty stream, the files so far are fine
+        log.debug("Can't read tar stream: %s", e)
+    except BaseException:
+        channel.close()
+        raise
+    finally:
+        feeder.join()
+
+    status, stderr = _finish(channel)
+
+    if status != 0:
+        log.warning("Remote tar exited with status %d: %s", status, stderr)
+    return done
+
+
+def upload(sftp, local_root, remote_root, files, callback=None):
+    """
+    Uploads files (dict of root relative filename -> File) into an
+    extracting tar command on the remote side. Mtimes and permissions are
+    taken from the Files.
+
+    Files which changed since they were listed are left out. Raises
+    IOError if the remote command fails, nothing can be assumed to be
+    uploaded then. Otherwise callback(filename) is called for every
+    uploaded file and the set of uploaded filenames is returned.
+    """
+    channel = exec_remote(sftp, 'tar -xpf - --no-same-owner -C %s' % quote(remote_root))
+
+    sent = set()
+    try:
+        with tarfile.open(fileobj=_ChannelWriter(channel), mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for filename, f in files.items():
+                lpath = os.path.join(local_root, filename)
+                try:
+                    s = os.lstat(lpath)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(s.st_mode) or (s.st_size, int(s.st_mtime)) != (f.size, f.mtime):
+                    log.debug("Skipping changed file %s", filename)
+                    continue
+
+                member = tarfile.TarInfo(filename)
+                member.size = f.size
+                member.mtime = f.mtime
+                member.mode = stat.S_IMODE(f.mode)
+                with open(lpath, 'rb') as fp:
+                    tar.addfile(member, fp)
+                sent.add(filename)
+        channel.shutdown_write()
+    except (IOError, EOFError, socket.error) as e:
+        # the command died, its status tells why
+        status, stderr = _finish(channel)
+        raise IOError("Remote tar exited with status %s: %s" % (status, stderr or e))
+    except BaseException:
+        channel.close()
+        raise
+
+    status, stderr = _finish(channel)
+
+    if status != 0:
+        raise IOError("Remote tar exited with status %d: %s" % (status, stderr))
+    if callback is not None:
+        for filename in sent:
+            callback(filename)
+    return sent
@@ -0,0 +1,243 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import hashlib
+import multiprocessing
+import os
+
+from helperlib.logging import scope_logger
+
+from .sftp import run_remote, python_command
+
+__author__ = 'bluec0re'
+
+# below this number of files the process pool isn't worth starting
+POOL_MIN_FILES = 16
+
+# reads NUL separated paths (relative to argv[1]) from stdin and prints
+# "path\0sha256\0" for every readable file
+REMOTE_HASH_SCRIPT = '''
+import hashlib, os, sys
+os.chdir(sys.argv[1])
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+for name in getattr(sys.stdin, 'buffer', sys.stdin).read().split(b'\\0'):
+    if not name:
+        continue
+    h = hashlib.sha256()
+    try:
+        f = open(name, 'rb')
+        while True:
+            b = f.read(1 << 20)
+            if not b:
+                break
+            h.update(b)
+        f.close()
+    except (IOError, OSError):
+        continue
+    out.write(name + b'\\0' + h.hexdigest().encode('ascii') + b'\\0')
+'''
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _try_hash_file(path):
+    """
+    hash_file() for the process pool: returns (hash, None), or (None,
+    error message) if the file can't be read
+    """
+    try:
+        return hash_file(path), None
+    except (IOError, OSError) as e:
+        return None, str(e)
+
+
+def remote_hashes(sftp, root, filenames):
+    """
+    Hashes the given files (relative to root) on the remote side with a
+    single command. Returns a dict of filename -> sha256. Unreadable files
+    are missing in the result.
+    """
+    if not filenames:
+        return {}
+
+    data = b'\0'.join(filename.encode('utf-8') for filename in filenames)
+    output = run_remote(sftp, python_command(REMOTE_HASH_SCRIPT, root), data)
+    parts = output.split(b'\0')
+    return dict((parts[i].decode('utf-8'), parts[i + 1].decode('ascii'))
+                for i in range(0, len(parts) - 1, 2))
+
+
+def _stat_key(s):
+    mtime_ns = getattr(s, 'st_mtime_ns', None)
+    ctime_ns = getattr(s, 'st_ctime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(s.st_mtime * 1e9)
+        ctime_ns = int(s.st_ctime * 1e9)
+    return '%d:%d:%d:%d:%d' % (s.st_dev, s.st_ino, mtime_ns, ctime_ns, s.st_size)
+
+
+@scope_logger
+class HashCache(object):
+    """
+    Persistent cache of local file hashes. Entries are keyed by device,
+    inode, mtime (ns) and size, so a file is only hashed again after it
+    was modified. The ctime is part of the key as well, as a rewrite which
+    restores the old mtime (like our own downloads) keeps all the others.
+
+    Every entry also holds the path of its file, relative to the directory
+    of the cache. On save, entries which weren't used during the run are
+    kept if they are outside of scope (a root relative directory) or their
+    file is unchanged, the others are dropped.
+    """
+    def __init__(self, fname, scope=None):
+        self.fname = fname
+        self.root = os.path.join(os.path.dirname(fname), '')
+        self.scope = (scope or '').rstrip('/') or None
+        # key -> (digest, path)
+        self.hashes = {}
+        # path -> key, to drop the entry of a file hashed again
+        self.keys = {}
+        self.used = set()
+        self.dirty = False
+
+    def load(self):
+        self.hashes = {}
+        self.keys = {}
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname, 'rb') as fp:
+            for line in fp.read().decode('utf-8').split('\n'):
+                parts = line.split('\t', 2)
+                # entries without a path are from older versions
+                if len(parts) == 2:
+                    self.hashes[parts[0]] = (parts[1], None)
+                elif len(parts) == 3:
+                    self.hashes[parts[0]] = (parts[1], parts[2])
+                    self.keys[parts[2]] = parts[0]
+        self.log.info('Loaded %d hashes from %s', len(self.hashes), self.fname)
+
+    def _in_scope(self, path):
+        return self.scope is None or path.startswith(self.scope + '/')
+
+    def _keep(self, key, path):
+        if key in self.used:
+            return True
+        if path is None:
+            return False
+        if not self._in_scope(path):
+            return True
+        return self._key(os.path.join(self.root, path)) == key
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.fname + '.tmp'
+        count = 0
+        with open(tmp, 'wb') as fp:
+            for key, (digest, path) in self.hashes.items():
+                if not self._keep(key, path):
+                    continue
+                if path is None:
+                    fp.write(('%s\t%s\n' % (key, digest)).encode('utf-8'))
+                else:
+                    fp.write(('%s\t%s\t%s\n' % (key, digest, path)).encode('utf-8'))
+                count += 1
+        os.rename(tmp, self.fname)
+        self.dirty = False
+        self.log.info('Saved %d hashes to %s', count, self.fname)
+
+    def _key(self, path):
+        try:
+            return _stat_key(os.stat(path))
+        except OSError:
+            return None
+
+    def _relative(self, path):
+        if path.startswith(self.root):
+            return path[len(self.root):]
+        return path
+
+    def _lookup(self, path, key):
+        entry = self.hashes.get(key)
+        if entry is None:
+            return None
+        self.used.add(key)
+        if entry[1] is None:
+            # an entry of an older version gets its path
+            self._store(path, key, entry[0])
+        return entry[0]
+
+    def _store(self, path, key, digest):
+        path = self._relative(path)
+        old = self.keys.get(path)
+        if old is not None and old != key:
+            self.hashes.pop(old, None)
+        self.hashes[key] = (digest, path)
+        self.keys[path] = key
+        self.used.add(key)
+        self.dirty = True
+
+    def get(self, path):
+        """
+        Hash of the regular file at path (or None)
+        """
+        if not os.path.isfile(path):
+            return None
+        key = self._key(path)
+        if key is None:
+            return None
+        digest = self._lookup(path, key)
+        if digest is None:
+            try:
+                digest = hash_file(path)
+            except (IOError, OSError):
+                return None
+            self._store(path, key, digest)
+        return digest
+
+    def hash_files(self, paths):
+        """
+        Hashes all given regular files, using a process pool for the ones
+        which aren't cached. Returns a dict of path -> hash. Unreadable
+        files are missing in the result.
+        """
+        result = {}
+        todo = []
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            key = self._key(path)
+            if key is None:
+                continue
+            digest = self._lookup(path, key)
+            if digest is None:
+                todo.append((path, key))
+            else:
+                result[path] = digest
+
+        if len(todo) >= POOL_MIN_FILES:
+            pool = multiprocessing.Pool()
+            try:
+                digests = pool.map(_try_hash_file, [path for path, _ in todo], 16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = [_try_hash_file(path) for path, _ in todo]
+
+        for (path, key), (digest, e) in zip(todo, digests):
+            if digest is None:
+                self.log.warning("Can't hash %s: %s", path, e)
+                continue
+            self._store(path, key, digest)
+            result[path] = digest
+        return result
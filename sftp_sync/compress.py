@@ -0,0 +1,279 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Compressed transfers of single files through a python helper on the
+remote side. Data is sent in zlib compressed blocks, blocks which don't
+get smaller are sent as they are.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import socket
+import struct
+import zlib
+
+from paramiko import SSHException
+
+from .sftp import exec_remote, python_command
+from .transfer import part_name
+
+__author__ = 'bluec0re'
+
+# smaller files aren't worth starting the helper
+MIN_SIZE = 64 * 1024
+BLOCK_SIZE = 256 * 1024
+SAMPLE_SIZE = 64 * 1024
+LEVEL = 1
+# a sample has to shrink below this ratio to be considered compressible
+MAX_RATIO = 0.9
+
+FRAME = struct.Struct('!cI')
+
+# exit status of the helper if it can't read or write the file, stderr
+# holds "errno\tmessage"
+FILE_ERROR = 3
+# exit status of the helper if an upload was aborted or broke off
+ABORTED = 4
+
+# formats which are compressed already
+INCOMPRESSIBLE = frozenset((
+    '.7z', '.apk', '.avi', '.bz2', '.deb', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar',
+    '.jpeg', '.jpg', '.lz', '.lz4', '.lzma', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt',
+    '.ogg', '.opus', '.pdf', '.png', '.pptx', '.rar', '.rpm', '.tbz2', '.tgz', '.txz', '.webm',
+    '.webp', '.whl', '.woff', '.woff2', '.xlsx', '.xz', '.zip', '.zst',
+))
+COMPRESSIBLE = frozenset((
+    '.c', '.cfg', '.cpp', '.css', '.csv', '.h', '.htm', '.html', '.ini', '.java', '.js',
+    '.json', '.log', '.md', '.php', '.pl', '.py', '.rb', '.rst', '.sh', '.sql', '.svg',
+    '.tex', '.tsv', '.txt', '.xml', '.yaml', '.yml',
+))
+
+# get PATH: writes the frames of PATH to stdout
+# put PATH PART MTIME MODE: writes the frames from stdin to PART, sets
+# mtime and mode and renames it to PATH. PART is removed if the upload
+# fails, is aborted with an 'a' frame or the input ends early.
+REMOTE_SCRIPT = '''
+import os, struct, sys, zlib
+FRAME = struct.Struct('!cI')
+def failed(e):
+    sys.stderr.write('%%d\\t%%s' %% (e.errno or 0, e))
+    sys.exit(%(file_error)d)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+def read(n):
+    data = b''
+    while len(data) < n:
+        chunk = inp.read(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+if sys.argv[1] == 'get':
+    try:
+        f = open(sys.argv[2], 'rb')
+    except (IOError, OSError) as e:
+        failed(e)
+    while True:
+        block = f.read(%(block)d)
+        if not block:
+            break
+        data = zlib.compress(block, %(level)d)
+        if len(data) < len(block):
+            out.write(FRAME.pack(b'z', len(data)) + data)
+        else:
+            out.write(FRAME.pack(b'r', len(block)) + block)
+    out.write(FRAME.pack(b'e', 0))
+    out.flush()
+else:
+    path, part, mtime, mode = sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])
+    f = None
+    try:
+        f = open(part, 'wb')
+        while True:
+            kind, length = FRAME.unpack(read(FRAME.size))
+            if kind == b'e':
+                break
+            if kind == b'a':
+                raise EOFError
+            data = read(length)
+            f.write(zlib.decompress(data) if kind == b'z' else data)
+        f.close()
+        os.chmod(part, mode)
+        os.utime(part, (mtime, mtime))
+        os.rename(part, path)
+    except Exception as e:
+        try:
+            if f is not None:
+                f.close()
+                os.unlink(part)
+        except Exception:
+            pass
+        if isinstance(e, (IOError, OSError)):
+            failed(e)
+        sys.exit(%(aborted)d)
+''' % {'block': BLOCK_SIZE, 'level': LEVEL, 'file_error': FILE_ERROR, 'aborted': ABORTED}
+
+
+class HelperError(IOError):
+    """
+    The remote helper couldn't be started or failed for another reason
+    than the file, so compressed transfers won't work
+    """
+
+
+def compressible(path, sample=True):
+    """
+    Decides by the extension of path if it's worth compressing. Files of
+    unknown types are sampled if sample is set and path is local.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in INCOMPRESSIBLE:
+        return False
+    if ext in COMPRESSIBLE or not sample:
+        return True
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read(SAMPLE_SIZE)
+    except (IOError, OSError):
+        return False
+    return len(zlib.compress(data, LEVEL)) < len(data) * MAX_RATIO
+
+
+def _read(fp, n):
+    data = b''
+    while len(data) < n:
+        chunk = fp.read(n - len(data))
+        if not chunk:
+            raise EOFError("Compressed stream ended unexpectedly")
+        data += chunk
+    return data
+
+
+def _finish(channel):
+    try:
+        stderr = channel.makefile_stderr('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    stderr = stderr.decode('utf-8', 'replace').strip()
+    if status == FILE_ERROR:
+        number, _, message = stderr.partition('\t')
+        raise IOError(int(number) if number.isdigit() else 0, message)
+    if status != 0:
+        raise HelperError("Remote compression helper failed with status %d: %s" % (status, stderr))
+
+
+def _send(channel, data):
+    try:
+        channel.sendall(data)
+    except socket.error:
+        # the helper exited early, its status tells why
+        _finish(channel)
+        raise
+
+
+def _abort(channel):
+    """
+    Tells the helper to drop the partial file of an upload and waits for
+    it to exit
+    """
+    try:
+        channel.sendall(FRAME.pack(b'a', 0))
+        channel.shutdown_write()
+        channel.recv_exit_status()
+    except (socket.error, EOFError, SSHException):
+        pass
+    finally:
+        channel.close()
+
+
+def _start(sftp, *args):
+    try:
+        return exec_remote(sftp, python_command(REMOTE_SCRIPT, *args))
+    except SSHException as e:
+        raise HelperError("Can't start the remote compression helper: %s" % e)
+
+
+def download(sftp, rpath, lpath, mtime, size, callback=None):
+    """
+    Downloads rpath to lpath through the remote helper and sets the
+    mtime. Returns the number of bytes received.
+
+    Raises HelperError if the helper doesn't work and IOError if only
+    this file can't be transferred.
+    """
+    channel = _start(sftp, 'get', rpath)
+    channel.shutdown_write()
+    stream = channel.makefile('rb')
+    part = part_name(lpath, mtime, size)
+    total = received = 0
+    try:
+        with open(part, 'wb') as fp:
+            while True:
+                kind, length = FRAME.unpack(_read(stream, FRAME.size))
+                received += FRAME.size + length
+                if kind == b'e':
+                    break
+                data = _read(stream, length)
+                if kind == b'z':
+                    data = zlib.decompress(data)
+                fp.write(data)
+                total += len(data)
+                if callback is not None:
+                    callback(total, size)
+        _finish(channel)
+        if total != size:
+            raise IOError("size mismatch in transfer!  %d != %d" % (total, size))
+    except BaseException as e:
+        try:
+            if isinstance(e, EOFError):
+                # the helper failed, its status tells why
+                _finish(channel)
+        finally:
+            channel.close()
+            try:
+                os.unlink(part)
+            except OSError:
+                pass
+        raise
+
+    os.utime(part, (mtime, mtime))
+    os.rename(part, lpath)
+    return received
+
+
+def upload(sftp, lpath, rpath, mtime, size, mode, callback=None):
+    """
+    Uploads lpath to rpath through the remote helper and sets the mtime
+    and the permissions. Returns the number of bytes sent. Errors are
+    raised like by download().
+    """
+    part = part_name(rpath, mtime, size)
+    channel = _start(sftp, 'put', rpath, part, str(mtime), str(mode & 0o7777))
+    total = sent = 0
+    try:
+        with open(lpath, 'rb') as fp:
+            while True:
+                block = fp.read(BLOCK_SIZE)
+                if not block:
+                    break
+                data = zlib.compress(block, LEVEL)
+                if len(data) < len(block):
+                    frame = FRAME.pack(b'z', len(data)) + data
+                else:
+                    frame = FRAME.pack(b'r', len(block)) + block
+                _send(channel, frame)
+                sent += len(frame)
+                total += len(block)
+                if callback is not None:
+                    callback(total, size)
+        if total != size:
+            raise IOError("size mismatch in transfer!  %d != %d" % (total, size))
+        _send(channel, FRAME.pack(b'e', 0))
+        sent += FRAME.size
+        channel.shutdown_write()
+    except BaseException:
+        _abort(channel)
+        raise
+    _finish(channel)
+    return sent
+
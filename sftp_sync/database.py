@@ -0,0 +1,264 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Revision data in a SQLite database, an alternative to the .files text
+file. Entries are looked up on demand instead of being loaded, and
+other processes can read the database while a sync is running.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import sqlite3
+import time
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from helperlib.logging import scope_logger
+
+__author__ = 'bluec0re'
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    hash TEXT,
+    target TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+'''
+
+COLUMNS = 'mtime, size, mode, hash, target'
+INSERT = 'INSERT OR REPLACE INTO files (path, dir, %s) VALUES (?, ?, ?, ?, ?, ?, ?)' % COLUMNS
+
+
+@scope_logger
+class RevisionDatabase(MutableMapping):
+    """
+    Stores the last synced state of every file in a SQLite database in
+    WAL mode, with the same interface as RevisionFile.
+
+    Lookups load the whole directory of the entry, as the entries of a
+    directory are usually needed together. Only the last directory is
+    kept. Changes done through `record()` and `forget()` are committed in
+    batches of BATCH_SIZE changes or after BATCH_SECONDS, changes done
+    through the mapping interface only by `save()` / `commit()`. If scope
+    is set, only the entries below that directory are visible.
+
+    The database is created with the first change. An existing revision
+    file (legacy) is imported into a new database and renamed to
+    legacy + '.migrated' afterwards.
+    """
+    BATCH_SIZE = 1000
+    BATCH_SECONDS = 1.0
+
+    def __init__(self, fname, scope=None, legacy=None):
+        self.fname = fname
+        self.scope = (scope or '').rstrip('/') or None
+        self.legacy = legacy
+        self._pending = 0
+        self._committed = time.time()
+        self.db = None
+        self._dir = None
+        self._entries = {}
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.fname, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(SCHEMA)
+            self._migrate()
+        return self.db
+
+    def _query(self, query, args=()):
+        """
+        Runs a read only query, a database which doesn't exist yet is empty
+        """
+        if self.db is None and not os.path.exists(self.fname):
+            return iter(())
+        return self._connect().execute(query, args)
+
+    def _execute(self, query, args=()):
+        return self._connect().execute(query, args)
+
+    def in_scope(self, fn):
+        return self.scope is None or fn.startswith(self.scope + '/')
+
+    def _where(self, column='path'):
+        """
+        Condition and arguments restricting a query to the scope
+        """
+        if self.scope is None:
+            return '1', ()
+        return '%s >= ? AND %s < ?' % (column, column), (self.scope + '/', self.scope + '0')
+
+    def _file(self, row):
+        from .sync import File
+        return File(*row)
+
+    def _listdir(self, directory):
+        """
+        Entries of directory (cached)
+        """
+        if directory != self._dir:
+            query = 'SELECT path, %s FROM files WHERE dir = ?' % COLUMNS
+            self._entries = dict((row[0], self._file(row[1:])) for row in self._query(query, (directory,)))
+            self._dir = directory
+        return self._entries
+
+    def __getitem__(self, fn):
+        if not self.in_scope(fn):
+            raise KeyError(fn)
+        return self._listdir(os.path.dirname(fn))[fn]
+
+    def __contains__(self, fn):
+        return self.in_scope(fn) and fn in self._listdir(os.path.dirname(fn))
+
+    def __setitem__(self, fn, data):
+        self._execute(INSERT, (fn, os.path.dirname(fn)) + tuple(data))
+        if os.path.dirname(fn) == self._dir:
+            self._entries[fn] = self._file(data)
+
+    def _delete(self, fn):
+        if os.path.dirname(fn) == self._dir:
+            self._entries.pop(fn, None)
+        return self._execute('DELETE FROM files WHERE path = ?', (fn,)).rowcount
+
+    def __delitem__(self, fn):
+        if not self.in_scope(fn) or self._delete(fn) == 0:
+            raise KeyError(fn)
+
+    def __iter__(self):
+        where, args = self._where()
+        for row in self._query('SELECT path FROM files WHERE %s ORDER BY path' % where, args):
+            yield row[0]
+
+    def __len__(self):
+        where, args = self._where()
+        return next(self._query('SELECT COUNT(*) FROM files WHERE %s' % where, args), (0,))[0]
+
+    def __bool__(self):
+        where, args = self._where()
+        row = next(self._query('SELECT 1 FROM files WHERE %s LIMIT 1' % where, args), None)
+        return row is not None
+    __nonzero__ = __bool__
+
+    def items(self):
+        where, args = self._where()
+        query = 'SELECT path, %s FROM files WHERE %s ORDER BY path' % (COLUMNS, where)
+        for row in self._query(query, args):
+            yield row[0], self._file(row[1:])
+
+    def clear(self):
+        where, args = self._where()
+        self._execute('DELETE FROM files WHERE %s' % where, args)
+        self._dir = None
+
+    def listdir(self, directory):
+        """
+        Filenames of the entries directly in the (root relative) directory
+        """
+        if self.scope is not None and not self.in_scope(directory + '/'):
+            return []
+        return list(self._listdir(directory))
+
+    def directories(self):
+        """
+        Directories which directly contain entries
+        """
+        where, args = self._where('dir')
+        # dir is the scope itself for its top level entries
+        if self.scope is not None:
+            where, args = '(%s OR dir = ?)' % where, args + (self.scope,)
+        return [row[0] for row in self._query('SELECT DISTINCT dir FROM files WHERE %s' % where, args)]
+
+    def subtree(self, path):
+        """
+        Filenames of the entry path and of the entries below the (root
+        relative) directory path
+        """
+        where, args = self._where()
+        if path:
+            where, args = '%s AND (path = ? OR path >= ? AND path < ?)' % where, \
+                args + (path, path + '/', path + '0')
+        return [row[0] for row in self._query('SELECT path FROM files WHERE %s' % where, args)]
+
+    def _migrate(self):
+        """
+        Imports the legacy revision file into a new database
+        """
+        from .sync import RevisionFile
+
+        version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is not None:
+            return
+        legacy = None
+        if self.legacy is not None and os.path.exists(self.legacy):
+            legacy = RevisionFile(self.legacy)
+            legacy.load()
+            self.db.executemany(INSERT, ((fn, os.path.dirname(fn)) + tuple(data)
+                                         for fn, data in legacy.items()))
+            self.log.warning('Imported %d files from %s', len(legacy), self.legacy)
+        self.db.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", ('%d' % SCHEMA_VERSION,))
+        self.db.commit()
+
+        if legacy is not None:
+            # the journal is part of the renamed file then
+            legacy.save()
+            os.rename(self.legacy, self.legacy + '.migrated')
+            for fname in (legacy.offsets, legacy.columns):
+                if os.path.exists(fname):
+                    os.unlink(fname)
+
+    def load(self):
+        self._pending = 0
+        self._dir = None
+        if self.db is not None:
+            self.db.rollback()
+        elif os.path.exists(self.fname) or self.legacy is not None and os.path.exists(self.legacy):
+            self._connect()
+        else:
+            self.log.warning('Revision database %s does not exist', self.fname)
+            return
+        self.log.info('Using revision database %s', self.fname)
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.BATCH_SIZE or time.time() - self._committed >= self.BATCH_SECONDS:
+            self.save()
+
+    def record(self, fn, data):
+        """
+        Sets the entry for fn, committed with the next batch
+        """
+        self[fn] = data
+        self._changed()
+
+    def forget(self, fn):
+        """
+        Removes the entry for fn, committed with the next batch
+        """
+        self._delete(fn)
+        self._changed()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def commit(self):
+        self.save()
+
+    def save(self):
+        self._connect().commit()
+        self._pending = 0
+        self._committed = time.time()
@@ -0,0 +1,128 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+What happens to files which were deleted on the other side. Besides
+asking for every file, deletions can be done, skipped or moved into a
+trash directory without any questions, so a sync can run unattended.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import namedtuple
+import os
+
+from helperlib import info, error, warning
+
+__author__ = 'bluec0re'
+
+ASK = 'ask'
+NEVER = 'never'
+ALWAYS = 'always'
+TRASH = 'trash'
+
+POLICIES = (ASK, NEVER, ALWAYS, TRASH)
+
+# below the root of the side the files are deleted on
+TRASH_DIR = '.sftpsync-trash'
+
+# failed deletions listed in the report
+MAX_LISTED = 10
+
+DeletePolicy = namedtuple('DeletePolicy', ('mode', 'trash_dir', 'max_count'))
+DeletePolicy.__new__.__defaults__ = (None, None, None)
+
+
+def resolve(policy, setting, batch=False):
+    """
+    Completes a DeletePolicy from the command line with the settings file
+    (setting(option) returns a value or None) and the defaults. Files are
+    kept in batch mode unless a policy is given.
+    """
+    policy = policy or DeletePolicy()
+    mode = policy.mode or setting('delete') or (NEVER if batch else ASK)
+    if mode not in POLICIES:
+        raise ValueError("Unknown delete policy %s, use one of %s" % (mode, ', '.join(POLICIES)))
+    if mode == ASK and batch:
+        raise ValueError("Can't ask before deleting in batch mode, use one of %s" % (
+            ', '.join(p for p in POLICIES if p != ASK)))
+
+    trash_dir = (policy.trash_dir or setting('trash_dir') or TRASH_DIR).strip('/')
+    if not trash_dir or os.path.isabs(trash_dir) or trash_dir.split('/')[0] == os.pardir:
+        raise ValueError("The trash directory has to be below the root: %s" % trash_dir)
+
+    max_count = policy.max_count
+    if max_count is None and setting('max_delete') is not None:
+        max_count = int(setting('max_delete'))
+    return DeletePolicy(mode, trash_dir, max_count)
+
+
+class DeleteReport(object):
+    """
+    Outcome of the deletions of a sync run, shown as a summary instead of
+    a line per file
+    """
+    OUTCOMES = (('deleted', 'deleted'), ('trashed', 'moved to the trash'),
+                ('gone', 'already gone'), ('kept', 'kept'),
+                ('changed', 'kept as they changed since the last sync'),
+                ('failed', 'failed'), ('dirs', 'emptied directories removed'))
+
+    def __init__(self):
+        self.counts = {}
+        self.failures = []
+        self.conflicts = []
+        self.limited = None
+
+    def add(self, side, outcome, n=1):
+        if n:
+            self.counts[side, outcome] = self.counts.get((side, outcome), 0) + n
+
+    def fail(self, side, path, e):
+        self.add(side, 'failed')
+        self.failures.append((side, path, e))
+
+    def conflict(self, side, path):
+        """
+        Records that the file at path wasn't deleted as it changed since
+        the last sync
+        """
+        self.add(side, 'changed')
+        self.conflicts.append((side, path))
+
+    def limit(self, count, max_count):
+        """
+        Records that count deletions were refused because of max_count
+        """
+        self.limited = (count, max_count)
+
+    @property
+    def problem(self):
+        """
+        Message describing why the deletions weren't complete, or None
+        """
+        if self.limited is not None:
+            return "Refusing to delete %d files, the limit is %d" % self.limited
+        if self.failures:
+            side, path, e = self.failures[0]
+            if len(self.failures) == 1:
+                return "Can't delete %s file %s: %s" % (side, path, e)
+            return "%d deletions failed" % len(self.failures)
+        if self.conflicts:
+            if len(self.conflicts) == 1:
+                return "%s file %s changed since the last sync, not deleting it" % self.conflicts[0]
+            return "%d files changed since the last sync, not deleting them" % len(self.conflicts)
+        return None
+
+    def show(self):
+        if self.limited is not None:
+            error("%s, nothing was deleted\n" % self.problem)
+        for side in ('local', 'remote'):
+            parts = ["%d %s" % (self.counts[side, outcome], text)
+                     for outcome, text in self.OUTCOMES if (side, outcome) in self.counts]
+            if parts:
+                info("%s deletions: %s\n" % (side.capitalize(), ', '.join(parts)))
+        for side, path in self.conflicts[:MAX_LISTED]:
+            error("Not deleting %s file %s, it changed since the last sync\n" % (side, path))
+        if len(self.conflicts) > MAX_LISTED:
+            warning("... and %d more\n" % (len(self.conflicts) - MAX_LISTED))
+        for side, path, e in self.failures[:MAX_LISTED]:
+            error("Can't delete %s file %s: %s\n" % (side, path, e))
+        if len(self.failures) > MAX_LISTED:
+            warning("... and %d more\n" % (len(self.failures) - MAX_LISTED))
@@ -0,0 +1,153 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import hashlib
+import os
+import logging
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .sftp import run_remote, python_command
+from .transfer import part_name, PART_SUFFIX, remote_rename, set_remote_attributes
+
+__author__ = 'bluec0re'
+
+log = logging.getLogger(__name__)
+
+DELTA_BLOCK_SIZE = 64 * 1024
+
+# prints the md5 of every block of a file, one per line
+BLOCK_DIGEST_SCRIPT = '''
+import hashlib, sys
+bs = int(sys.argv[1])
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+f = open(sys.argv[2], 'rb')
+while True:
+    b = f.read(bs)
+    if not b:
+        break
+    out.write(hashlib.md5(b).hexdigest().encode('ascii') + b'\\n')
+'''
+
+
+def block_digests(fp, block_size=DELTA_BLOCK_SIZE):
+    digests = []
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        digests.append(hashlib.md5(block).hexdigest())
+    return digests
+
+
+def remote_block_digests(sftp, path, block_size=DELTA_BLOCK_SIZE):
+    output = run_remote(sftp, python_command(BLOCK_DIGEST_SCRIPT, str(block_size), path))
+    return output.decode('ascii').split()
+
+
+def changed_ranges(old, new, size, block_size=DELTA_BLOCK_SIZE):
+    """
+    Returns the (offset, length) ranges of the new file which are not
+    available at the same position in the old one. Adjacent blocks are
+    merged.
+    """
+    ranges = []
+    for i, digest in enumerate(new):
+        if i < len(old) and old[i] == digest:
+            continue
+        offset = i * block_size
+        length = min(block_size, size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+def delta_name(path, mtime, size):
+    """
+    Name of the file a delta transfer to path patches. Blocks are written
+    out of order, so it must never be taken for a resumable partial file.
+    """
+    return part_name(path, mtime, size)[:-len(PART_SUFFIX)] + '.delta' + PART_SUFFIX
+
+
+def delta_download(sftp, rpath, lpath, mtime, size, block_size=DELTA_BLOCK_SIZE):
+    """
+    Updates the existing local copy lpath to the content of rpath, fetching
+    only the blocks which differ. Returns the number of transferred bytes.
+    """
+    remote = remote_block_digests(sftp, rpath, block_size)
+    with open(lpath, 'rb') as fp:
+        local = block_digests(fp, block_size)
+
+    ranges = changed_ranges(local, remote, size, block_size)
+    tmp = delta_name(lpath, mtime, size)
+    transferred = 0
+    try:
+        with open(lpath, 'rb') as old:
+            with open(tmp, 'wb') as new:
+                with sftp.open(rpath, 'rb') as rf:
+                    chunks = rf.readv(ranges) if ranges else iter(())
+                    pos = 0
+                    for offset, length in ranges:
+                        if offset > pos:
+                            old.seek(pos)
+                            new.write(old.read(offset - pos))
+                        data = next(chunks)
+                        new.write(data)
+                        transferred += len(data)
+                        pos = offset + length
+                    if pos < size:
+                        old.seek(pos)
+                        new.write(old.read(size - pos))
+                if new.tell() != size:
+                    raise IOError("size mismatch in delta transfer!  %d != %d" % (new.tell(), size))
+        os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, lpath)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return transferred
+
+
+def delta_upload(sftp, lpath, rpath, mtime, size, block_size=DELTA_BLOCK_SIZE):
+    """
+    Updates the existing remote copy rpath to the content of lpath, sending
+    only the blocks which differ. Returns the number of transferred bytes.
+    """
+    remote = remote_block_digests(sftp, rpath, block_size)
+    with open(lpath, 'rb') as fp:
+        local = block_digests(fp, block_size)
+
+    ranges = changed_ranges(remote, local, size, block_size)
+    tmp = delta_name(rpath, mtime, size)
+    run_remote(sftp, 'cp -p -- %s %s' % (quote(rpath), quote(tmp)))
+
+    transferred = 0
+    try:
+        with open(lpath, 'rb') as lf:
+            with sftp.open(tmp, 'r+b') as rf:
+                rf.set_pipelined(True)
+                for offset, length in ranges:
+                    lf.seek(offset)
+                    data = lf.read(length)
+                    rf.seek(offset)
+                    rf.write(data)
+                    transferred += len(data)
+                rf.truncate(size)
+        remote_rename(sftp, tmp, rpath)
+    except BaseException:
+        try:
+            sftp.remove(tmp)
+        except (IOError, EOFError):
+            pass
+        raise
+
+    set_remote_attributes(sftp, rpath, mtime)
+    return transferred
@@ -0,0 +1,261 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Compact in-memory table of the revision entries of RevisionFile
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import array
+import binascii
+from bisect import bisect_left, insort
+import marshal
+import sys
+
+__author__ = 'bluec0re'
+
+# 64 bit integers, 'q' is missing on python 2 (where 'l' is 64 bit on 64 bit unix)
+INT64 = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+
+DIGEST_SIZE = 32
+NO_DIGEST = b'\0' * DIGEST_SIZE
+
+SNAPSHOT_VERSION = 1
+
+
+def _digest(hash):
+    """
+    The raw form of a sha256 hex digest, or None for other hashes
+    """
+    if hash is None or len(hash) != 2 * DIGEST_SIZE:
+        return None
+    try:
+        digest = binascii.unhexlify(hash)
+    except (TypeError, ValueError):
+        return None
+    # upper case digests wouldn't survive the round trip
+    if hash.lower() != hash or digest == NO_DIGEST:
+        return None
+    return digest
+
+
+def _to_bytes(column):
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+
+def _from_bytes(data):
+    column = array.array(INT64)
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+    return column
+
+
+class EntryTable(object):
+    """
+    Maps (root relative) paths to (mtime, size, mode, hash, target)
+    tuples with little memory per entry.
+
+    Every directory is kept once, with a dict of the names in it and
+    their row. The mtime, size and mode of all entries are kept in arrays
+    indexed by row, sha256 hashes as 32 raw bytes per row. Symlink targets
+    and other hashes are rare and kept in a dict per row. Rows of removed
+    entries are reused.
+
+    `dump()` and `load()` convert the table from and to a bytes snapshot
+    which is read without parsing every entry. A sorted list of the
+    directories is built by the first `subtree()` and kept up to date.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.dirs = {}
+        self.mtimes = array.array(INT64)
+        self.sizes = array.array(INT64)
+        self.modes = array.array(INT64)
+        self.digests = bytearray()
+        self.extra = {}
+        self.free = []
+        self.count = 0
+        self._sorted = None
+
+    def _row(self, path):
+        directory, _, name = path.rpartition('/')
+        names = self.dirs.get(directory)
+        if names is None:
+            return None
+        return names.get(name)
+
+    def get(self, path):
+        row = self._row(path)
+        if row is None:
+            return None
+        hash, target = self.extra.get(row, (None, None))
+        if hash is None:
+            digest = self.digests[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE]
+            if digest != NO_DIGEST:
+                hash = binascii.hexlify(digest).decode('ascii')
+        return self.mtimes[row], self.sizes[row], self.modes[row], hash, target
+
+    def _added(self, directory):
+        if self._sorted is not None:
+            insort(self._sorted, directory)
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        for column in (self.mtimes, self.sizes, self.modes):
+            column.append(0)
+        self.digests.extend(NO_DIGEST)
+        return len(self.mtimes) - 1
+
+    def set(self, path, mtime, size, mode, hash=None, target=None):
+        directory, _, name = path.rpartition('/')
+        names = self.dirs.get(directory)
+        if names is None:
+            names = self.dirs[directory] = {}
+            self._added(directory)
+        row = names.get(name)
+        if row is None:
+            row = names[name] = self._allocate()
+            self.count += 1
+
+        self.mtimes[row] = int(mtime)
+        self.sizes[row] = int(size)
+        self.modes[row] = int(mode)
+        digest = _digest(hash)
+        self.digests[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE] = digest or NO_DIGEST
+        if target is not None or digest is None and hash is not None:
+            self.extra[row] = (None if digest else hash, target)
+        else:
+            self.extra.pop(row, None)
+
+    def update(self, entries):
+        """
+        set() for an iterable of (path, mtime, size, mode, hash, target)
+        tuples. New entries are appended to the columns directly.
+        """
+        dirs = self.dirs
+        mtimes, sizes, modes = self.mtimes, self.sizes, self.modes
+        digests, extra = self.digests, self.extra
+        for path, mtime, size, mode, hash, target in entries:
+            directory, _, name = path.rpartition('/')
+            names = dirs.get(directory)
+            if names is None:
+                names = dirs[directory] = {}
+                self._sorted = None
+            if name in names or self.free:
+                self.set(path, mtime, size, mode, hash, target)
+                continue
+            row = names[name] = len(mtimes)
+            mtimes.append(mtime)
+            sizes.append(size)
+            modes.append(mode)
+            digest = _digest(hash)
+            digests.extend(digest or NO_DIGEST)
+            if target is not None or digest is None and hash is not None:
+                extra[row] = (None if digest else hash, target)
+            self.count += 1
+
+    def remove(self, path):
+        """
+        Removes the entry of path. Returns False if there is none.
+        """
+        directory, _, name = path.rpartition('/')
+        names = self.dirs.get(directory)
+        if names is None or name not in names:
+            return False
+        row = names.pop(name)
+        if not names:
+            del self.dirs[directory]
+            if self._sorted is not None:
+                del self._sorted[bisect_left(self._sorted, directory)]
+        self.extra.pop(row, None)
+        self.free.append(row)
+        self.count -= 1
+        return True
+
+    def __contains__(self, path):
+        return self._row(path) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for directory, names in self.dirs.items():
+            if not directory:
+                for name in names:
+                    yield name
+                continue
+            prefix = directory + '/'
+            for name in names:
+                yield prefix + name
+
+    def listdir(self, directory):
+        """
+        Paths of the entries directly in directory
+        """
+        names = self.dirs.get(directory)
+        if not names:
+            return ()
+        prefix = directory + '/' if directory else ''
+        return [prefix + name for name in names]
+
+    def directories(self):
+        """
+        Directories which directly contain entries
+        """
+        return list(self.dirs)
+
+    def subtree(self, path):
+        """
+        Paths of the entry path and of all entries below the directory
+        path
+        """
+        if not path:
+            return list(self)
+        result = [path] if path in self else []
+        result.extend(self.listdir(path))
+        if self._sorted is None:
+            self._sorted = sorted(self.dirs)
+        # the directories below path sort between path + '/' and path + '0'
+        lower, upper = path + '/', path + '0'
+        dirs = self._sorted
+        for i in range(bisect_left(dirs, lower), len(dirs)):
+            if dirs[i] >= upper:
+                break
+            result.extend(self.listdir(dirs[i]))
+        return result
+
+    def dump(self):
+        """
+        Returns the table as a snapshot for load()
+        """
+        dirs = [(directory, list(names), list(names.values())) for directory, names in self.dirs.items()]
+        return marshal.dumps((SNAPSHOT_VERSION, sys.byteorder, dirs, _to_bytes(self.mtimes),
+                              _to_bytes(self.sizes), _to_bytes(self.modes), bytes(self.digests),
+                              self.extra, self.free))
+
+    def load(self, data):
+        """
+        Replaces the content of the table with a snapshot of dump(). Raises
+        ValueError if it can't be read.
+        """
+        try:
+            version, byteorder, dirs, mtimes, sizes, modes, digests, extra, free = marshal.loads(data)
+        except (EOFError, TypeError, ValueError) as e:
+            raise ValueError("Broken snapshot: %s" % e)
+        if (version, byteorder) != (SNAPSHOT_VERSION, sys.byteorder):
+            raise ValueError("Snapshot version %r (%s) not supported" % (version, byteorder))
+        self.dirs = dict((directory, dict(zip(names, rows))) for directory, names, rows in dirs)
+        self.mtimes = _from_bytes(mtimes)
+        self.sizes = _from_bytes(sizes)
+        self.modes = _from_bytes(modes)
+        self.digests = bytearray(digests)
+        self.extra = extra
+        self.free = free
+        self._sorted = None
+        self.count = sum(len(names) for names in self.dirs.values())
+        if not len(self.mtimes) == len(self.sizes) == len(self.modes) == len(self.digests) // DIGEST_SIZE:
+            self.clear()
+            raise ValueError("Broken snapshot: columns differ in length")
@@ -0,0 +1,85 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import re
+
+from helperlib.logging import scope_logger
+
+from .transfer import PART_SUFFIX
+
+__author__ = 'bluec0re'
+
+# editor backups and swap files, office lock files, python bytecode and
+# our own partial transfers
+DEFAULT_RULES = re.compile(
+    r'(~|\.swp|\.swo|\.pyc|\.pyo|%s)$' % re.escape(PART_SUFFIX) +
+    r'|(^|/)(\.~|~\$)[^/]*$' +
+    r'|__pycache__'
+)
+
+
+@scope_logger
+class ExcludeMatcher(object):
+    """
+    Decides which paths are left out of a sync. Paths are relative to
+    the project root.
+
+    The user pattern is matched at the start of the path, the default
+    rules anywhere in it. A directory is excluded if its path matches,
+    with or without a trailing slash, and nothing below it is visited.
+    Results are cached for directories and excluded paths only, so the
+    cache doesn't grow with the tree. `hits` counts the excluded paths.
+    """
+    def __init__(self, pattern=None):
+        if pattern is not None and not hasattr(pattern, 'pattern'):
+            pattern = re.compile(pattern)
+        self.pattern = pattern
+        self._files = {}
+        self._dirs = {}
+        self.hits = 0
+
+    def match(self, path):
+        """
+        True if the path itself is excluded
+        """
+        if path in self._files:
+            return True
+
+        excluded = False
+        if self.pattern is not None and self.pattern.match(path):
+            self.log.debug("Excluded by regex: %s", path)
+            excluded = True
+        elif DEFAULT_RULES.search(path):
+            self.log.debug("Excluded by default: %s", path)
+            excluded = True
+        if excluded:
+            self.hits += 1
+            self._files[path] = True
+        return excluded
+
+    def match_dir(self, path):
+        """
+        True if the directory at path shouldn't be entered
+        """
+        try:
+            return self._dirs[path]
+        except KeyError:
+            pass
+
+        excluded = self.match(path) or self.match(path + '/')
+        self._dirs[path] = excluded
+        return excluded
+
+    def excluded(self, path):
+        """
+        True if the path or any of its parent directories is excluded
+        """
+        if self.match(path):
+            return True
+        parent = os.path.dirname(path)
+        while parent:
+            if self.match_dir(parent):
+                return True
+            parent = os.path.dirname(parent)
+        return False
@@ -0,0 +1,206 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Lists the local tree with os.scandir. Directories are listed by a few
+threads ahead of the consumer, which hides the latency of network file
+systems.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import errno
+import os
+import stat
+import threading
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from helperlib.logging import scope_logger
+
+__author__ = 'bluec0re'
+
+WORKERS = 8
+# directories listed ahead of the consumer
+WINDOW = 64
+
+
+class _Entry(object):
+    """
+    Replacement of os.scandir() entries for pythons without it
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=False):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def _scandir(path):
+    return iter([_Entry(path, name) for name in os.listdir(path)])
+
+
+scandir = getattr(os, 'scandir', _scandir)
+
+
+def _decode(name):
+    try:
+        return name.decode('utf-8')
+    except UnicodeError:
+        return name
+
+
+class _Listing(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+@scope_logger
+class LocalScanner(object):
+    """
+    Lists directories below root. Paths are relative to root, directories
+    for which skip_dir(path) is true aren't listed and files for which
+    skip_file(path) is true are left out. Up to workers (default WORKERS)
+    directories are listed at once.
+
+    Listings are (dirs, files) with a list of directory names and a dict
+    of file name -> lstat result. Symlinks to directories are files.
+    """
+    def __init__(self, root, skip_dir, skip_file, workers=None):
+        self.root = root
+        self.skip_dir = skip_dir
+        self.skip_file = skip_file
+        self.workers = WORKERS if workers is None else workers
+        self._tasks = Queue()
+        self._threads = []
+        self._listings = {}
+
+    def _scan(self, root):
+        """
+        Lists root unfiltered, returns None if it doesn't exist
+        """
+        path = os.path.join(self.root, root).encode('utf-8')
+        dirs = []
+        files = []
+        try:
+            entries = scandir(path)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            # an unreadable directory must not look like deleted files
+            raise IOError("Error during listing of %s: %s" % (path.decode('utf-8'), e))
+
+        try:
+            for entry in entries:
+                name = _decode(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(name)
+                    continue
+                try:
+                    files.append((name, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    # vanished in the meantime
+                    continue
+        except OSError as e:
+            raise IOError("Error during listing of %s: %s" % (path.decode('utf-8'), e))
+        finally:
+            close = getattr(entries, 'close', None)
+            if close is not None:
+                close()
+        return dirs, files
+
+    def _worker(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            root, listing = task
+            try:
+                listing.result = self._scan(root)
+            except Exception as e:
+                listing.error = e
+            listing.done.set()
+
+    def prefetch(self, roots):
+        """
+        Starts listing the given directories in the background, as far as
+        the window allows
+        """
+        if self.workers <= 1:
+            return
+        for root in roots:
+            if len(self._listings) >= WINDOW:
+                break
+            if root in self._listings:
+                continue
+            if not self._threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._worker)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+            listing = self._listings[root] = _Listing()
+            self._tasks.put((root, listing))
+
+    def listdir(self, root):
+        """
+        Returns the filtered listing of root, or None if it doesn't exist
+        """
+        listing = self._listings.pop(root, None)
+        if listing is None:
+            result = self._scan(root)
+        else:
+            listing.done.wait()
+            if listing.error is not None:
+                raise listing.error
+            result = listing.result
+        if result is None:
+            return None
+
+        dirs, files = result
+        return ([name for name in dirs if not self.skip_dir(os.path.join(root, name))],
+                dict((name, s) for name, s in files if not self.skip_file(os.path.join(root, name))))
+
+    def walk(self, top=''):
+        """
+        Yields (root, dirs, files) for top and every directory below it,
+        depth first with parents before their children. Removing names
+        from dirs skips them, like with os.walk().
+        """
+        todo = [top]
+        while todo:
+            root = todo.pop()
+            listing = self.listdir(root)
+            if listing is None:
+                continue
+            yield (root,) + listing
+            todo.extend(os.path.join(root, name) for name in sorted(listing[0], reverse=True))
+            # the next directories to visit are on top
+            self.prefetch(reversed(todo[-WINDOW:]))
+
+    def close(self):
+        """
+        Stops the threads and drops the listings nobody asked for
+        """
+        while True:
+            try:
+                self._tasks.get_nowait()
+            except Empty:
+                break
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._listings.clear()
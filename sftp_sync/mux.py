@@ -0,0 +1,415 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Connection multiplexing similar to OpenSSH's ControlMaster.
+
+The first invocation starts a detached master process which holds the ssh
+transport and listens on a unix socket. Later invocations against the same
+host talk to the master instead of doing a full handshake. The master exits
+after it was idle for the configured number of seconds.
+
+Every connection to the socket starts with a request line:
+
+sftp
+    the socket is bridged to a new sftp channel
+exec LENGTH
+    followed by LENGTH bytes of the command line. The command is executed
+    and the socket is bridged to its stdin. Output is sent
+    in frames of (kind, length, data), kind being 'o' (stdout), 'e' (stderr)
+    or 'x' (exit status, as decimal string)
+ping
+    answered with "ok"
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import argparse
+import hashlib
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import paramiko
+
+from .sftp import CACHE_DIR, setup_sftp, resolve_host, ask_username, _load_cache, _save_cache
+
+__author__ = 'bluec0re'
+
+log = logging.getLogger(__name__)
+
+FRAME = struct.Struct('!cI')
+# how long to wait for a new master to come up
+STARTUP_TIMEOUT = 30
+BUFSIZE = 32768
+# the package imports this module, so it can't be started with -m
+MASTER_COMMAND = 'import sys; from sftp_sync.mux import main; sys.exit(main(sys.argv[1:]))'
+
+
+def control_path(hostname, port, username):
+    name = '%s@%s:%d' % (username, hostname, port)
+    return os.path.join(CACHE_DIR, 'mux-%s.sock' % hashlib.sha1(name.encode('utf-8')).hexdigest()[:16])
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection to master closed")
+        data += chunk
+    return data
+
+
+def _request(path, line):
+    sock = MuxSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(line.encode('utf-8') + b'\n')
+    return sock
+
+
+def ping(path):
+    try:
+        sock = _request(path, 'ping')
+    except socket.error:
+        return False
+    try:
+        return _recv_exactly(sock, 3) == b'ok\n'
+    except (socket.error, EOFError):
+        return False
+    finally:
+        sock.close()
+
+
+class MuxSocket(socket.socket):
+    """
+    Socket to the master, usable as sock of a paramiko.SFTPClient
+    """
+    transport = None
+
+    def get_transport(self):
+        return self.transport
+
+    def get_name(self):
+        return 'mux'
+
+
+class MuxTransport(object):
+    """
+    The parts of paramiko.Transport used by sftpsync, served by the master
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _request(self, line):
+        sock = _request(self.path, line)
+        sock.transport = self
+        return sock
+
+    def open_sftp_client(self):
+        return paramiko.SFTPClient(self._request('sftp'))
+
+    def open_session(self):
+        return MuxExecChannel(self)
+
+    def is_active(self):
+        return ping(self.path)
+
+
+class _ChannelFile(object):
+    def __init__(self, recv):
+        self.recv = recv
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self.recv(size)
+        data = []
+        while True:
+            chunk = self.recv(BUFSIZE)
+            if not chunk:
+                return b''.join(data)
+            data.append(chunk)
+
+    def close(self):
+        pass
+
+
+class MuxExecChannel(object):
+    """
+    The parts of paramiko.Channel needed to run a remote command
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = None
+        self.exit_status = None
+        self._buffers = {b'o': bytearray(), b'e': bytearray()}
+        self._eof = False
+        self._cond = threading.Condition()
+
+    def exec_command(self, command):
+        command = command.encode('utf-8')
+        self.sock = self.transport._request('exec %d' % len(command))
+        self.sock.sendall(command)
+        thread = threading.Thread(target=self._reader)
+        thread.daemon = True
+        thread.start()
+
+    def _reader(self):
+        try:
+            while True:
+                kind, length = FRAME.unpack(_recv_exactly(self.sock, FRAME.size))
+                data = _recv_exactly(self.sock, length)
+                with self._cond:
+                    if kind == b'x':
+                        self.exit_status = int(data)
+                        break
+                    self._buffers[kind] += data
+                    self._cond.notify_all()
+        except (socket.error, EOFError, struct.error, KeyError, ValueError):
+            if self.exit_status is None:
+                self.exit_status = -1
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def _recv(self, kind, size):
+        with self._cond:
+            buf = self._buffers[kind]
+            while not buf and not self._eof:
+                self._cond.wait()
+            data = bytes(buf[:size])
+            del buf[:size]
+            return data
+
+    def recv(self, size):
+        return self._recv(b'o', size)
+
+    def recv_stderr(self, size):
+        return self._recv(b'e', size)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def makefile(self, *args):
+        return _ChannelFile(self.recv)
+
+    def makefile_stderr(self, *args):
+        return _ChannelFile(self.recv_stderr)
+
+    def exit_status_ready(self):
+        return self._eof
+
+    def recv_exit_status(self):
+        with self._cond:
+            while not self._eof:
+                self._cond.wait()
+        return self.exit_status
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+class MuxClient(object):
+    """
+    Stand-in for paramiko.SSHClient using a master connection. Closing
+    it leaves the master running.
+    """
+    def __init__(self, path):
+        self.transport = MuxTransport(path)
+
+    def get_transport(self):
+        return self.transport
+
+    def open_sftp(self):
+        return self.transport.open_sftp_client()
+
+    def close(self):
+        pass
+
+
+def setup_mux(args, interactive=True):
+    """
+    Returns a MuxClient for args.HOST, starting a master process if there
+    is none. Returns None if no master could be started, False if there is
+    no username.
+    """
+    cache = _load_cache()
+    hostname, port, username, _, _ = resolve_host(args.HOST, cache)
+    username = ask_username(username, interactive)
+    if username is None:
+        return False
+    _save_cache(cache)
+
+    path = control_path(hostname, port, username)
+    if ping(path):
+        log.debug("Using master connection %s", path)
+        return MuxClient(path)
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR, 0o700)
+
+    env = dict(os.environ)
+    pythonpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if env.get('PYTHONPATH'):
+        pythonpath += os.pathsep + env['PYTHONPATH']
+    env['PYTHONPATH'] = pythonpath
+
+    with open(os.devnull, 'r+b') as devnull:
+        with open(path[:-len('.sock')] + '.log', 'ab') as logfile:
+            master = subprocess.Popen([sys.executable, '-c', MASTER_COMMAND,
+                                       args.HOST, username, path, str(args.control_persist)],
+                                      stdin=devnull, stdout=devnull, stderr=logfile,
+                                      close_fds=True, env=env, preexec_fn=os.setsid)
+
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if master.poll() is not None:
+            log.warning("Master connection failed, connecting directly")
+            return None
+        if ping(path):
+            log.info("Started master connection %s", path)
+            return MuxClient(path)
+        time.sleep(0.1)
+    log.warning("Master connection didn't come up, connecting directly")
+    return None
+
+
+class Master(object):
+    def __init__(self, transport, path, ttl):
+        self.transport = transport
+        self.path = path
+        self.ttl = ttl
+        self.active = 0
+        self.last_activity = time.time()
+        self._lock = threading.Lock()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(1)
+
+        try:
+            while self.transport.is_active():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    with self._lock:
+                        idle = self.active == 0 and time.time() - self.last_activity > self.ttl
+                    if idle:
+                        log.info("Idle for %d seconds, exiting", self.ttl)
+                        break
+                    continue
+                conn.settimeout(None)
+                thread = threading.Thread(target=self._handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        with self._lock:
+            self.active += 1
+        try:
+            line = b''
+            while not line.endswith(b'\n'):
+                chunk = conn.recv(1)
+                if not chunk:
+                    return
+                line += chunk
+            request = line[:-1].decode('utf-8')
+
+            if request == 'ping':
+                conn.sendall(b'ok\n')
+            elif request == 'sftp':
+                channel = self.transport.open_session()
+                channel.invoke_subsystem('sftp')
+                self._bridge(conn, channel)
+            elif request.startswith('exec '):
+                command = _recv_exactly(conn, int(request[5:]))
+                channel = self.transport.open_session()
+                channel.exec_command(command)
+                self._bridge(conn, channel, framed=True)
+        except Exception as e:
+            log.error("Request failed: %s", e)
+        finally:
+            conn.close()
+            with self._lock:
+                self.active -= 1
+                self.last_activity = time.time()
+
+    def _bridge(self, conn, channel, framed=False):
+        sockets = [conn, channel]
+        try:
+            while True:
+                readable = select.select(sockets, [], [], 1)[0]
+                if conn in readable:
+                    data = conn.recv(BUFSIZE)
+                    if data:
+                        channel.sendall(data)
+                    elif framed:
+                        channel.shutdown_write()
+                        sockets.remove(conn)
+                    else:
+                        return
+                if framed:
+                    self._send_stderr(conn, channel)
+                if channel in readable:
+                    data = channel.recv(BUFSIZE)
+                    if not data:
+                        break
+                    conn.sendall(FRAME.pack(b'o', len(data)) + data if framed else data)
+
+            if framed:
+                status = str(channel.recv_exit_status()).encode('ascii')
+                self._send_stderr(conn, channel)
+                conn.sendall(FRAME.pack(b'x', len(status)) + status)
+        finally:
+            channel.close()
+
+    def _send_stderr(self, conn, channel):
+        while channel.recv_stderr_ready():
+            data = channel.recv_stderr(BUFSIZE)
+            conn.sendall(FRAME.pack(b'e', len(data)) + data)
+
+
+def run_master(host, username, path, ttl):
+    """
+    Connects to host and serves the connection on the unix socket at path
+    """
+    args = argparse.Namespace(HOST='%s@%s' % (username, host.split('@')[-1]))
+    client = setup_sftp(args, interactive=False)
+    if not client:
+        return 1
+
+    transport = client.get_transport()
+    transport.set_keepalive(30)
+    try:
+        Master(transport, path, int(ttl)).serve()
+    finally:
+        client.close()
+    return 0
+
+
+def main(argv):
+    logging.basicConfig(level='INFO', format='%(asctime)s [%(levelname)s] %(message)s')
+    logging.getLogger('paramiko').setLevel('WARNING')
+    return run_master(*argv)
@@ -0,0 +1,144 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import namedtuple
+import io
+import json
+
+from helperlib.logging import scope_logger
+
+__author__ = 'bluec0re'
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+SYMLINK_LOCAL = 'symlink-local'
+SYMLINK_REMOTE = 'symlink-remote'
+MKDIR_LOCAL = 'mkdir-local'
+MKDIR_REMOTE = 'mkdir-remote'
+DELETE_LOCAL = 'delete-local'
+DELETE_REMOTE = 'delete-remote'
+CONFLICT = 'conflict'
+
+TRANSFERS = (DOWNLOAD, UPLOAD, SYMLINK_LOCAL, SYMLINK_REMOTE)
+
+PLAN_VERSION = 1
+
+Action = namedtuple('Action', ('kind', 'path', 'file', 'reason'))
+
+
+def format_size(size):
+    if size > 1024 ** 3:
+        return "%.2f GiB" % (size / 1024 ** 3,)
+    elif size > 1024 ** 2:
+        return "%.2f MiB" % (size / 1024 ** 2,)
+    elif size > 1024:
+        return "%.2f KiB" % (size / 1024,)
+    return "%d Bytes" % size
+
+
+@scope_logger
+class SyncPlan(object):
+    """
+    Everything a sync run is going to do, computed before anything is
+    touched. Paths are relative to the project root (including the subdir).
+
+    `updates` holds the new revision entries of files which don't need a
+    transfer (e.g. unchanged content with new metadata).
+    """
+    def __init__(self, direction, remote, local, subdir=''):
+        self.direction = direction
+        self.remote = remote
+        self.local = local
+        self.subdir = subdir
+        self.actions = []
+        self.updates = {}
+
+    def add(self, kind, path, file=None, reason=None):
+        self.actions.append(Action(kind, path, file, reason))
+
+    def update(self, path, file):
+        self.updates[path] = file
+
+    def by_kind(self, *kinds):
+        return [action for action in self.actions if action.kind in kinds]
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __len__(self):
+        return len(self.actions)
+
+    @property
+    def conflicts(self):
+        return self.by_kind(CONFLICT)
+
+    @property
+    def download_bytes(self):
+        return sum(action.file.size for action in self.by_kind(DOWNLOAD))
+
+    @property
+    def upload_bytes(self):
+        return sum(action.file.size for action in self.by_kind(UPLOAD))
+
+    def summary(self):
+        counts = {}
+        for action in self.actions:
+            counts[action.kind] = counts.get(action.kind, 0) + 1
+
+        parts = []
+        for kind in (DOWNLOAD, UPLOAD, SYMLINK_LOCAL, SYMLINK_REMOTE, MKDIR_LOCAL,
+                     MKDIR_REMOTE, DELETE_LOCAL, DELETE_REMOTE, CONFLICT):
+            if kind in counts:
+                parts.append("%d %s" % (counts[kind], kind))
+        if not parts:
+            return "Nothing to do"
+        return "%s (%s down, %s up)" % (', '.join(parts),
+                                        format_size(self.download_bytes),
+                                        format_size(self.upload_bytes))
+
+    def describe(self):
+        for action in self.actions:
+            if action.kind == CONFLICT:
+                print("  %-14s %s: %s" % (action.kind, action.path, action.reason))
+            elif action.kind in (DOWNLOAD, UPLOAD):
+                print("  %-14s %s (%s)" % (action.kind, action.path, format_size(action.file.size)))
+            else:
+                print("  %-14s %s" % (action.kind, action.path))
+        print(self.summary())
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'direction': self.direction,
+            'remote': self.remote,
+            'local': self.local,
+            'subdir': self.subdir,
+            'actions': [[action.kind, action.path,
+                         list(action.file) if action.file is not None else None,
+                         action.reason] for action in self.actions],
+            'updates': dict((path, list(f)) for path, f in self.updates.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        from .sync import File
+
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError("Unsupported plan version %r" % data.get('version'))
+
+        plan = cls(data['direction'], data['remote'], data['local'], data['subdir'])
+        for kind, path, f, reason in data['actions']:
+            plan.add(kind, path, File(*f) if f is not None else None, reason)
+        for path, f in data['updates'].items():
+            plan.update(path, File(*f))
+        return plan
+
+    def save(self, fname):
+        with io.open(fname, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(self.to_dict(), ensure_ascii=False))
+        self.log.info('Saved plan with %d actions to %s', len(self), fname)
+
+    @classmethod
+    def load(cls, fname):
+        with io.open(fname, 'r', encoding='utf-8') as fp:
+            return cls.from_dict(json.load(fp))
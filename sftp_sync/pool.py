@@ -0,0 +1,155 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import deque
+import threading
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from helperlib.logging import scope_logger
+
+from .sftp import open_sftp_channel
+
+__author__ = 'bluec0re'
+
+
+@scope_logger
+class ChannelPool(object):
+    """
+    Runs jobs concurrently on several SFTP channels which share the
+    transport of the given client.
+
+    Every job is a callable which gets the SFTP client of the worker as
+    first argument. With a single job the callable is executed directly
+    on the given client, so the pool can be used unconditionally.
+    Worker clients are instrumented with the given Stats.
+    """
+    def __init__(self, sftp, jobs=1, stats=None):
+        self.sftp = sftp
+        self.jobs = max(1, jobs or 1)
+        self.stats = stats
+        self.pending = set()
+        self.started = set()
+        self._lock = threading.Lock()
+        self._tasks = Queue()
+        self._results = Queue()
+        self._done = deque()
+        self._threads = []
+        self._clients = []
+
+    def _start(self):
+        for _ in range(self.jobs):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        sftp = None
+        failure = None
+        try:
+            sftp = open_sftp_channel(self.sftp)
+            if self.stats is not None:
+                self.stats.instrument(sftp)
+            with self._lock:
+                self._clients.append(sftp)
+        except Exception as e:
+            self.log.error("Can't open additional sftp channel: %s", e)
+            failure = e
+
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            key, func, args = task
+            with self._lock:
+                self.started.add(key)
+            try:
+                if failure is not None:
+                    raise failure
+                self._results.put((key, func(sftp, *args), None))
+            except Exception as e:
+                self._results.put((key, None, e))
+
+        if sftp is not None:
+            sftp.close()
+
+    def submit(self, key, func, *args):
+        """
+        Queues `func(sftp, *args)`. The result is reported by
+        `completed()` under the given key.
+        """
+        self.pending.add(key)
+        if self.jobs == 1:
+            self.started.add(key)
+            try:
+                self._done.append((key, func(self.sftp, *args), None))
+            except Exception as e:
+                self._done.append((key, None, e))
+            return
+
+        if not self._threads:
+            self._start()
+        self._tasks.put((key, func, args))
+
+    def completed(self, wait=False):
+        """
+        Yields (key, result, exception) for every finished job.
+        If wait is set, blocks until all queued jobs are done.
+        """
+        while self._done:
+            result = self._done.popleft()
+            self._finish(result[0])
+            yield result
+
+        while self.pending and self._threads:
+            try:
+                result = self._results.get(block=wait)
+            except Empty:
+                return
+            self._finish(result[0])
+            yield result
+
+    def join(self):
+        return self.completed(wait=True)
+
+    def _finish(self, key):
+        self.pending.discard(key)
+        with self._lock:
+            self.started.discard(key)
+
+    def abort(self):
+        """
+        Cancels all outstanding jobs.
+
+        Returns a list of (key, started) tuples for the unfinished jobs.
+        """
+        while True:
+            try:
+                self._tasks.get_nowait()
+            except Empty:
+                break
+
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+        self.close(timeout=5)
+
+        unfinished = [(key, key in self.started) for key in self.pending]
+        self.pending.clear()
+        self.started.clear()
+        self._done.clear()
+        return unfinished
+
+    def close(self, timeout=None):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
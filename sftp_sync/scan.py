@@ -0,0 +1,200 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Lists a whole remote tree with a single command instead of one SFTP
+directory listing per directory. A python helper walks the tree on the
+remote side and streams the entries back.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import json
+import logging
+import os
+import stat
+
+from paramiko.sftp_attr import SFTPAttributes
+
+from .exclude import DEFAULT_RULES
+from .sftp import exec_remote, python_command
+
+__author__ = 'bluec0re'
+
+log = logging.getLogger(__name__)
+
+BUFSIZE = 65536
+
+# fields of the records, all of them are terminated by a NUL byte:
+#   v                                       the helper started
+#   d PATH                                  entries of directory PATH follow
+#   f NAME MODE SIZE MTIME ATIME UID GID TARGET
+#   E PATH MESSAGE                          PATH can't be listed
+#   z EXCLUDED                              end of the listing
+FIELDS = {'v': 0, 'd': 1, 'f': 8, 'E': 2, 'z': 1}
+
+# walks the directories breadth first, so parents come before their
+# children. Excluded entries are left out if the patterns compile here.
+REMOTE_SCRIPT = '''
+import json, os, re, stat, sys
+from collections import deque
+config = json.loads(sys.argv[1])
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+def b(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8', 'replace')
+try:
+    pattern = config['pattern'] is not None and re.compile(config['pattern'])
+    rules = re.compile(config['rules'])
+    prune = True
+except Exception:
+    prune = False
+def skip(path, directory):
+    for p in ([path, path + '/'] if directory else [path]):
+        if pattern and pattern.match(p) or rules.search(p):
+            return True
+    return False
+prefix = config['subdir'] + '/' if config['subdir'] else ''
+top = b(os.path.join(config['root'], config['subdir']))
+excluded = 0
+out.write(b'v\\0')
+queue = deque([b''])
+while queue:
+    rel = queue.popleft()
+    directory = os.path.join(top, rel) if rel else top
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        out.write(b'E\\0' + directory + b'\\0' + b(e.strerror or str(e)) + b'\\0')
+        break
+    out.write(b'd\\0' + rel + b'\\0')
+    for name in names:
+        path = os.path.join(rel, name) if rel else name
+        full = os.path.join(directory, name)
+        try:
+            s = os.lstat(full)
+        except OSError:
+            continue
+        isdir = stat.S_ISDIR(s.st_mode)
+        if prune and skip(prefix + path.decode('utf-8', 'replace'), isdir):
+            excluded += 1
+            continue
+        if isdir:
+            queue.append(path)
+        target = b''
+        if stat.S_ISLNK(s.st_mode):
+            try:
+                target = os.readlink(full)
+            except OSError:
+                pass
+        out.write(b'\\0'.join([b'f', name] + [b(str(int(v))) for v in (
+            s.st_mode, s.st_size, s.st_mtime, s.st_atime, s.st_uid, s.st_gid)] + [target, b'']))
+out.write(b'z\\0' + b(str(excluded)) + b'\\0')
+out.flush()
+'''
+
+
+def _text(data):
+    return data.decode('utf-8')
+
+
+def _records(channel):
+    """
+    Parses the output of the helper into (kind, fields) tuples as it
+    arrives
+    """
+    buf = b''
+    fields = []
+    while True:
+        data = channel.recv(BUFSIZE)
+        if not data:
+            return
+        parts = (buf + data).split(b'\0')
+        buf = parts.pop()
+        for part in parts:
+            fields.append(part)
+            kind = _text(fields[0])
+            if len(fields) > FIELDS.get(kind, 0):
+                yield kind, fields[1:]
+                fields = []
+
+
+def _finish(channel):
+    try:
+        stderr = channel.makefile_stderr('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return status, stderr.decode('utf-8', 'replace').strip()
+
+
+def _attributes(fields):
+    attr = SFTPAttributes()
+    attr.filename = _text(fields[0])
+    attr.st_mode, attr.st_size, attr.st_mtime, attr.st_atime, attr.st_uid, attr.st_gid = \
+        map(int, fields[1:7])
+    attr._flags = attr.FLAG_SIZE | attr.FLAG_UIDGID | attr.FLAG_PERMISSIONS | attr.FLAG_AMTIME
+    # the link target saves a readlink request later
+    attr.target = _text(fields[7]) if stat.S_ISLNK(attr.st_mode) and fields[7] else None
+    return attr
+
+
+def start(sftp, root, subdir, exclude):
+    """
+    Starts listing the tree below root/subdir on the remote side. Raises
+    IOError if the helper can't be started, the tree has to be walked
+    over SFTP then.
+
+    Returns a generator yielding (directory, directories, files) like
+    Sync.walk(), with SFTPAttributes entries. Entries excluded by the
+    ExcludeMatcher exclude are left out and counted as its hits.
+    """
+    pattern = exclude.pattern.pattern if exclude.pattern is not None else None
+    if isinstance(pattern, bytes):
+        pattern = _text(pattern)
+    config = json.dumps({'root': root, 'subdir': subdir, 'pattern': pattern,
+                         'rules': DEFAULT_RULES.pattern})
+    channel = exec_remote(sftp, python_command(REMOTE_SCRIPT, config))
+    try:
+        channel.shutdown_write()
+        records = _records(channel)
+        first = next(records, None)
+    except BaseException:
+        channel.close()
+        raise
+    if first is None or first[0] != 'v':
+        status, stderr = _finish(channel)
+        raise IOError("Remote listing helper failed with status %s: %s" % (status, stderr))
+    return _walk(channel, records, subdir, exclude)
+
+
+def _walk(channel, records, subdir, exclude):
+    directory = None
+    directories = []
+    files = []
+    try:
+        for kind, fields in records:
+            if kind == 'f':
+                f = _attributes(fields)
+                path = os.path.join(subdir, directory, f.filename)
+                # the helper may have been unable to filter
+                if stat.S_ISDIR(f.st_mode):
+                    if not exclude.match_dir(path):
+                        directories.append(f)
+                elif not exclude.match(path):
+                    files.append(f)
+                continue
+
+            if directory is not None:
+                yield directory, directories, files
+                directory = None
+                directories = []
+                files = []
+            if kind == 'd':
+                directory = _text(fields[0])
+            elif kind == 'E':
+                raise IOError("Error during listing of %s: %s" % (_text(fields[0]), _text(fields[1])))
+            elif kind == 'z':
+                exclude.hits += int(fields[0])
+                break
+        else:
+            status, stderr = _finish(channel)
+            raise IOError("Remote listing helper failed with status %s: %s" % (status, stderr))
+    finally:
+        channel.close()
@@ -4,15 +4,42 @@ from binascii import hexlify
 import getpass
 import os
 import paramiko
+from paramiko.sftp import CMD_OPENDIR, CMD_READDIR, CMD_CLOSE, CMD_STATUS, CMD_HANDLE, CMD_NAME, \
+    CMD_LSTAT, CMD_ATTRS, CMD_MKDIR, CMD_READLINK, CMD_REMOVE, CMD_RMDIR, CMD_RENAME, CMD_WRITE, \
+    CMD_READ, CMD_DATA
+try:
+    from paramiko.sftp import int64
+except ImportError:
+    # paramiko < 3
+    from paramiko.py3compat import long as int64
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.common import cMSG_CHANNEL_WINDOW_ADJUST
+import json
 import logging
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 __author__ = 'bluec0re'
 
 
 log = logging.getLogger(__name__)
 
+try:
+    input = raw_input
+except NameError:
+    pass
 
-def connect(hostname, port, username, pkey=None, sock=None):
+CACHE_DIR = os.path.expanduser('~/.cache/sftpsync')
+CONNECTION_CACHE = os.path.join(CACHE_DIR, 'connections.json')
+
+KEY_CLASSES = tuple(getattr(paramiko, name) for name in ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey')
+                    if hasattr(paramiko, name))
+
+
+def connect(hostname, port, username, pkey=None, sock=None, interactive=True):
     """
     Connect to the given host and port, first attempt is by using
     a ssh agent, second attempt is manual auth
@@ -43,10 +70,12 @@ def connect(hostname, port, username, pkey=None, sock=None):
             return False
         except paramiko.PasswordRequiredException as e:
             log.error("Password required for %s@%s", username, hostname)
+            if not interactive:
+                return False
             password = getpass.getpass("Password: ")
             continue
         except paramiko.SSHException as e:
-            if 'not found in known_hosts' in e.message:
+            if 'not found in known_hosts' in str(e):
                 log.critical("Host %s was not found in known_hosts file. Connect via ssh first", hostname)
                 return False
             raise e
@@ -55,59 +84,473 @@ def connect(hostname, port, username, pkey=None, sock=None):
     return client
 
 
-def setup_sftp(args):
+def open_sftp_channel(sftp):
     """
-    Creates a sftp transport
+    Opens an additional sftp session on the transport of the given client
+    """
+    transport = sftp.get_channel().get_transport()
+    return transport.open_sftp_client()
+
+
+# private parts of paramiko RequestPipeline and set_window() build on. They
+# are the same in all versions tested (2.12, 3.4 and 5.0).
+PIPELINE_INTERNALS = ('_async_request', '_read_response', '_convert_status', '_adjust_cwd',
+                      '_expecting')
+WINDOW_INTERNALS = ('in_window_size', 'in_window_threshold', 'remote_chanid', 'lock')
+
+
+def _has(obj, names):
+    return all(hasattr(obj, name) for name in names)
+
+
+def can_pipeline(sftp):
+    """
+    True if requests can be pipelined on the given client. Otherwise
+    RequestPipeline does one request at a time.
+    """
+    return _has(sftp, PIPELINE_INTERNALS)
+
+
+def set_window(sftp, window_size):
+    """
+    Grows the receive window of the channel of the given client to
+    window_size bytes. Channels opened later on the same transport start
+    with it. Does nothing for channels which aren't paramiko's.
+    """
+    channel = sftp.get_channel()
+    if not isinstance(channel, paramiko.Channel):
+        return
+    transport = channel.get_transport()
+    transport.default_window_size = max(transport.default_window_size, window_size)
+
+    if not _has(channel, WINDOW_INTERNALS) or not hasattr(transport, '_send_user_message'):
+        log.debug("Can't grow the window of an open channel with paramiko %s", paramiko.__version__)
+        return
+    grow = window_size - channel.in_window_size
+    if grow <= 0:
+        return
+    m = paramiko.Message()
+    m.add_byte(cMSG_CHANNEL_WINDOW_ADJUST)
+    m.add_int(channel.remote_chanid)
+    m.add_int(grow)
+    with channel.lock:
+        channel.in_window_size = window_size
+        channel.in_window_threshold = window_size // 10
+    transport._send_user_message(m)
+
+
+def exec_remote(sftp, command):
+    """
+    Starts command on the host of the given sftp client. Returns the channel.
+    """
+    transport = sftp.get_channel().get_transport()
+    channel = transport.open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def run_remote(sftp, command, stdin=None):
+    """
+    Runs command on the host of the given sftp client and returns its
+    output. Raises IOError if the command fails.
     """
+    channel = exec_remote(sftp, command)
+
+    def feed():
+        try:
+            if stdin:
+                channel.sendall(stdin)
+        finally:
+            channel.shutdown_write()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        stdout = channel.makefile('rb').read()
+        stderr = channel.makefile_stderr('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        feeder.join()
+        channel.close()
+
+    if status != 0:
+        raise IOError("Remote command failed with status %d: %s" % (
+            status, stderr.decode('utf-8', 'replace').strip()))
+    return stdout
+
+
+def python_command(script, *args):
+    """
+    Shell command running a python script with any remote python interpreter
+    """
+    return '"$(command -v python3 || command -v python)" -c %s %s' % (
+        quote(script), ' '.join(quote(arg) for arg in args))
+
+
+class RequestPipeline(object):
+    """
+    Keeps several sftp requests in flight on a single channel.
+
+    Uses the asynchronous request ids of paramiko's SFTPClient (the same
+    mechanism its prefetching is built on). Responses are dispatched to
+    the callback of the request, either by `wait()` or by any synchronous
+    request done on the client in the meantime.
+
+    If the client lacks them (see `can_pipeline()`), the requests are
+    done one at a time with the public methods of the client and the
+    callbacks are called right away.
+    """
+    def __init__(self, sftp, window=64):
+        self.sftp = sftp
+        self.window = window
+        self.callbacks = {}
+        self.pipelined = can_pipeline(sftp)
+        if not self.pipelined:
+            log.debug("No pipelining with paramiko %s", paramiko.__version__)
+
+    @property
+    def outstanding(self):
+        return len(self.callbacks)
+
+    def _send(self, callback, t, *args):
+        num = self.sftp._async_request(self, t, *args)
+        self.callbacks[num] = callback
+        return num
+
+    def request(self, callback, t, *args):
+        """
+        Sends the request of type t. callback(t, msg) is called with the response.
+        """
+        while self.outstanding >= self.window:
+            self.wait()
+        return self._send(callback, t, *args)
+
+    def _async_response(self, t, msg, num):
+        callback = self.callbacks.pop(num, None)
+        if callback is not None:
+            callback(t, msg)
+
+    def wait(self):
+        """
+        Processes at least one response
+        """
+        if self.callbacks:
+            self.sftp._read_response()
+
+    def flush(self):
+        while self.callbacks:
+            self.sftp._read_response()
+
+    def _call(self, callback, func, *args):
+        """
+        Runs func(*args) and calls callback(result, exception)
+        """
+        try:
+            result = func(*args)
+        except (IOError, EOFError) as e:
+            callback(None, e)
+        else:
+            callback(result, None)
+
+    def status(self, t, msg):
+        """
+        Converts a status response into an exception (or None)
+        """
+        if t != CMD_STATUS:
+            return IOError("Unexpected response type %d" % t)
+        try:
+            self.sftp._convert_status(msg)
+        except (IOError, EOFError) as e:
+            return e
+        return None
+
+    def listdir_attr(self, path, callback):
+        """
+        Lists the given directory. callback(path, entries, exception) is
+        called once the listing is complete.
+        """
+        if not self.pipelined:
+            self._call(lambda entries, e: callback(path, entries, e), self.sftp.listdir_attr, path)
+            return
+        entries = []
 
-    # get hostname
+        def on_handle(t, msg):
+            if t != CMD_HANDLE:
+                callback(path, None, self.status(t, msg) or IOError("Expected handle"))
+                return
+            handle = msg.get_binary()
+            self._send(lambda t, msg: on_names(handle, t, msg), CMD_READDIR, handle)
+
+        def on_names(handle, t, msg):
+            if t == CMD_NAME:
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attr = SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        entries.append(attr)
+                self._send(lambda t, msg: on_names(handle, t, msg), CMD_READDIR, handle)
+                return
+
+            self._send(None, CMD_CLOSE, handle)
+            e = self.status(t, msg)
+            if isinstance(e, EOFError):
+                callback(path, entries, None)
+            else:
+                callback(path, None, e or IOError("Expected name response"))
+
+        self.request(on_handle, CMD_OPENDIR, self.sftp._adjust_cwd(path))
+
+    def lstat(self, path, callback):
+        """
+        callback(path, attributes, exception) is called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda attr, e: callback(path, attr, e), self.sftp.lstat, path)
+            return
+
+        def on_attrs(t, msg):
+            if t == CMD_ATTRS:
+                callback(path, SFTPAttributes._from_msg(msg), None)
+            else:
+                callback(path, None, self.status(t, msg) or IOError("Expected attributes"))
+
+        self.request(on_attrs, CMD_LSTAT, self.sftp._adjust_cwd(path))
+
+    def readlink(self, path, callback):
+        """
+        callback(path, target, exception) is called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda target, e: callback(path, target, e), self.sftp.readlink, path)
+            return
+
+        def on_name(t, msg):
+            if t == CMD_NAME and msg.get_int() == 1:
+                callback(path, msg.get_text(), None)
+            else:
+                callback(path, None, self.status(t, msg) or IOError("Expected link target"))
+
+        self.request(on_name, CMD_READLINK, self.sftp._adjust_cwd(path))
+
+    def mkdir(self, path, callback, mode=0o777):
+        """
+        callback(path, exception) is called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda _, e: callback(path, e), self.sftp.mkdir, path, mode)
+            return
+        attr = SFTPAttributes()
+        attr.st_mode = mode
+        self.request(lambda t, msg: callback(path, self.status(t, msg)),
+                     CMD_MKDIR, self.sftp._adjust_cwd(path), attr)
+
+    def read(self, fp, offset, length, callback):
+        """
+        Reads up to length bytes at offset of the open SFTPFile fp.
+        callback(offset, data, exception) is called with the result, data
+        is empty at the end of the file.
+        """
+        if not self.pipelined:
+            def read():
+                fp.seek(offset)
+                return fp.read(length)
+            self._call(lambda data, e: callback(offset, data, e), read)
+            return
+
+        def on_data(t, msg):
+            if t == CMD_DATA:
+                callback(offset, msg.get_string(), None)
+                return
+            e = self.status(t, msg)
+            if isinstance(e, EOFError):
+                callback(offset, b'', None)
+            else:
+                callback(offset, None, e or IOError("Expected data"))
+
+        self.request(on_data, CMD_READ, fp.handle, int64(offset), int(length))
+
+    def write(self, fp, offset, data, callback):
+        """
+        Writes data at offset of the open SFTPFile fp. callback(offset,
+        exception) is called with the result
+        """
+        if not self.pipelined:
+            def write():
+                fp.seek(offset)
+                fp.write(data)
+                fp.flush()
+            self._call(lambda _, e: callback(offset, e), write)
+            return
+        self.request(lambda t, msg: callback(offset, self.status(t, msg)),
+                     CMD_WRITE, fp.handle, int64(offset), data)
+
+    def remove(self, path, callback):
+        """
+        Deletes the file path. callback(path, exception) is called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda _, e: callback(path, e), self.sftp.remove, path)
+            return
+        self.request(lambda t, msg: callback(path, self.status(t, msg)),
+                     CMD_REMOVE, self.sftp._adjust_cwd(path))
+
+    def rmdir(self, path, callback):
+        """
+        Deletes the empty directory path. callback(path, exception) is
+        called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda _, e: callback(path, e), self.sftp.rmdir, path)
+            return
+        self.request(lambda t, msg: callback(path, self.status(t, msg)),
+                     CMD_RMDIR, self.sftp._adjust_cwd(path))
+
+    def rename(self, path, target, callback):
+        """
+        Moves path to target, which must not exist. callback(path,
+        exception) is called with the result
+        """
+        if not self.pipelined:
+            self._call(lambda _, e: callback(path, e), self.sftp.rename, path, target)
+            return
+        self.request(lambda t, msg: callback(path, self.status(t, msg)),
+                     CMD_RENAME, self.sftp._adjust_cwd(path), self.sftp._adjust_cwd(target))
+
+
+def _load_cache():
+    try:
+        with open(CONNECTION_CACHE) as fp:
+            cache = json.load(fp)
+    except (IOError, ValueError):
+        cache = {}
+    cache.setdefault('hosts', {})
+    cache.setdefault('keys', {})
+    return cache
+
+
+def _save_cache(cache):
+    tmp = CONNECTION_CACHE + '.tmp'
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, 0o700)
+        with open(tmp, 'w') as fp:
+            json.dump(cache, fp)
+        os.rename(tmp, CONNECTION_CACHE)
+    except (IOError, OSError) as e:
+        log.warning("Can't write connection cache %s: %s", CONNECTION_CACHE, e)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def resolve_host(host, cache):
+    """
+    Splits [user@]host[:port] and applies ~/.ssh/config. The resolved
+    config entry is cached until the config file changes.
+
+    Returns (hostname, port, username, identityfiles, proxycommand)
+    """
     username = None
     port = None
-    pkey = None
-    sock = None
-    hostname = args.HOST
+    hostname = host
     if hostname.find('@') >= 0:
         username, hostname = hostname.split('@')
     if hostname.find(':') >= 0:
         hostname, portstr = hostname.split(':')
         port = int(portstr)
 
-    if os.path.exists(os.path.expanduser('~/.ssh/config')):
-        with open(os.path.expanduser('~/.ssh/config')) as fp:
-            config = paramiko.SSHConfig()
-            config.parse(fp)
-
-            entry = config.lookup(hostname)
-            if entry:
-                if not port:
-                   port = entry.get('port', 22)
-                hostname = entry.get('hostname', hostname)
-                if username is None:
-                    username = entry.get('user')
-                pkeys = entry.get('identityfile')
-                if pkeys:
-                    for pk in pkeys:
-                        pkey = None
-                        for cls in (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.DSSKey):
-                            try:
-                                pkey = cls.from_private_key_file(pk)
-                            except paramiko.PasswordRequiredException:
-                                log.error("Password required for key %s", pk)
-                                pkey = cls.from_private_key_file(pk, getpass.getpass("Key Password: "))
-                            except (paramiko.SSHException, IOError):
-                                log.warning("Can't read pkey %s as %s", pk, cls.__name__)
-                                continue
-                            break
-                        if isinstance(pkey, paramiko.PKey):
-                            break
-                sock = entry.get('proxycommand')
-
-    # get username
+    config_file = os.path.expanduser('~/.ssh/config')
+    config_mtime = _mtime(config_file)
+    entry = cache['hosts'].get(hostname)
+    if entry is None or entry.get('config_mtime') != config_mtime:
+        entry = {'config_mtime': config_mtime}
+        if config_mtime is not None:
+            with open(config_file) as fp:
+                config = paramiko.SSHConfig()
+                config.parse(fp)
+
+                found = config.lookup(hostname)
+                for key in ('hostname', 'port', 'user', 'identityfile', 'proxycommand'):
+                    entry[key] = found.get(key)
+        cache['hosts'][hostname] = entry
+
+    if not port:
+        port = int(entry.get('port') or 22)
+    hostname = entry.get('hostname') or hostname
     if username is None:
+        username = entry.get('user')
+    return hostname, port, username, entry.get('identityfile') or [], entry.get('proxycommand')
+
+
+def ask_username(username, interactive=True):
+    """
+    Asks for the username if the host didn't specify one. Returns None if
+    there is none and asking isn't allowed.
+    """
+    if username is None:
+        if not interactive:
+            log.error("No username given, use user@host or set User in ~/.ssh/config")
+            return None
         default_username = getpass.getuser()
-        username = raw_input('Username [%s]: ' % default_username)
+        username = input('Username [%s]: ' % default_username)
         if len(username) == 0:
             username = default_username
+    return username
+
+
+def load_identity(pkeys, cache, interactive=True):
+    """
+    Loads the first usable private key. The key type of every identity
+    file is cached, so the right class is tried first next time.
+    """
+    for pk in pkeys:
+        mtime = _mtime(pk)
+        if mtime is None:
+            continue
+
+        classes = list(KEY_CLASSES)
+        known = cache['keys'].get(pk)
+        if known and known.get('mtime') == mtime:
+            classes.sort(key=lambda cls: cls.__name__ != known.get('type'))
+
+        for cls in classes:
+            try:
+                pkey = cls.from_private_key_file(pk)
+            except paramiko.PasswordRequiredException:
+                if not interactive:
+                    log.warning("Password required for key %s", pk)
+                    break
+                log.error("Password required for key %s", pk)
+                pkey = cls.from_private_key_file(pk, getpass.getpass("Key Password: "))
+            except (paramiko.SSHException, IOError, ValueError):
+                log.warning("Can't read pkey %s as %s", pk, cls.__name__)
+                continue
+            cache['keys'][pk] = {'type': cls.__name__, 'mtime': mtime}
+            return pkey
+    return None
+
+
+def setup_sftp(args, interactive=True):
+    """
+    Creates a sftp transport
+    """
+    cache = _load_cache()
+    hostname, port, username, pkeys, proxycommand = resolve_host(args.HOST, cache)
+    username = ask_username(username, interactive)
+    if username is None:
+        return False
+    pkey = load_identity(pkeys, cache, interactive)
+    _save_cache(cache)
+
+    sock = None
+    if proxycommand:
+        sock = paramiko.ProxyCommand(proxycommand)
 
-    client = connect(hostname, port, username, pkey, sock)
+    client = connect(hostname, port, username, pkey, sock, interactive)
     return client
@@ -0,0 +1,175 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import json
+import threading
+import time
+
+from paramiko.sftp import CMD_NAMES
+
+from .plan import format_size
+
+__author__ = 'bluec0re'
+
+
+class Stats(object):
+    """
+    Timers and counters of a sync run.
+
+    Phases are timed separately and don't overlap, time spent in a phase
+    by several threads adds up. Requests and bytes are counted on every
+    sftp client passed to `instrument()`.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.network_wait = 0.0
+        self.compression = {'files': 0, 'bytes': 0, 'sent': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed(self, phase, iterable):
+        """
+        Iterates over iterable, accounting the time spent in it to phase
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, time.time() - start)
+            yield item
+
+    def add_compression(self, size, sent, seconds):
+        """
+        Accounts a compressed transfer of size bytes, which took sent bytes
+        on the wire
+        """
+        with self._lock:
+            self.compression['files'] += 1
+            self.compression['bytes'] += size
+            self.compression['sent'] += sent
+            self.compression['seconds'] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def instrument(self, sftp):
+        """
+        Counts the requests, bytes and time spent waiting for responses of
+        the given SFTPClient. Instrumenting a client again only switches
+        it to this instance.
+        """
+        if getattr(sftp, '_stats', None) is None:
+            _wrap(sftp)
+        sftp._stats = self
+        return sftp
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'seconds': time.time() - self.started,
+                'phases': dict(self.phases),
+                'counters': dict(self.counters),
+                'requests': dict(self.requests),
+                'total_requests': sum(self.requests.values()),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'network_wait': self.network_wait,
+                'compression': dict(self.compression),
+            }
+
+    def report(self):
+        data = self.to_dict()
+        print()
+        print("Statistics (%.3fs total)" % data['seconds'])
+        print("  Phases:")
+        for phase, seconds in data['phases'].items():
+            print("    %-16s %9.3fs" % (phase, seconds))
+        print("  Counters:")
+        for name, value in data['counters'].items():
+            print("    %-16s %9d" % (name, value))
+        print("  Requests: %d (%s)" % (
+            data['total_requests'],
+            ', '.join('%s %d' % item for item in sorted(data['requests'].items(),
+                                                       key=lambda item: -item[1]))))
+        print("  Network: %s sent, %s received, %.3fs waiting for responses" % (
+            format_size(data['bytes_sent']), format_size(data['bytes_received']),
+            data['network_wait']))
+        compression = data['compression']
+        if compression['files']:
+            seconds = compression['seconds'] or 1e-9
+            print("  Compression: %d files, %s -> %s (%.1f%%), %s/s effective, %s/s on the wire" % (
+                compression['files'], format_size(compression['bytes']),
+                format_size(compression['sent']),
+                compression['sent'] * 100 / (compression['bytes'] or 1),
+                format_size(compression['bytes'] / seconds), format_size(compression['sent'] / seconds)))
+
+    def save(self, fname):
+        with io.open(fname, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(self.to_dict(), ensure_ascii=False, sort_keys=True))
+
+
+def _wrap(sftp):
+    """
+    Wraps the request, response and socket methods of sftp. Methods a
+    paramiko version lacks aren't counted.
+    """
+    async_request = getattr(sftp, '_async_request', None)
+    read_response = getattr(sftp, '_read_response', None)
+    read_all = getattr(sftp, '_read_all', None)
+    write_all = getattr(sftp, '_write_all', None)
+
+    def _async_request(fileobj, t, *args):
+        stats = sftp._stats
+        name = CMD_NAMES.get(t, str(t))
+        with stats._lock:
+            stats.requests[name] = stats.requests.get(name, 0) + 1
+        return async_request(fileobj, t, *args)
+
+    def _read_response(*args, **kwargs):
+        start = time.time()
+        try:
+            return read_response(*args, **kwargs)
+        finally:
+            stats = sftp._stats
+            with stats._lock:
+                stats.network_wait += time.time() - start
+
+    def _read_all(n):
+        data = read_all(n)
+        with sftp._stats._lock:
+            sftp._stats.bytes_received += len(data)
+        return data
+
+    def _write_all(out):
+        with sftp._stats._lock:
+            sftp._stats.bytes_sent += len(out)
+        return write_all(out)
+
+    for original, wrapper in ((async_request, _async_request), (read_response, _read_response),
+                              (read_all, _read_all), (write_all, _write_all)):
+        if original is not None:
+            setattr(sftp, wrapper.__name__, wrapper)
@@ -1,7 +1,11 @@
 # vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+from bisect import bisect_left
 from datetime import timedelta
+import errno
+import heapq
+import shutil
 import sys
 import os
 import stat
@@ -11,18 +15,42 @@ try:
 except ImportError:
     from ConfigParser import ConfigParser
 
-from collections import namedtuple
+from collections import namedtuple, deque
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 from helperlib import prompt, info, success, error, warning, spinner
 from helperlib.logging import scope_logger
 
 import paramiko
 import re
 
+from .plan import format_size, SyncPlan, DOWNLOAD, UPLOAD, SYMLINK_LOCAL, SYMLINK_REMOTE, \
+    MKDIR_LOCAL, MKDIR_REMOTE, DELETE_LOCAL, DELETE_REMOTE, CONFLICT, TRANSFERS
+from .pool import ChannelPool
+from . import transfer, delta, checksum, bundle, compress, scan, database, delete
+from .checksum import HashCache
+from .entries import EntryTable
+from .transfer import Streaming
+from . import watch as watcher
+from .sftp import RequestPipeline, set_window
+from .exclude import ExcludeMatcher
+from .local import LocalScanner
+from .stats import Stats
+
 __author__ = 'bluec0re'
 
 MTIME = 0
 SIZE = 1
 MODE = 2
+HASH = 3
+TARGET = 4
+
+# bookkeeping files in the local root, never synced
+METADATA_FILES = ('.files', '.files.journal', '.files.journal.tmp', '.files.tmp', '.files.index',
+                  '.files.index.tmp', '.files.columns', '.files.columns.tmp', '.files.hashes', '.files.hashes.tmp', '.files.migrated',
+                  '.files.db', '.files.db-wal', '.files.db-shm', '.files.db-journal')
 
 DEFAULT_CONFIG = {
     'general': {
@@ -31,7 +59,8 @@ DEFAULT_CONFIG = {
     #'<project name>': { }
 }
 
-File = namedtuple('File', ('mtime', 'size', 'mode'))
+File = namedtuple('File', ('mtime', 'size', 'mode', 'hash', 'target'))
+File.__new__.__defaults__ = (None, None)
 
 
 def to_unicode(s):
@@ -81,13 +110,24 @@ def different(sftp, filename, other, current, local, remote):
         print("    Mode: %o vs %o" % (other[MODE], current[MODE]))
         return True
     elif stat.S_ISLNK(other[MODE]):  # symlink
-        rtarget = sftp.readlink(os.path.join(remote, filename))
-        ltarget = os.readlink(os.path.join(local, filename))
-        if ltarget != rtarget:
+        if other[TARGET] is not None and current[TARGET] is not None:
+            otarget, ctarget = other[TARGET], current[TARGET]
+        else:
+            otarget = os.readlink(os.path.join(local, filename))
+            ctarget = sftp.readlink(os.path.join(remote, filename))
+        if otarget != ctarget:
             print()
             success("Differences in %s" % filename)
             print("         dst vs src")
-            print("    Target: %s vs %s" % (ltarget, rtarget))
+            print("    Target: %s vs %s" % (otarget, ctarget))
+            return True
+
+    elif other[HASH] is not None and current[HASH] is not None:
+        if other[HASH] != current[HASH]:
+            print()
+            success("Differences in %s" % filename)
+            print("         dst vs src")
+            print("    Hash: %s vs %s" % (other[HASH], current[HASH]))
             return True
 
     elif (other[MTIME] < current[MTIME] or
@@ -101,46 +141,463 @@ def different(sftp, filename, other, current, local, remote):
     return False
 
 
+def _below(filename, paths):
+    """
+    True if filename or one of its parent directories is in paths
+    """
+    while filename:
+        if filename in paths:
+            return True
+        filename = os.path.dirname(filename)
+    return False
+
+
+def _parents(paths):
+    """
+    The directories containing paths and their parents, without the root
+    """
+    dirs = set()
+    for path in paths:
+        path = os.path.dirname(path)
+        while path and path not in dirs:
+            dirs.add(path)
+            path = os.path.dirname(path)
+    return dirs
+
+
+def _same(a, b):
+    """
+    True if the Files a and b have the same content
+    """
+    if stat.S_IFMT(a.mode) != stat.S_IFMT(b.mode):
+        return False
+    if stat.S_ISLNK(a.mode):
+        return a.target == b.target
+    if a.hash is not None and b.hash is not None:
+        return a.hash == b.hash
+    return (a.mtime, a.size) == (b.mtime, b.size)
+
+
+def _decode_line(line):
+    line = line[:-1]
+    try:
+        return line.decode('utf-8')
+    except UnicodeError:
+        return to_unicode(line)
+
+
+def _read_lines(fp):
+    """
+    Yields the decoded lines of a revision or journal file one by one. The
+    last line is dropped if it isn't terminated (torn write).
+    """
+    for line in fp:
+        if not line.endswith(b'\n'):
+            return
+        yield _decode_line(line)
+
+
+def _copy(src, dst, size):
+    """
+    Copies size bytes from src to dst
+    """
+    while size > 0:
+        data = src.read(min(size, 1024 * 1024))
+        if not data:
+            break
+        dst.write(data)
+        size -= len(data)
+
+
+def _parse_entry(parts):
+    """
+    (filename, mtime, size, mode, hash, target) from the fields of a
+    revision file line. Old revision files have no mode.
+    """
+    n = len(parts)
+    return (parts[0], int(parts[1]), int(parts[2]), int(parts[3]) if n > 3 else -1,
+            parts[4] or None if n > 4 else None, parts[5] or None if n > 5 else None)
+
+
+def _format_entry(data):
+    parts = ['%d' % value for value in data[:HASH]]
+    parts.extend('' if value is None else value for value in data[HASH:])
+    while parts[-1] == '':
+        parts.pop()
+    return parts
+
+
+def _format_line(*parts):
+    line = '\t'.join(parts) + '\n'
+    try:
+        return line.encode('utf-8')
+    except UnicodeDecodeError:
+        return line
+
+
 @scope_logger
-class RevisionFile(dict):
-    def __init__(self, fname):
-        super(RevisionFile, self).__init__()
+class RevisionFile(MutableMapping):
+    """
+    Stores the last synced state of every file.
+
+    The state is kept in a base file (fname) plus an append-only journal
+    (fname + '.journal'). Changes done through `record()` and `forget()`
+    are appended to the journal immediately, so finished transfers survive
+    a crash. `save()` writes a new base file and empties the journal.
+
+    The entries are kept in an EntryTable, grouped by directory, and are
+    returned as File tuples. `fname + '.columns'` holds a snapshot of the
+    table next to the base file, so loading all entries doesn't parse it.
+
+    The base file is sorted by filename, so every subtree is a contiguous
+    range of it. `fname + '.index'` holds the offset of every
+    INDEX_INTERVAL-th entry. If scope is set, only the entries below that
+    directory are loaded and saving only rewrites their range.
+    """
+    COMPACT_MIN = 10000
+    INDEX_INTERVAL = 1024
+
+    def __init__(self, fname, scope=None):
         self.fname = fname
+        self.scope = (scope or '').rstrip('/') or None
+        self._entries = EntryTable()
+        self._journal_fp = None
+        self._journal_entries = 0
+        # (stamp, start, end) of the scope in the base file, if it's sorted
+        self._span = None
 
-    def add(self, fn, *args):
-        args = [int(arg) for arg in args[:3]]
-        if len(args) < 3:
-            args.append(-1)
+    @property
+    def journal(self):
+        return self.fname + '.journal'
+
+    @property
+    def offsets(self):
+        return self.fname + '.index'
+
+    @property
+    def columns(self):
+        return self.fname + '.columns'
+
+    def in_scope(self, fn):
+        return self.scope is None or fn.startswith(self.scope + '/')
+
+    def __getitem__(self, fn):
+        data = self._entries.get(fn)
+        if data is None:
+            raise KeyError(fn)
+        return File(*data)
+
+    def get(self, fn, default=None):
+        data = self._entries.get(fn)
+        return default if data is None else File(*data)
+
+    def __contains__(self, fn):
+        return fn in self._entries
+
+    def __setitem__(self, fn, data):
+        self._entries.set(fn, *data)
+
+    def __delitem__(self, fn):
+        if not self._entries.remove(fn):
+            raise KeyError(fn)
 
-        self[fn] = File(*args)
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def add(self, fn, *args):
+        """
+        Sets the entry for fn from the fields of a revision file line
+        """
+        self._entries.set(*_parse_entry((fn,) + args))
+
+    def listdir(self, directory):
+        """
+        Filenames of the entries directly in the (root relative) directory
+        """
+        return self._entries.listdir(directory)
+
+    def directories(self):
+        """
+        Directories which directly contain entries
+        """
+        return self._entries.directories()
+
+    def subtree(self, path):
+        """
+        Filenames of the entry path and of the entries below the (root
+        relative) directory path
+        """
+        return self._entries.subtree(path)
+
+    def _stamp(self):
+        s = os.stat(self.fname)
+        return '%d\t%r' % (s.st_size, s.st_mtime)
+
+    def _read_offsets(self):
+        """
+        Returns the (filename, offset) pairs of the index, or None if
+        there is none or it doesn't belong to the current base file
+        """
+        try:
+            with open(self.offsets, "rb") as fp:
+                lines = _read_lines(fp)
+                if next(lines, None) != self._stamp():
+                    return None
+                offsets = []
+                for line in lines:
+                    fn, offset = line.rsplit("\t", 1)
+                    offsets.append((fn, int(offset)))
+                return offsets
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_offsets(self, offsets):
+        tmp = self.offsets + '.tmp'
+        with open(tmp, "wb") as fp:
+            fp.write(_format_line(self._stamp()))
+            for fn, offset in offsets:
+                fp.write(_format_line(fn, '%d' % offset))
+        os.rename(tmp, self.offsets)
+
+    def _read_columns(self):
+        """
+        Loads the snapshot of the entries. Returns False if there is none
+        or it doesn't belong to the current base file.
+        """
+        try:
+            with open(self.columns, "rb") as fp:
+                stamp = fp.readline()
+                if not stamp.endswith(b'\n') or _decode_line(stamp) != self._stamp():
+                    return False
+                self._entries.load(fp.read())
+            return True
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                self.log.warning('Ignoring revision snapshot %s: %s', self.columns, e)
+            return False
+
+    def _write_columns(self):
+        tmp = self.columns + '.tmp'
+        with open(tmp, "wb") as fp:
+            fp.write(_format_line(self._stamp()))
+            fp.write(self._entries.dump())
+        os.rename(tmp, self.columns)
+
+    def _drop_columns(self):
+        if os.path.exists(self.columns):
+            os.unlink(self.columns)
+
+    def _subtree(self, fp, offsets):
+        """
+        Yields the lines of the scope from the sorted base file and sets
+        `_span` to their byte range
+        """
+        lower, upper = self.scope + '/', self.scope + '0'
+        i = bisect_left([fn for fn, _ in offsets], lower)
+        fp.seek(offsets[i - 1][1] if i else 0)
+        start = None
+        while True:
+            offset = fp.tell()
+            line = fp.readline()
+            if not line.endswith(b'\n'):
+                break
+            line = _decode_line(line)
+            fn = line.split("\t", 1)[0]
+            if fn >= upper:
+                break
+            if fn >= lower:
+                if start is None:
+                    start = offset
+                yield line
+        self._span = (self._stamp(), offset if start is None else start, offset)
 
     def load(self):
-        if not os.path.exists(self.fname):
+        self.close()
+        self.clear()
+        self._span = None
+        if os.path.exists(self.fname) and self.scope is None and self._read_columns():
+            self.log.info('Loaded %d files from %s', len(self), self.columns)
+        elif os.path.exists(self.fname):
+            with open(self.fname, "rb") as fp:
+                offsets = self._read_offsets() if self.scope is not None else None
+                lines = self._subtree(fp, offsets) if offsets is not None else _read_lines(fp)
+                entries = (_parse_entry(line.split("\t")) for line in lines)
+                if self.scope is not None and offsets is None:
+                    entries = (entry for entry in entries if self.in_scope(entry[0]))
+                self._entries.update(entries)
+            if self.scope is not None:
+                self.log.info('Loaded %d files below %s from %s', len(self), self.scope, self.fname)
+            else:
+                self.log.info('Loaded %d files from %s', len(self), self.fname)
+        else:
             self.log.warning('Revisionfile %s does not exist', self.fname)
-            return
 
-        with open(self.fname, "r") as fp:
-            for line in fp:
-                parts = to_unicode(line.strip()).split("\t")
-                fn = parts[0]
-                self.add(fn, *parts[1:])
-        self.log.info('Loaded %d files from %s', len(self), self.fname)
+        self._journal_entries = 0
+        if os.path.exists(self.journal):
+            with open(self.journal, "rb") as fp:
+                for line in _read_lines(fp):
+                    parts = line.split("\t")
+                    try:
+                        if len(parts) > 1 and not self.in_scope(parts[1]):
+                            continue
+                        if parts[0] == '+' and len(parts) >= 5:
+                            self.add(parts[1], *parts[2:])
+                        elif parts[0] == '-' and len(parts) == 2:
+                            self._entries.remove(parts[1])
+                        else:
+                            raise ValueError(line)
+                    except ValueError:
+                        self.log.warning('Ignoring broken journal entry %r', line)
+                        continue
+                    self._journal_entries += 1
+            self.log.info('Replayed %d changes from %s', self._journal_entries, self.journal)
+
+    def _append(self, line):
+        if self._journal_fp is None:
+            self._journal_fp = open(self.journal, "ab")
+        self._journal_fp.write(line)
+        self._journal_fp.flush()
+        self._journal_entries += 1
+        if self._journal_entries > max(self.COMPACT_MIN, len(self) // 4):
+            self.save()
+
+    def record(self, fn, data):
+        """
+        Sets the entry for fn and journals the change
+        """
+        self[fn] = data
+        self._append(_format_line('+', fn, *_format_entry(data)))
+
+    def forget(self, fn):
+        """
+        Removes the entry for fn and journals the change
+        """
+        self._entries.remove(fn)
+        self._append(_format_line('-', fn))
+
+    def close(self):
+        if self._journal_fp is not None:
+            self._journal_fp.close()
+            self._journal_fp = None
+
+    def commit(self):
+        """
+        Finishes a run. The journal is only compacted if it grew large.
+        """
+        if self._journal_entries > max(self.COMPACT_MIN, len(self) // 4) or \
+                not os.path.exists(self.fname):
+            self.save()
+        else:
+            self.close()
+
+    def _write_entries(self, fp, offset, offsets):
+        """
+        Writes the entries sorted to fp, starting at offset. Adds their
+        index entries to offsets and returns the offset after them.
+        """
+        for i, fn in enumerate(sorted(self)):
+            if i % self.INDEX_INTERVAL == 0:
+                offsets.append((fn, offset))
+            line = _format_line(fn, *_format_entry(self[fn]))
+            fp.write(line)
+            offset += len(line)
+        return offset
 
     def save(self):
-        with open(self.fname, "w") as fp:
-            for f, data in self.iteritems():
-                line = ("%s\t%d\t%d\t%d\n" % (
-                    f,
-                    data[MTIME],
-                    data[SIZE],
-                    data[MODE]))
-                try:
-                    line = line.encode('utf-8')
-                except UnicodeDecodeError:
-                    pass
-                fp.write(line)
+        if self.scope is not None:
+            self._save_scope()
+        else:
+            offsets = []
+            tmp = self.fname + '.tmp'
+            with open(tmp, "wb") as fp:
+                self._write_entries(fp, 0, offsets)
+            os.rename(tmp, self.fname)
+            self._write_offsets(offsets)
+            self._write_columns()
+
+            self.close()
+            if os.path.exists(self.journal):
+                os.unlink(self.journal)
+        self._journal_entries = 0
         self.log.info('Saved %d files to %s', len(self), self.fname)
 
+    def _save_scope(self):
+        """
+        Replaces the range of the scope in the base file. The rest is
+        copied without parsing it.
+        """
+        offsets = None
+        if self._span is not None and os.path.exists(self.fname) and self._span[0] == self._stamp():
+            offsets = self._read_offsets()
+        if offsets is None:
+            # unsorted, unindexed or changed since loading
+            self._merge_into_base()
+            return
+
+        _, start, end = self._span
+        new_offsets = [(fn, offset) for fn, offset in offsets if offset < start]
+        tmp = self.fname + '.tmp'
+        with open(self.fname, "rb") as src:
+            with open(tmp, "wb") as dst:
+                _copy(src, dst, start)
+                stop = self._write_entries(dst, start, new_offsets)
+                src.seek(end)
+                shutil.copyfileobj(src, dst)
+        new_offsets.extend((fn, offset + stop - end) for fn, offset in offsets if offset >= end)
+        os.rename(tmp, self.fname)
+        self._write_offsets(new_offsets)
+        # only holds the scope, the next full save writes a new one
+        self._drop_columns()
+        self._span = (self._stamp(), start, stop)
+        self._drop_journal()
+
+    def _merge_into_base(self):
+        """
+        Saves the scope by loading, updating and saving the whole revision
+        file. Only needed once, the base file is sorted and indexed after.
+        """
+        self.close()
+        base = RevisionFile(self.fname)
+        base.load()
+        for fn in [fn for fn in base if self.in_scope(fn)]:
+            del base[fn]
+        base.update(self)
+        base.save()
+        del base
+
+        with open(self.fname, "rb") as fp:
+            for _ in self._subtree(fp, self._read_offsets()):
+                pass
+
+    def _drop_journal(self):
+        """
+        Removes the journal entries of the scope, they are part of the
+        base file now
+        """
+        self.close()
+        if not os.path.exists(self.journal):
+            return
+        kept = 0
+        tmp = self.journal + '.tmp'
+        with open(self.journal, "rb") as src:
+            with open(tmp, "wb") as dst:
+                for line in _read_lines(src):
+                    parts = line.split("\t")
+                    if len(parts) > 1 and not self.in_scope(parts[1]):
+                        dst.write(_format_line(line))
+                        kept += 1
+        if kept:
+            os.rename(tmp, self.journal)
+        else:
+            os.unlink(tmp)
+            os.unlink(self.journal)
+
 
 @scope_logger
 class SettingsFile(ConfigParser):
@@ -170,6 +627,14 @@ class SettingsFile(ConfigParser):
             self.write(fp)
 
 
+# revision stores selectable with the revision_store setting
+REVISION_STORES = {
+    'file': lambda root, scope: RevisionFile(os.path.join(root, '.files'), scope),
+    'sqlite': lambda root, scope: database.RevisionDatabase(os.path.join(root, '.files.db'), scope,
+                                                            os.path.join(root, '.files')),
+}
+
+
 def load_rev_file(fname):
     files = RevisionFile(fname)
     files.load()
@@ -190,8 +655,13 @@ def save_rev_file(fname, files):
 class Sync(object):
     def __init__(self, sftp, remote, local,
                  exclude=None, skip_on_error=False,
-                 subdir=None, dry_run=False):
+                 subdir=None, dry_run=False, jobs=1, delta_threshold=None,
+                 checksum=False, stats=None, streaming=None, bundle_threshold=None,
+                 compression=False, remote_scan=False, delete_policy=None, batch=False):
         self.sftp = sftp
+        self.stats = stats or Stats()
+        if sftp is not None:
+            self.stats.instrument(sftp)
         self.subdir = to_unicode(subdir or '')
         self.remote_root = remote
         self.local_root = to_unicode(local)
@@ -200,14 +670,36 @@ class Sync(object):
         self.exclude = exclude
         self.skip_on_error = skip_on_error
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.walk_window = 64
+        self.remote_dirs = set([''])
+        # uploads which were retried after recreating their directory
+        self.retried = set()
+        self.delta_threshold = delta_threshold
+        self.bundle_threshold = bundle_threshold
+        self.compression = compression
+        self.remote_scan = remote_scan
+        self.bytes_saved = 0
+        self.checksum = checksum
+        self.batch = batch
 
-        fname = os.path.join(self.local_root, '.files')
-        self.revision_file = RevisionFile(fname)
-        self.revision_file.load()
         fname = os.path.join(self.local_root, '.sftpsync')
         name = os.path.basename(self.local_root)
         self.settings = SettingsFile(fname, name)
         self.settings.load()
+        self.delete_policy = delete.resolve(delete_policy, self._setting, batch)
+
+        self.revision_store = self._setting('revision_store') or 'file'
+        if self.revision_store not in REVISION_STORES:
+            raise ValueError("Unknown revision store %s, use one of %s" % (
+                self.revision_store, ', '.join(sorted(REVISION_STORES))))
+        self.revision_file = self._open_revisions()
+        self.revision_file.load()
+        self.hash_cache = HashCache(os.path.join(self.local_root, '.files.hashes'), self.subdir)
+        if checksum:
+            self.hash_cache.load()
+        self.scanner = LocalScanner(self.local_root, self._exclude_dir, self._exclude_local,
+                                    self._int_setting('scan_workers'))
 
         extra_pattern = None
         if self.settings.has_option('general', 'exclude'):
@@ -223,207 +715,461 @@ class Sync(object):
         if hasattr(orig, 'pattern'):
             orig = orig.pattern
 
+        pattern = orig
         if extra_pattern:
             self.log.warning("Loaded exclude pattern %s from settings file", extra_pattern)
             if orig:
-                self.exclude = '(%s)|(%s)' % (orig, extra_pattern)
+                pattern = '(%s)|(%s)' % (orig, extra_pattern)
             else:
-                self.exclude = extra_pattern
-
-        if not hasattr(self.exclude, 'pattern'):
-            self.exclude = re.compile(str(self.exclude))
+                pattern = extra_pattern
+
+        # files moved to the trash are never synced back
+        trash = '%s/' % re.escape(self.delete_policy.trash_dir)
+        pattern = '(%s)|(%s)' % (pattern, trash) if pattern else trash
+        self.exclude = ExcludeMatcher(pattern)
+
+        # command line values win over the settings file, the rest is
+        # derived from the round trip time before the first transfer
+        streaming = streaming or Streaming()
+        self.streaming = Streaming(*[value if value is not None else self._int_setting(option)
+                                     for option, value in zip(Streaming._fields, streaming)])
+        self._tuned = False
+
+    def _setting(self, option):
+        for section in (self.settings.name, 'general'):
+            if self.settings.has_option(section, option):
+                return self.settings.get(section, option)
+        return None
+
+    def _int_setting(self, option):
+        value = self._setting(option)
+        return int(value) if value is not None else None
+
+    def _open_revisions(self):
+        """
+        Creates the (not loaded) revision store chosen in the settings,
+        scoped to the subdir
+        """
+        return REVISION_STORES[self.revision_store](self.local_root, self.subdir)
+
+    def _tune(self):
+        """
+        Chooses the streaming parameters and grows the channel window
+        """
+        if self._tuned:
+            return
+        self._tuned = True
+        rtt = 0
+        if None in self.streaming:
+            with self.stats.phase('tuning'):
+                rtt = transfer.measure_rtt(self.sftp, self.remote_root)
+        self.streaming = transfer.tune(rtt, self.streaming)
+        self.log.info("Round trip time %.1fms: %d byte requests, %d in flight, %s window",
+                      rtt * 1000, self.streaming.chunk_size, self.streaming.max_requests,
+                      format_size(self.streaming.window_size))
+        set_window(self.sftp, self.streaming.window_size)
 
     def build_rev_file(self):
         if not os.path.lexists(self.local_root):
             os.mkdir(self.local_root)
 
         if self.revision_file:
+            if self.batch:
+                error("Revision data already exists, not overriding it in batch mode\n")
+                return False
             c = prompt("File already exists. Override?[y/n]").lower()
             if c != 'y':
                 return False
 
-        remote_files = {}
-        local_files = {}
-        spinner.waitfor('Searching remote')
-        for root, dirs, files in self.walk():
-            for f in files:
-                filename = os.path.join(root, f.filename)
-                if self._exclude(filename):
+        revision_file = self._open_revisions()
+        revision_file.clear()
+        links = []
+        spinner.waitfor('Searching')
+        for root, remote, local in self._walk_both():
+            if not remote or not local:
+                continue
+            for name, f in remote.items():
+                if name not in local:
                     continue
-
-                remote_files[filename] = File(
-                    int(f.st_mtime),
-                    int(f.st_size),
-                    int(f.st_mode)
-                )
-
-                spinner.status(string_shortener(filename))
-        spinner.succeeded()
-
-        spinner.waitfor('Searching local')
-        for root, dirs, files in os.walk(self.local.encode('utf-8')):
-            root = to_unicode(root)
-            relroot = os.path.relpath(root, self.local)
-            for f in files:
-                f = to_unicode(f)
-                filename = os.path.join(relroot, f)
-                s = os.lstat(os.path.join(root, f))
-                local_files[filename] = File(
-                    int(s.st_mtime),
-                    int(s.st_size),
-                    int(s.st_mode)
-                )
+                filename = os.path.join(root, name)
                 spinner.status(string_shortener(filename))
+                rf = File(int(f.st_mtime), int(f.st_size), int(f.st_mode),
+                          target=getattr(f, 'target', None))
+                if stat.S_ISLNK(rf.mode) and rf.target is None:
+                    links.append((filename, rf))
+                else:
+                    revision_file[filename] = rf
         spinner.succeeded()
 
-        files = dict([(k, v) for k, v in remote_files.iteritems() if k in local_files])
-        self.revision_file = RevisionFile(os.path.join(self.local_root, '.files'))
-        self.revision_file.update(files)
-        self.revision_file.save()
+        revision_file.update(self._read_links(links))
+        self.revision_file = revision_file
+        with self.stats.phase('revision save'):
+            self.revision_file.save()
 
     def _exclude(self, path):
-        if self.exclude:
-            self.log.debug("Testing for exclusion: %s (%s)", path, self.exclude.pattern)
-            if self.exclude.match(path):
-                self.log.debug("Excluded by regex: %s", path)
-                return True
-
-        basename = os.path.basename(path)
-        if path[-1] == '~' or path.endswith('.swp') or path.endswith('.swo') \
-                or basename.startswith('.~') or basename.startswith("~$") \
-                or basename.endswith('.pyc') or basename.endswith('.pyo') \
-                or '__pycache__' in path:
-            self.log.debug("Excluded by default: %s", basename)
-            return True
-
-        return False
-
-    def check_dir(self, path):
-        if self._exclude(path):
-            return
+        return self.exclude.match(path)
+
+    def _exclude_dir(self, path):
+        return self.exclude.match_dir(path)
+
+    def _exclude_local(self, path):
+        return os.path.basename(path) in METADATA_FILES or self._exclude(path)
+
+    def _revision_dirs(self):
+        """
+        Directories containing files of the revision file. They existed
+        on the remote side after the last sync.
+        """
+        dirs = set([''])
+        for path in self.revision_file.directories():
+            while path not in dirs:
+                dirs.add(path)
+                path = os.path.dirname(path)
+        return dirs
+
+    def missing_dirs(self, paths):
+        """
+        Returns the (root relative) directories of paths and their parents
+        which don't exist on the remote side yet, parents first.
+
+        Directories in `remote_dirs` are known to exist, all others are
+        checked with pipelined lstat requests.
+        """
+        known = self.remote_dirs
+        todo = set()
+        for path in paths:
+            while path not in known and path not in todo:
+                todo.add(path)
+                path = os.path.dirname(path)
+
+        missing = []
+
+        def checked(path, attr, e):
+            if e is None:
+                known.add(path)
+            else:
+                missing.append(path)
 
-        current_path = self.remote
-        for segment in path.split('/'):
-            current_path = os.path.join(current_path, segment)
-            s = None
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        with self.stats.phase('remote checks'):
             try:
-                s = self.sftp.lstat(current_path)
-            except KeyboardInterrupt:
-                raise
-            except:
-                pass
+                for path in todo:
+                    pipeline.lstat(os.path.join(self.remote_root, path),
+                                   lambda _, attr, e, path=path: checked(path, attr, e))
+            finally:
+                pipeline.flush()
+        return sorted(missing, key=lambda path: (path.count('/'), path))
+
+    def remote_lstat(self, filenames):
+        """
+        Returns a dict of (root relative) filename -> remote attributes for
+        the given files, using pipelined lstat requests. Files which can't
+        be stat'ed are left out.
+        """
+        result = {}
+
+        def checked(filename, attr, e):
+            if e is None:
+                result[filename] = attr
+
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        with self.stats.phase('remote checks'):
+            try:
+                for filename in filenames:
+                    pipeline.lstat(os.path.join(self.remote_root, filename),
+                                   lambda _, attr, e, filename=filename: checked(filename, attr, e))
+            finally:
+                pipeline.flush()
+        return result
+
+    def _mkdir_remote(self, paths, retry=True):
+        """
+        Creates the given (root relative) directories. Requests for
+        directories of the same depth are pipelined.
+
+        Parents in `remote_dirs` are assumed to exist. If one of them is
+        gone, it is created as well and the directories are retried once.
+        """
+        errors = []
+
+        def created(path, e):
+            if e is None:
+                self.remote_dirs.add(path)
+            else:
+                errors.append((path, e))
 
-            if not s and not self._exclude(current_path):
-                print("  Creating directory %s" % current_path)
-                if not self.dry_run:
-                    self.sftp.mkdir(current_path)
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        depth = None
+        with self.stats.phase('mkdir'):
+            try:
+                for path in sorted(paths, key=lambda path: (path.count('/'), path)):
+                    if depth is not None and path.count('/') != depth:
+                        # parents have to exist before their children are created
+                        pipeline.flush()
+                        if errors:
+                            break
+                    depth = path.count('/')
+                    rpath = os.path.join(self.remote_root, path)
+                    print("  Creating directory %s" % rpath)
+                    pipeline.mkdir(rpath, lambda _, e, path=path: created(path, e))
+            finally:
+                pipeline.flush()
+
+        if errors and retry and all(getattr(e, 'errno', None) == errno.ENOENT for _, e in errors):
+            for path, _ in errors:
+                self._forget_dirs(os.path.dirname(path))
+            self._mkdir_remote(self.missing_dirs(paths), retry=False)
+        elif errors:
+            path, e = errors[0]
+            raise IOError("Can't create directory %s: %s" % (os.path.join(self.remote_root, path), e))
+
+    def _forget_dirs(self, path):
+        """
+        Drops the (root relative) directory path and its parents from
+        `remote_dirs` after it turned out to be gone
+        """
+        while path:
+            self.remote_dirs.discard(path)
+            path = os.path.dirname(path)
 
     def walk(self):
-        directory_stack = [self.remote]
-        while directory_stack:
-            directory = directory_stack.pop()
-            if self._exclude(os.path.relpath(directory, self.remote)):
-                continue
+        """
+        Walks the remote tree. Parent directories are always yielded before
+        their children. Excluded entries are left out and excluded
+        directories aren't listed at all.
+
+        With remote_scan the tree is listed by a helper on the remote side
+        in one go, falling back to SFTP listings if it can't be started.
+        """
+        if self.subdir and self.exclude.excluded(self.subdir):
+            return
 
+        if self.remote_scan:
             try:
-                entries = self.sftp.listdir_attr(directory)
-            except Exception as e:
-                if sys.version_info.major >= 3 and False:
-                    #raise IOError("Error during listing of %s" % directory) from e
-                    pass
-                else:
-                    raise IOError("Error during listing of %s: %s" % (directory, str(e)))
-            files = []
-            directories = []
-            for entry in entries:
-                if self._exclude(os.path.relpath(os.path.join(directory, entry.filename), self.remote)):
-                    continue
-
-                if stat.S_IFMT(entry.st_mode) == stat.S_IFDIR:
-                    directories.append(entry)
-                else:
-                    files.append(entry)
+                entries = scan.start(self.sftp, self.remote_root, self.subdir, self.exclude)
+            except (IOError, EOFError, paramiko.SSHException) as e:
+                self.log.warning("Remote listing failed (%s), listing over SFTP", e)
+                self.remote_scan = False
+            else:
+                for entry in entries:
+                    yield entry
+                return
+
+        for entry in self._walk_sftp():
+            yield entry
+
+    def _walk_sftp(self):
+        """
+        Walks the remote tree with SFTP listings. Directory listings are
+        pipelined, so several directories are listed at once, but never
+        far ahead of the consumer.
+        """
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        listings = deque()
+        pending = deque([self.remote])
+
+        def listed(directory, entries, e):
+            listings.append((directory, entries, e))
 
-            relative_dir = os.path.relpath(directory, self.remote)
+        try:
+            while pending or listings or pipeline.outstanding:
+                # finished listings are bounded like the requests in flight
+                while pending and pipeline.outstanding < self.walk_window and \
+                        len(listings) < self.walk_window:
+                    pipeline.listdir_attr(pending.popleft(), listed)
+                if not listings:
+                    pipeline.wait()
+                    continue
 
-            segments = relative_dir.split(os.path.sep, 1)
-            if segments[0] == os.path.curdir:
-                if len(segments) > 1:
-                    relative_dir = segments[1]
-                else:
-                    relative_dir = ''
+                directory, entries, e = listings.popleft()
+                if e is not None:
+                    raise IOError("Error during listing of %s: %s" % (directory, str(e)))
 
-            yield relative_dir, directories, files
+                files = []
+                directories = []
+                for entry in entries:
+                    path = os.path.relpath(os.path.join(directory, entry.filename), self.remote_root)
+                    if stat.S_IFMT(entry.st_mode) == stat.S_IFDIR:
+                        if self._exclude_dir(path):
+                            continue
+                        directories.append(entry)
+                        pending.append(os.path.join(directory, entry.filename))
+                    elif not self._exclude(path):
+                        files.append(entry)
+
+                relative_dir = os.path.relpath(directory, self.remote)
+
+                segments = relative_dir.split(os.path.sep, 1)
+                if segments[0] == os.path.curdir:
+                    if len(segments) > 1:
+                        relative_dir = segments[1]
+                    else:
+                        relative_dir = ''
+
+                yield relative_dir, directories, files
+        finally:
+            # don't leave responses for a stopped walk on the channel
+            pipeline.flush()
+
+    def walk_local(self, top=None):
+        """
+        Walks the local tree, or the tree below the (root relative)
+        directory top. Yields (root, dirs, files) like os.walk() with
+        root relative to the local root and files as dict of name ->
+        lstat result. Symlinks to directories are files, like on the
+        remote side. Excluded entries and our metadata files are left out
+        and excluded directories aren't entered.
+        """
+        if self.subdir and self.exclude.excluded(self.subdir):
+            return
 
-            for current_dir in directories:
-                directory_stack.append(os.path.join(directory, current_dir.filename))
+        try:
+            for entry in self.scanner.walk(self.subdir if top is None else top):
+                yield entry
+        finally:
+            self.scanner.close()
+
+    def _list_local(self, root):
+        """
+        Lists the (root relative) local directory root, leaving out what
+        walk_local() leaves out. Returns a list of directory names and a
+        dict of file names -> lstat result, or None if root doesn't exist.
+        """
+        return self.scanner.listdir(root)
+
+    def _local_tree(self, top):
+        """
+        Yields (root, dirs, files) of the local tree below the (root
+        relative) directory top, as returned by _list_local()
+        """
+        entries = self.scanner.walk(top)
+        while True:
+            with self.stats.phase('local walk'):
+                entry = next(entries, None)
+            if entry is None:
+                return
+            yield entry
+
+    def _walk_both(self):
+        """
+        Walks the remote and the local tree side by side. Yields (root,
+        remote, local) for every directory which exists on either side or
+        still has revision entries. remote and local are dicts of file
+        name -> SFTPAttributes / lstat result, or None if the directory
+        doesn't exist on that side. Only the current directory is kept in
+        memory.
+        """
+        visited = set()
+        try:
+            for root, dirs, files in self.stats.timed('remote walk', self.walk()):
+                if self.subdir:
+                    root = os.path.join(self.subdir, root) if root else self.subdir
+                visited.add(root)
+                with self.stats.phase('local walk'):
+                    listing = self._list_local(root)
+                ldirs, lfiles = listing if listing is not None else ([], None)
+                rdirs = set(d.filename for d in dirs)
+                # the remote walk visits them later
+                self.scanner.prefetch(os.path.join(root, name) for name in ldirs if name in rdirs)
+                yield root, dict((f.filename, f) for f in files), lfiles
+
+                # trees which only exist locally
+                for name in sorted(ldirs):
+                    if name in rdirs:
+                        continue
+                    for lroot, _, lfiles in self._local_tree(os.path.join(root, name)):
+                        visited.add(lroot)
+                        yield lroot, None, lfiles
+        finally:
+            self.scanner.close()
+
+        for directory in self._unvisited(visited):
+            yield directory, None, None
+
+    def _unvisited(self, visited):
+        """
+        Directories of revision entries which weren't visited by a walk,
+        i.e. which are gone
+        """
+        for directory in self.revision_file.directories():
+            if directory in visited or self.exclude.excluded(directory):
+                continue
+            if self.subdir and not _below(directory, [self.subdir]):
+                continue
+            yield directory
+
+    def _missing(self, root, names):
+        """
+        Revision entries of the (root relative) directory root which aren't
+        in names and aren't excluded
+        """
+        return [filename for filename in self.revision_file.listdir(root)
+                if os.path.basename(filename) not in names and not self.exclude.excluded(filename)]
+
+    def ignored(self, path):
+        """
+        True if the (root relative) path is never synced
+        """
+        return os.path.basename(path) in METADATA_FILES or self.exclude.excluded(path)
+
+    def _walk_paths(self, paths):
+        """
+        Like walk_local(), but only yields the given (root relative) paths
+        and the trees below the directories among them. Paths outside of
+        the subdir, excluded ones and ones which don't exist are left out.
+        """
+        for path in sorted(paths):
+            if self.subdir and path != self.subdir and not path.startswith(self.subdir + '/'):
+                continue
+            if self.ignored(path):
+                continue
+            lpath = os.path.join(self.local_root, path)
+            try:
+                s = os.lstat(lpath)
+            except OSError:
+                continue
+            if stat.S_ISDIR(s.st_mode):
+                for entry in self.walk_local(path):
+                    yield entry
+            else:
+                yield os.path.dirname(path), [], {os.path.basename(path): s}
 
     def check_revision_against_remote(self):
-        for root, dirs, files in self.walk():
+        remote_files = []
+        for root, dirs, files in self.stats.timed('remote walk', self.walk()):
             if self.subdir:
                 root = os.path.join(self.subdir, root)
 
             for f in files:
                 filename = os.path.join(root, f.filename)
+                remote_files.append((filename, self._remote_entry(filename, f)))
+
+        seen = set()
+        for filename, rdata in self._read_links(remote_files):
+            seen.add(filename)
+            if filename not in self.revision_file:
+                error("File only on remote")
+                print_file_info2(filename, rdata)
+            else:
+                different(self.sftp, filename, rdata, self.revision_file[filename],
+                          self.local_root, self.remote_root)
 
-                rdata = File(
-                    int(f.st_mtime),
-                    int(f.st_size),
-                    int(f.st_mode)
-                )
-
-                if filename not in self.revision_file:
-                    error("File only on remote")
-                    print_file_info2(filename, rdata)
-                elif different(self.sftp, filename, rdata, self.revision_file[filename],
-                               self.local_root, self.remote_root):
-                    del self.revision_file[filename]
-                else:
-                    del self.revision_file[filename]
-
+        # the revision store is left untouched, a database would keep the deletes
         for filename, ldata in self.revision_file.items():
-            error("File only in revision file\n")
-            print_file_info2(filename, ldata)
+            if filename not in seen:
+                error("File only in revision file\n")
+                print_file_info2(filename, ldata)
 
     def list_local_changes(self):
-        local_files = {}
-        for root, dirs, files in os.walk(self.local.encode('utf-8')):
-            root = to_unicode(root)
-            if self._exclude(root):
-                continue
-
-            if self.subdir:
-                root = os.path.join(root, self.subdir)
-
-            for d in dirs:
-                d = to_unicode(d)
-                path = os.path.join(root, d)
-                if self._exclude(path):
-                    continue
-
-            for f in files:
-                f = to_unicode(f)
-                if f in ('.files',):
-                    continue
-
-                lfile = os.path.join(root, f)
-                filename = os.path.relpath(lfile, self.local_root)
-                if filename.split(os.path.sep)[0] == os.path.curdir:
-                    filename = filename[2:]
-
-                if self._exclude(lfile):
-                    continue
-
-                s = os.lstat(lfile)
+        for root, dirs, files in self.stats.timed('local walk', self.walk_local()):
+            for f, s in files.items():
+                filename = os.path.join(root, f)
                 sys.stdout.flush()
-                local_files[filename] = File(int(s.st_mtime),
-                                             int(s.st_size),
-                                             int(s.st_mode))
+                lf = self._local_entry(filename, s)
 
                 if filename not in self.revision_file:
                     print("New: {}".format(filename))
                 else:
-                    lf = local_files[filename]
                     rf = self.revision_file[filename]
                     if different(self.sftp, filename, rf, lf, self.local_root, self.remote_root):
                         print("Changed: {}".format(filename))
@@ -447,305 +1193,1002 @@ class Sync(object):
                 return False
         return True
 
-    def down(self):
+    def _check_local_hash(self, lfile, lfilename, rfile, rfilename):
+        """
+        Content based variant of _check_local()
+        """
+        if not os.path.lexists(lfilename):
+            return True
+
+        lhash = self.hash_cache.get(lfilename)
+        if lhash == rfile.hash:
+            print()
+            success("Already downloaded (same content)\n")
+            return False
+        if lfile is not None and lfile.hash is None:
+            # no hash from the last sync to compare with
+            return self._check_local(lfile, lfilename, rfile, rfilename)
+        if lfile is None or lhash != lfile.hash:
+            raise ValueError("Conflict with file %s (Both modified (different content))" % rfilename)
+        return True
+
+    def _entry(self, filename, mtime, size, mode):
+        """
+        Revision entry for the current state of filename. Data cached in
+        the revision file (the hash or the symlink target) is kept if the
+        metadata didn't change.
+        """
+        f = File(int(mtime), int(size), int(mode))
+        old = self.revision_file.get(filename)
+        if old is not None and old[:HASH] == f[:HASH]:
+            return old
+        return f
+
+    def _local_entry(self, filename, s):
+        lf = self._entry(filename, s.st_mtime, s.st_size, s.st_mode)
+        if stat.S_ISLNK(lf.mode) and lf.target is None:
+            lf = lf._replace(target=to_unicode(os.readlink(os.path.join(self.local_root, filename))))
+        return lf
+
+    def _remote_entry(self, filename, f):
+        rf = self._entry(filename, f.st_mtime, f.st_size, f.st_mode)
+        # listings of the remote helper come with link targets
+        target = getattr(f, 'target', None)
+        if target is not None and rf.target is None:
+            rf = rf._replace(target=target)
+        return rf
+
+    def _read_links(self, items):
+        """
+        Fills in the targets of remote symlinks. items are tuples starting
+        with the filename and its File. The targets of entries without one
+        are read with pipelined readlink requests.
+        """
+        targets = {}
+
+        def read(filename, target, e):
+            if e is None:
+                targets[filename] = target
+            else:
+                self.log.warning("Can't read link %s: %s", filename, e)
+
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        with self.stats.phase('readlink'):
+            try:
+                for item in items:
+                    filename, f = item[:2]
+                    if stat.S_ISLNK(f.mode) and f.target is None:
+                        pipeline.readlink(os.path.join(self.remote_root, filename),
+                                          lambda _, target, e, filename=filename: read(filename, target, e))
+            finally:
+                pipeline.flush()
+
+        return [(item[0], item[1]._replace(target=targets[item[0]])) + tuple(item[2:])
+                if item[0] in targets else item for item in items]
+
+    def _changed(self, filename, new, f):
+        """
+        Tests filename against the revision file. f is the stat result of the
+        source side.
+        """
+        self.stats.count('examined')
+        if filename not in self.revision_file:
+            print_file_info(filename, f)
+            return True
+        with self.stats.phase('compare'):
+            return different(self.sftp, filename, self.revision_file[filename], new,
+                             self.local_root, self.remote_root)
+
+    def _plan_download(self, plan, filename, rfile, changed):
+        download = changed
+        if download:
+            lfilename = os.path.join(self.local_root, filename)
+            try:
+                if rfile.hash is not None:
+                    download = self._check_local_hash(self.revision_file.get(filename), lfilename,
+                                                      rfile, filename)
+                else:
+                    download = self._check_local(self.revision_file.get(filename), lfilename,
+                                                 rfile, filename)
+            except ValueError as e:
+                self.stats.count('conflicts')
+                plan.add(CONFLICT, filename, rfile, str(e))
+                return
+
+        if download:
+            if stat.S_ISLNK(rfile.mode):
+                plan.add(SYMLINK_LOCAL, filename, rfile)
+            else:
+                plan.add(DOWNLOAD, filename, rfile)
+        else:
+            self.stats.count('unchanged')
+            if self.revision_file.get(filename) != rfile:
+                plan.update(filename, rfile)
+
+    def _plan_upload(self, plan, filename, lf, changed, rhash=None, rstat=None):
+        if changed and rhash is not None and rhash == lf.hash:
+            success("Already uploaded (same content)\n")
+            changed = False
+
+        if not changed:
+            self.stats.count('unchanged')
+            if self.revision_file.get(filename) != lf:
+                plan.update(filename, lf)
+            return
+
+        if rstat is not None and rstat.st_mtime > lf.mtime:
+            self.stats.count('conflicts')
+            plan.add(CONFLICT, filename, lf,
+                     "Conflict with file %s (remote file is newer)" % filename)
+            return
+
+        if stat.S_ISLNK(lf.mode):
+            plan.add(SYMLINK_REMOTE, filename, lf)
+        else:
+            plan.add(UPLOAD, filename, lf)
+
+    def plan_down(self):
+        """
+        Compares the remote tree against the revision file and the local
+        files. Returns a SyncPlan which brings the local side up to date.
+        """
         if not os.path.lexists(self.local_root):
             os.mkdir(self.local_root)
 
         self.revision_file.load()
         revision_file = self.revision_file
-        remote_files = {}
+        plan = SyncPlan('down', self.remote_root, self.local_root, self.subdir)
+        visited = set()
+        checks = []
+        links = []
 
         spinner.waitfor('Testing')
-        for root, dirs, files in self.walk():
+        for root, dirs, files in self.stats.timed('remote walk', self.walk()):
             lroot = os.path.join(self.local, root)
-            if self._exclude(lroot):
-                sys.stdout.write("\r[\033[33m#\033[0m] Skipping {0}".format(lroot))
-                continue
-
-            if not os.path.lexists(lroot) and not self.dry_run:
-                os.mkdir(lroot)
-
             if self.subdir:
-                root = os.path.join(self.subdir, root)
+                root = os.path.join(self.subdir, root) if root else self.subdir
+            visited.add(root)
+
+            if not os.path.lexists(lroot):
+                plan.add(MKDIR_LOCAL, root)
 
             for f in files:
                 filename = os.path.join(root, f.filename)
-
-                if self._exclude(filename):
-                    continue
-
                 spinner.status(string_shortener(filename))
 
-                remote_files[filename] = File(
-                    int(f.st_mtime),
-                    int(f.st_size),
-                    int(f.st_mode)
-                )
+                rfile = self._remote_entry(filename, f)
 
-                if filename not in revision_file:
-                    print_file_info(filename, f)
-                    download = True
+                # unchanged metadata keeps the hash of the revision file
+                if self.checksum and stat.S_ISREG(rfile.mode) and rfile.hash is None:
+                    checks.append((filename, rfile, f))
+                elif stat.S_ISLNK(rfile.mode) and rfile.target is None:
+                    links.append((filename, rfile, f))
                 else:
-                    lfile = revision_file[filename]
-                    rfile = remote_files[filename]
-                    download = different(self.sftp, filename, lfile, rfile,
-                                         self.local_root, self.remote_root)
+                    self._plan_download(plan, filename, rfile, self._changed(filename, rfile, f))
 
-                if download:
-                    spinner.succeeded()
-                    info("Downloading: %s\n" % filename)
-                    mtime = remote_files[filename][0]
-                    lfilename = os.path.join(self.local_root, filename)
+            for filename in self._missing(root, set(f.filename for f in files)):
+                plan.add(DELETE_LOCAL, filename, revision_file[filename])
+        spinner.succeeded()
 
-                    try:
+        for filename, rfile, f in self._read_links(links):
+            self._plan_download(plan, filename, rfile, self._changed(filename, rfile, f))
+
+        if checks:
+            spinner.waitfor('Hashing')
+            with self.stats.phase('hashing'):
+                hashes = checksum.remote_hashes(self.sftp, self.remote_root,
+                                                [filename for filename, _, _ in checks])
+                self.hash_cache.hash_files([os.path.join(self.local_root, filename)
+                                            for filename, _, _ in checks])
+            spinner.succeeded()
+            for filename, rfile, f in checks:
+                rfile = rfile._replace(hash=hashes.get(filename))
+                self._plan_download(plan, filename, rfile, self._changed(filename, rfile, f))
+
+        for directory in self._unvisited(visited):
+            for filename in self._missing(directory, ()):
+                plan.add(DELETE_LOCAL, filename, revision_file[filename])
+
+        return plan
+
+    def plan_up(self, paths=None):
+        """
+        Compares the local tree against the revision file and the remote
+        files. Returns a SyncPlan which brings the remote side up to date.
+
+        If paths (root relative) are given, only they and the trees below
+        the directories among them are compared. The remote directories
+        known from the last full comparison are reused then.
+        """
+        self.sftp.lstat(self.remote)
 
-                        if not self._check_local(revision_file.get(filename), lfilename,
-                                                 remote_files[filename], filename):
-                            spinner.waitfor('Testing')
-                            continue
-                        start = time.time()
-
-                        def status(total, size):
-                            if size == 0:
-                                return
-
-                            speed = total / (time.time() - start) * 1.0
-                            if speed > 1024 ** 2:
-                                speed = "%.2f MiByte/s" % (speed / 1024 ** 2,)
-                            elif speed > 1024:
-                                speed = "%.2f KiByte/s" % (speed / 1024,)
-                            else:
-                                speed = "%f Byte/s" % speed
-
-                            sys.stdout.write("\r%02d%% %d/%d %s" % (
-                                total * 100 / size, total, size, speed))
-                            sys.stdout.flush()
-
-                        if not self.dry_run:
-                            rfilename = os.path.join(self.remote_root, filename)
-                            if stat.S_ISLNK(f.st_mode):
-                                target = self.sftp.readlink(rfilename)
-                                info("Creating local symlink %s -> %s\n" % (lfilename, target))
-                                try:
-                                    os.symlink(target, lfilename)
-                                except OSError as e:
-                                    error("Failed: %s\n" % (e,))
-                            else:
-                                self.sftp.get(rfilename, lfilename, status)
-                                os.utime(lfilename, (mtime, mtime))
-                        spinner.waitfor('Testing')
-                    except ValueError:
-                        del remote_files[filename]
-                        revision_file.update(remote_files)
-                        if not self.dry_run:
-                            revision_file.save()
-                        raise
-                    except KeyboardInterrupt:
-                        del remote_files[filename]
-                        revision_file.update(remote_files)
-                        if not self.dry_run:
-                            os.unlink(lfile)
-                            revision_file.save()
-                        exit(1)
-                    except Exception as e:
-                        del remote_files[filename]
-                        if not self.dry_run and filename not in revision_file:
-                            try:
-                                os.unlink(lfile)
-                            except:
-                                pass
-                        if not self.skip_on_error:
-                            revision_file.update(remote_files)
-                            if not self.dry_run:
-                                revision_file.save()
-                            raise
-                        else:
-                            if filename in revision_file:  # prevent deletion
-                                remote_files[filename] = revision_file[filename]
-                            error("Error during downloading %s: %s\n" % (filename, str(e)))
-        spinner.succeeded()
+        plan = SyncPlan('up', self.remote_root, self.local_root, self.subdir)
+        # a full walk finds deleted files per directory, paths are few
+        seen = None
+        if paths is not None:
+            paths = set(paths)
+            seen = set()
+        visited = set()
+        local_dirs = []
+        checks = []
+        uploads = []
+        if paths is None:
+            self.remote_dirs = self._revision_dirs()
 
-        for filename in revision_file.keys():
-            if self.subdir:
-                if not filename.startswith(self.subdir):
-                    continue
-            if filename not in remote_files and not self._exclude(filename):
-                warning("Deleted file: %s\n" % filename)
-                print(" Last mod time: %d\n Size: %d\n Mode: %o" % revision_file[filename])
-                if not self.dry_run:
-                    if not os.path.lexists(os.path.join(self.local_root, filename)):
-                        warning("Already deleted?\n")
-                        del revision_file[filename]
+        spinner.waitfor('Testing')
+        entries = self.walk_local() if paths is None else self._walk_paths(paths)
+        for root, dirs, files in self.stats.timed('local walk', entries):
+            if root and root not in self.remote_dirs:
+                local_dirs.append(root)
+
+            for f, s in files.items():
+                filename = os.path.join(root, f)
+                if seen is not None:
+                    if filename in seen:
                         continue
+                    seen.add(filename)
+                spinner.status(string_shortener(filename))
 
-                    answer = prompt("Delete it locally?[y/n]")
-                    if answer == 'y':
-                        os.unlink(os.path.join(self.local_root, filename))
-                        del revision_file[filename]
+                lf = self._local_entry(filename, s)
 
-        revision_file.update(remote_files)
+                # unchanged metadata keeps the hash of the revision file
+                if self.checksum and stat.S_ISREG(lf.mode) and lf.hash is None:
+                    checks.append((filename, lf, s))
+                    continue
+                changed = self._changed(filename, lf, s)
+                if changed:
+                    uploads.append((filename, lf, changed, None))
+                else:
+                    self._plan_upload(plan, filename, lf, changed)
 
-        if not self.dry_run:
-            revision_file.save()
+            if seen is None:
+                visited.add(root)
+                for filename in self._missing(root, set(files)):
+                    plan.add(DELETE_REMOTE, filename, self.revision_file[filename])
+        spinner.succeeded()
 
-    def up(self):
+        missing = self.missing_dirs(local_dirs)
+        for path in missing:
+            plan.add(MKDIR_REMOTE, path)
+
+        if checks:
+            spinner.waitfor('Hashing')
+            with self.stats.phase('hashing'):
+                hashes = self.hash_cache.hash_files([os.path.join(self.local_root, filename)
+                                                     for filename, _, _ in checks])
+            checks = [(filename, lf._replace(hash=hashes.get(os.path.join(self.local_root, filename))), s)
+                      for filename, lf, s in checks]
+            # unreadable files are uploaded, so their error is reported
+            changes = [(filename, lf, lf.hash is None or self._changed(filename, lf, s))
+                       for filename, lf, s in checks]
+            with self.stats.phase('hashing'):
+                rhashes = checksum.remote_hashes(self.sftp, self.remote_root,
+                                                 [filename for filename, _, changed in changes if changed])
+            spinner.succeeded()
+            uploads.extend((filename, lf, changed, rhashes.get(filename))
+                           for filename, lf, changed in changes)
+
+        # files in directories which are about to be created can't conflict
+        missing = set(missing)
+        rstats = self.remote_lstat([filename for filename, _, changed, _ in uploads
+                                    if changed and os.path.dirname(filename) not in missing])
+        for filename, lf, changed, rhash in uploads:
+            self._plan_upload(plan, filename, lf, changed, rhash, rstats.get(filename))
+
+        if seen is None:
+            deleted = (filename for directory in self._unvisited(visited)
+                       for filename in self._missing(directory, ()))
+        else:
+            deleted = set()
+            for path in paths:
+                deleted.update(self.revision_file.subtree(path))
+            deleted = (filename for filename in sorted(deleted)
+                       if filename not in seen and
+                       (not self.subdir or _below(filename, [self.subdir])) and
+                       not self.exclude.excluded(filename))
+        for filename in deleted:
+            plan.add(DELETE_REMOTE, filename, self.revision_file[filename])
+
+        return plan
+
+    def _merge(self, plan, filename, rf, lf, base, unreadable=False):
+        """
+        Plans filename from its remote and local state and its state after
+        the last sync. Each of them is None if the file doesn't exist there.
+        An unreadable local file counts as changed.
+        """
+        self.stats.count('examined')
+        rchanged = rf is not None and (base is None or different(
+            self.sftp, filename, base, rf, self.local_root, self.remote_root))
+        lchanged = lf is not None and (base is None or unreadable or different(
+            self.sftp, filename, base, lf, self.local_root, self.remote_root))
+
+        pull = (SYMLINK_LOCAL if rf is not None and stat.S_ISLNK(rf.mode) else DOWNLOAD, filename, rf)
+        push = (SYMLINK_REMOTE if lf is not None and stat.S_ISLNK(lf.mode) else UPLOAD, filename, lf)
+        conflict = None
+
+        if rf is not None and lf is not None:
+            if (rchanged or lchanged) and not _same(rf, lf):
+                if rchanged and lchanged:
+                    conflict = "Conflict with file %s (changed on both sides)" % filename
+                else:
+                    plan.add(*(pull if rchanged else push))
+                    return
+            else:
+                # unchanged, or changed the same way on both sides
+                self.stats.count('unchanged')
+                if base != rf and _same(rf, lf):
+                    plan.update(filename, rf)
+                return
+        elif rf is not None:
+            if base is None:
+                plan.add(*pull)
+                return
+            if not rchanged:
+                plan.add(DELETE_REMOTE, filename, base)
+                return
+            conflict = "Conflict with file %s (deleted locally, changed on remote)" % filename
+        elif lf is not None:
+            if base is None:
+                plan.add(*push)
+                return
+            if not lchanged:
+                plan.add(DELETE_LOCAL, filename, base)
+                return
+            conflict = "Conflict with file %s (deleted on remote, changed locally)" % filename
+        else:
+            # deleted on both sides, only the revision entry is left
+            plan.add(DELETE_LOCAL, filename, base)
+            return
 
-        self.sftp.lstat(self.remote)
+        self.stats.count('conflicts')
+        plan.add(CONFLICT, filename, rf or lf, conflict)
+
+    def plan_both(self):
+        """
+        Compares the remote tree and the local tree against the revision
+        file in a single pass. Files changed or deleted on one side are
+        transferred or deleted on the other one, files changed differently
+        on both sides are conflicts. Returns a SyncPlan for both sides.
+
+        A directory which only exists on one side is only created on the
+        other one if files are transferred into it. Otherwise it was
+        deleted there, and its files are deleted as well. The revision file
+        has no entries for directories, so a new empty directory is taken
+        for a deleted one and left alone, unlike by plan_up and plan_down.
+        """
+        if not os.path.lexists(self.local_root):
+            os.mkdir(self.local_root)
+
+        self.revision_file.load()
+        plan = SyncPlan('both', self.remote_root, self.local_root, self.subdir)
+        self.remote_dirs = set()
+        # files which need a readlink or hashing first
+        deferred = []
+        # directories which only exist on one side, in walk order
+        one_sided = []
 
-        local_files = {}
         spinner.waitfor('Testing')
-        for root, dirs, files in os.walk(self.local.encode('utf-8')):
-            root = to_unicode(root)
-            if self._exclude(root):
+        for root, remote, local in self._walk_both():
+            if remote is not None:
+                self.remote_dirs.add(root)
+                if local is None and root:
+                    one_sided.append((MKDIR_LOCAL, root))
+            elif local is not None:
+                one_sided.append((MKDIR_REMOTE, root))
+
+            remote = remote or {}
+            local = local or {}
+            names = set(remote)
+            names.update(local)
+            names.update(os.path.basename(filename) for filename in self.revision_file.listdir(root))
+            with self.stats.phase('compare'):
+                for name in sorted(names):
+                    filename = os.path.join(root, name)
+                    if name not in remote and name not in local and self.exclude.excluded(filename):
+                        continue
+                    spinner.status(string_shortener(filename))
+                    rf = self._remote_entry(filename, remote[name]) if name in remote else None
+                    lf = self._local_entry(filename, local[name]) if name in local else None
+                    base = self.revision_file.get(filename)
+                    if rf is not None and stat.S_ISLNK(rf.mode) and rf.target is None or \
+                            self.checksum and any(f is not None and stat.S_ISREG(f.mode) and f.hash is None
+                                                  for f in (rf, lf)):
+                        deferred.append((filename, rf, lf, base))
+                    else:
+                        self._merge(plan, filename, rf, lf, base)
+        spinner.succeeded()
+
+        if deferred:
+            self._merge_deferred(plan, deferred)
+
+        pulled = _parents(action.path for action in plan.by_kind(DOWNLOAD, SYMLINK_LOCAL))
+        pushed = _parents(action.path for action in plan.by_kind(UPLOAD, SYMLINK_REMOTE))
+        for kind, root in one_sided:
+            if root in (pulled if kind == MKDIR_LOCAL else pushed):
+                plan.add(kind, root)
+        return plan
+
+    def _merge_deferred(self, plan, deferred):
+        """
+        Reads the link targets and hashes of the deferred (filename, rf,
+        lf, base) entries of plan_both, then merges them into plan
+        """
+        rfiles = dict(self._read_links([(filename, rf) for filename, rf, _, _ in deferred
+                                        if rf is not None]))
+        rhashes = lhashes = {}
+        if self.checksum:
+            # files with unchanged metadata keep the hash of the revision file
+            spinner.waitfor('Hashing')
+            with self.stats.phase('hashing'):
+                rhashes = checksum.remote_hashes(self.sftp, self.remote_root, [
+                    filename for filename, rf in rfiles.items()
+                    if stat.S_ISREG(rf.mode) and rf.hash is None])
+                lhashes = self.hash_cache.hash_files([
+                    os.path.join(self.local_root, filename) for filename, _, lf, _ in deferred
+                    if lf is not None and stat.S_ISREG(lf.mode) and lf.hash is None])
+            spinner.succeeded()
+
+        with self.stats.phase('compare'):
+            for filename, rf, lf, base in deferred:
+                if rf is not None:
+                    rf = rfiles[filename]
+                    if filename in rhashes:
+                        rf = rf._replace(hash=rhashes[filename])
+                lhash = lhashes.get(os.path.join(self.local_root, filename))
+                if lf is not None and lhash is not None:
+                    lf = lf._replace(hash=lhash)
+                unreadable = self.checksum and lf is not None and stat.S_ISREG(lf.mode) and lf.hash is None
+                self._merge(plan, filename, rf, lf, base, unreadable)
+
+    def _use_delta(self, f):
+        return self.delta_threshold is not None and f.size >= self.delta_threshold
+
+    def _delta(self, func, src, dst, f):
+        """
+        Tries a delta transfer. Returns the number of saved bytes or None
+        if the whole file has to be sent.
+        """
+        try:
+            sent = func(src, dst, f.mtime, f.size)
+        except (IOError, paramiko.SSHException) as e:
+            self.log.warning("Delta transfer of %s failed (%s), sending whole file", src, e)
+            return None
+        info("Delta transfer of %s: sent %s, saved %s\n" % (
+            src, format_size(sent), format_size(f.size - sent)))
+        return f.size - sent
+
+    def _use_compression(self, path, f, sample):
+        return self.compression and f.size >= compress.MIN_SIZE and compress.compressible(path, sample)
+
+    def _compressed(self, func, src, f):
+        """
+        Tries a compressed transfer. Returns False if the file has to be
+        sent uncompressed. Errors of the file itself are raised, only a
+        failing helper disables compression.
+        """
+        start = time.time()
+        try:
+            sent = func()
+        except (compress.HelperError, EOFError, paramiko.SSHException) as e:
+            self.log.warning("Compressed transfer of %s failed (%s), disabling compression", src, e)
+            self.compression = False
+            return False
+        self.stats.add_compression(f.size, sent, time.time() - start)
+        return True
+
+    def _download(self, sftp, rfilename, lfilename, f, callback=None):
+        if self._use_delta(f) and os.path.lexists(lfilename) and \
+                stat.S_ISREG(os.lstat(lfilename).st_mode):
+            saved = self._delta(lambda *args: delta.delta_download(sftp, *args),
+                                rfilename, lfilename, f)
+            if saved is not None:
+                return saved
+        if self._use_compression(rfilename, f, False) and self._compressed(
+                lambda: compress.download(sftp, rfilename, lfilename, f.mtime, f.size, callback),
+                rfilename, f):
+            return 0
+        transfer.download(sftp, rfilename, lfilename, f.mtime, f.size, callback, self.streaming)
+        return 0
+
+    def _download_symlink(self, sftp, rfilename, lfilename, f):
+        target = f.target
+        if target is None:
+            target = sftp.readlink(rfilename)
+        info("Creating local symlink %s -> %s\n" % (lfilename, target))
+        try:
+            if os.path.islink(lfilename):
+                os.unlink(lfilename)
+            os.symlink(target, lfilename)
+            # keeps the link from looking locally modified on the next run
+            if os.utime in getattr(os, 'supports_follow_symlinks', ()):
+                os.utime(lfilename, (f.mtime, f.mtime), follow_symlinks=False)
+        except OSError as e:
+            error("Failed: %s\n" % (e,))
+
+    def _upload(self, sftp, lfile, rfile, f, callback=None, update=False):
+        if update and self._use_delta(f):
+            saved = self._delta(lambda *args: delta.delta_upload(sftp, *args),
+                                lfile, rfile, f)
+            if saved is not None:
+                return saved
+        if self._use_compression(lfile, f, True) and self._compressed(
+                lambda: compress.upload(sftp, lfile, rfile, f.mtime, f.size, f.mode, callback),
+                lfile, f):
+            return 0
+        transfer.upload(sftp, lfile, rfile, f.mtime, f.size, callback, f.mode, self.streaming)
+        return 0
+
+    def _upload_symlink(self, sftp, lfile, rfile, target=None):
+        if target is None:
+            target = os.readlink(lfile)
+        print()
+        info("Creating remote symlink %s -> %s\n" % (rfile, target))
+        try:
+            try:
+                sftp.symlink(target, rfile)
+            except IOError:
+                # an existing link is replaced
+                if not stat.S_ISLNK(sftp.lstat(rfile).st_mode):
+                    raise
+                sftp.remove(rfile)
+                sftp.symlink(target, rfile)
+        except paramiko.SSHException as e:
+            error("Failed: %s\n" % (e,))
+        except IOError:
+            pass
+
+    def _progress(self):
+        start = time.time()
+
+        def status(total, size):
+            if size == 0 or total == 0:
+                return
+
+            speed = total / (time.time() - start) * 1.0
+            if speed > 1024 ** 2:
+                speeds = "%.2f MiByte/s" % (speed / 1024 ** 2,)
+            elif speed > 1024:
+                speeds = "%.2f KiByte/s" % (speed / 1024,)
+            else:
+                speeds = "%f Byte/s" % speed
+            remaining = timedelta(seconds=int((size - total) / speed))
+
+            sys.stdout.write("\r%02d%% %d/%d %s %s" % (
+                total * 100 / size, total, size, speeds, remaining))
+            sys.stdout.flush()
+        return status
+
+    def _bundled(self, action):
+        """
+        Records a file transferred by a bundle
+        """
+        if action.kind == DOWNLOAD:
+            info("Downloading: %s\n" % action.path)
+        else:
+            info(" Uploading: %s\n" % action.path)
+        self.revision_file.record(action.path, action.file)
+        self.stats.count('transferred')
+        self.stats.count('bundled')
+        self.stats.count('bytes down' if action.kind == DOWNLOAD else 'bytes up', action.file.size)
+
+    def _bundle(self, actions):
+        """
+        Transfers the files of actions below the bundle threshold as tar
+        streams. Returns the actions which are left for the regular
+        transfer, including all files of a failed bundle.
+        """
+        if not self.bundle_threshold:
+            return actions
+
+        done = set()
+        for kind, func, args in ((DOWNLOAD, bundle.download, (self.sftp, self.remote_root, self.local_root)),
+                                 (UPLOAD, bundle.upload, (self.sftp, self.local_root, self.remote_root))):
+            candidates = [action for action in actions
+                          if action.kind == kind and action.file.size < self.bundle_threshold and
+                          not self._use_delta(action.file)]
+            if len(candidates) < bundle.MIN_FILES:
                 continue
 
-            for d in dirs:
-                d = to_unicode(d)
-                path = os.path.relpath(os.path.join(root, d), self.local)
-                if self._exclude(path):
+            for i in range(0, len(candidates), bundle.MAX_FILES):
+                batch = dict((action.path, action) for action in candidates[i:i + bundle.MAX_FILES])
+                files = dict((path, action.file) for path, action in batch.items())
+                try:
+                    done.update(func(*args, files=files,
+                                     callback=lambda path: self._bundled(batch[path])))
+                except (IOError, OSError, EOFError, paramiko.SSHException) as e:
+                    self.log.warning("Bundled transfer failed (%s), sending files separately", e)
+
+        return [action for action in actions if action.path not in done]
+
+    def _submit(self, pool, action):
+        lfilename = os.path.join(self.local_root, action.path)
+        rfilename = os.path.join(self.remote_root, action.path)
+        status = self._progress() if pool.jobs == 1 else None
+
+        if action.kind == DOWNLOAD:
+            info("Downloading: %s\n" % action.path)
+            pool.submit(action, self._download, rfilename, lfilename, action.file, status)
+        elif action.kind == SYMLINK_LOCAL:
+            pool.submit(action, self._download_symlink, rfilename, lfilename, action.file)
+        elif action.kind == UPLOAD:
+            info(" Uploading: %s\n" % action.path)
+            pool.submit(action, self._upload, lfilename, rfilename, action.file, status,
+                        action.path in self.revision_file)
+        elif action.kind == SYMLINK_REMOTE:
+            pool.submit(action, self._upload_symlink, lfilename, rfilename, action.file.target)
+
+    def _collect(self, pool, wait=False):
+        """
+        Processes finished transfers of the pool and records them in the
+        revision file
+        """
+        for action, saved, e in (pool.join() if wait else pool.completed()):
+            if e is None:
+                self.revision_file.record(action.path, action.file)
+                self.bytes_saved += saved or 0
+                self.stats.count('transferred')
+                if action.kind in (DOWNLOAD, UPLOAD):
+                    self.stats.count('bytes down' if action.kind == DOWNLOAD else 'bytes up',
+                                     action.file.size - (saved or 0))
+                continue
+
+            if action.kind == UPLOAD and getattr(e, 'errno', None) == errno.ENOENT and \
+                    action.path not in self.retried:
+                # its directory may be gone although remote_dirs assumed it
+                self.retried.add(action.path)
+                directory = os.path.dirname(action.path)
+                self._forget_dirs(directory)
+                try:
+                    self._mkdir_remote(self.missing_dirs([directory]))
+                except IOError as mkdir_error:
+                    e = mkdir_error
+                else:
+                    self._submit(pool, action)
                     continue
-                self.check_dir(path)
 
-            if self.subdir:
-                root = os.path.join(self.subdir, root)
+            if not self.skip_on_error:
+                raise e
 
-            for f in files:
-                f = to_unicode(f)
-                if f in ('.files',):
-                    continue
+            self.stats.count('skipped')
 
-                lfile = os.path.join(root, f)
-                filename = os.path.relpath(lfile, self.local_root)
-                if filename.split(os.path.sep)[0] == os.path.curdir:
-                    filename = filename[2:]
+            if action.kind in (DOWNLOAD, SYMLINK_LOCAL):
+                error("Error during downloading %s: %s\n" % (action.path, str(e)))
+            else:
+                error("Error during upload of %s: %s\n" % (action.path, str(e)))
+
+    def _local_states(self, paths):
+        """
+        Returns a dict of (root relative) filename -> current File for the
+        given local files. Files which don't exist are left out.
+        """
+        states = {}
+        for path in paths:
+            try:
+                s = os.lstat(os.path.join(self.local_root, path))
+            except OSError:
+                continue
+            states[path] = self._local_entry(path, s)
+        return states
+
+    def _remote_states(self, paths):
+        """
+        Like _local_states() for remote files, with pipelined requests
+        """
+        return dict(self._read_links([(path, self._remote_entry(path, attr))
+                                      for path, attr in self.remote_lstat(paths).items()]))
+
+    def _verify(self, actions, side, states, report):
+        """
+        Returns the actions whose file is still in the state of its
+        revision entry. The entries of files which are gone are dropped,
+        changed files are kept and reported as conflicts.
+        """
+        verified = []
+        for action in actions:
+            current = states.get(action.path)
+            if current is None:
+                self._deleted(side, action.path, 'gone', report)
+                continue
+            base = action.file
+            if base.mode == -1:
+                # revision files of old versions have no mode
+                base = base._replace(mode=current.mode)
+            if _same(base, current):
+                verified.append(action)
+            else:
+                report.conflict(side, action.path)
+        return verified
+
+    def _confirm(self, actions, side, report):
+        """
+        Asks for every file of actions whether to delete it on side.
+        Returns the confirmed actions.
+        """
+        confirmed = []
+        for action in actions:
+            if side == 'local':
+                warning("Deleted file: %s\n" % action.path)
+            else:
+                warning("Deleted file locally: %s\n" % action.path)
+            print(" Last mod time: %d\n Size: %d\n Mode: %o" % tuple(action.file[:HASH]))
+            if prompt("Delete it %s?[y/n]" % ('locally' if side == 'local' else 'on remote')) == 'y':
+                confirmed.append(action)
+            else:
+                report.add(side, 'kept')
+        return confirmed
+
+    def _trash_path(self, path, stamp):
+        return os.path.join(self.delete_policy.trash_dir, stamp, path)
+
+    def _removable_dir(self, path):
+        """
+        True if the (root relative) directory may be removed once it is
+        empty, the root and the subdir stay
+        """
+        return path != '' and (not self.subdir or path.startswith(self.subdir + '/'))
+
+    def _deleted(self, side, path, outcome, report):
+        self.revision_file.forget(path)
+        report.add(side, outcome)
+        if outcome in ('deleted', 'trashed'):
+            self.stats.count(outcome)
+
+    def _delete_local(self, actions, report):
+        """
+        Deletes or trashes the local files of the DELETE_LOCAL actions,
+        then the directories emptied by it. Files changed since the last
+        sync are kept.
+        """
+        mode = self.delete_policy.mode
+        if mode == delete.NEVER:
+            report.add('local', 'kept', len(actions))
+            return
+        actions = self._verify(actions, 'local',
+                               self._local_states(action.path for action in actions), report)
+        if mode == delete.ASK:
+            actions = self._confirm(actions, 'local', report)
+
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        emptied = set()
+        for action in actions:
+            lfilename = os.path.join(self.local_root, action.path)
+            try:
+                if mode == delete.TRASH:
+                    target = os.path.join(self.local_root, self._trash_path(action.path, stamp))
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    os.rename(lfilename, target)
+                else:
+                    os.unlink(lfilename)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    self._deleted('local', action.path, 'gone', report)
+                else:
+                    report.fail('local', action.path, e)
+                continue
+            self._deleted('local', action.path, 'trashed' if mode == delete.TRASH else 'deleted', report)
+            emptied.add(os.path.dirname(action.path))
+
+        # deepest first, so a removed directory can empty its parent
+        todo = [(-path.count('/'), path) for path in emptied]
+        heapq.heapify(todo)
+        while todo:
+            _, path = heapq.heappop(todo)
+            if not self._removable_dir(path):
+                continue
+            try:
+                os.rmdir(os.path.join(self.local_root, path))
+            except OSError:
+                # not empty (e.g. excluded files)
+                continue
+            report.add('local', 'dirs')
+            parent = os.path.dirname(path)
+            if parent not in emptied:
+                emptied.add(parent)
+                heapq.heappush(todo, (-parent.count('/'), parent))
+
+    def _rmdir_remote(self, paths, report):
+        """
+        Removes the given (root relative) directories and the parents they
+        were the last entry of, if they are empty. Requests for
+        directories of the same depth are pipelined.
+        """
+        levels = {}
+        for path in paths:
+            levels.setdefault(path.count('/'), set()).add(path)
+
+        def removed(path, e):
+            if e is not None:
+                # not empty (e.g. excluded files)
+                return
+            report.add('remote', 'dirs')
+            self.remote_dirs.discard(path)
+            parent = os.path.dirname(path)
+            levels.setdefault(parent.count('/'), set()).add(parent)
+
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        try:
+            while levels:
+                depth = max(levels)
+                for path in sorted(levels.pop(depth)):
+                    if self._removable_dir(path):
+                        pipeline.rmdir(os.path.join(self.remote_root, path),
+                                       lambda _, e, path=path: removed(path, e))
+                pipeline.flush()
+        finally:
+            pipeline.flush()
+
+    def _delete_remote(self, actions, report):
+        """
+        Deletes or trashes the remote files of the DELETE_REMOTE actions
+        with pipelined requests, then the directories emptied by it. Files
+        changed since the last sync are kept.
+        """
+        mode = self.delete_policy.mode
+        if mode == delete.NEVER:
+            report.add('remote', 'kept', len(actions))
+            return
+        if not actions:
+            return
+        actions = self._verify(actions, 'remote',
+                               self._remote_states(action.path for action in actions), report)
+        if mode == delete.ASK:
+            actions = self._confirm(actions, 'remote', report)
+        if not actions:
+            return
 
-                if self._exclude(lfile):
-                    continue
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        outcome = 'trashed' if mode == delete.TRASH else 'deleted'
+        if mode == delete.TRASH:
+            self._mkdir_remote(self.missing_dirs(set(
+                os.path.dirname(self._trash_path(action.path, stamp)) for action in actions)))
 
-                rfile = os.path.join(self.remote_root, filename)
-                s = os.lstat(lfile)
-                spinner.status(string_shortener(filename))
+        emptied = set()
 
-                local_files[filename] = File(int(s.st_mtime), int(s.st_size), int(s.st_mode))
+        def done(path, e):
+            if e is None:
+                self._deleted('remote', path, outcome, report)
+                emptied.add(os.path.dirname(path))
+            elif getattr(e, 'errno', None) == errno.ENOENT:
+                self._deleted('remote', path, 'gone', report)
+            else:
+                report.fail('remote', path, e)
 
-                if filename not in self.revision_file:
-                    print_file_info(filename, s)
-                    upload = True
+        pipeline = RequestPipeline(self.sftp, self.walk_window)
+        try:
+            for action in actions:
+                rfilename = os.path.join(self.remote_root, action.path)
+                callback = lambda _, e, path=action.path: done(path, e)
+                if mode == delete.TRASH:
+                    pipeline.rename(rfilename, os.path.join(
+                        self.remote_root, self._trash_path(action.path, stamp)), callback)
                 else:
-                    lf = local_files[filename]
-                    rf = self.revision_file[filename]
-                    upload = different(self.sftp, filename, rf, lf,
-                                       self.local_root, self.remote_root)
+                    pipeline.remove(rfilename, callback)
+        finally:
+            pipeline.flush()
+
+        self._rmdir_remote(emptied, report)
+
+    def _delete(self, plan):
+        """
+        Applies the deletions of plan according to the delete policy.
+        Returns a DeleteReport.
+        """
+        report = delete.DeleteReport()
+        local = plan.by_kind(DELETE_LOCAL)
+        remote = plan.by_kind(DELETE_REMOTE)
+        max_count = self.delete_policy.max_count
+        if self.delete_policy.mode != delete.NEVER and max_count is not None and \
+                len(local) + len(remote) > max_count:
+            report.limit(len(local) + len(remote), max_count)
+            return report
+
+        self._delete_local(local, report)
+        self._delete_remote(remote, report)
+        return report
+
+    def execute(self, plan):
+        """
+        Runs a SyncPlan. The revision file is updated for every finished
+        transfer, so an aborted run still leaves a correct revision file.
+        """
+        if (plan.remote, plan.local, plan.subdir) != (self.remote_root, self.local_root, self.subdir):
+            raise ValueError("Plan was created for %s <-> %s (subdir %r)" % (
+                plan.remote, plan.local, plan.subdir))
+
+        if self.dry_run:
+            plan.describe()
+            return
 
-                if upload:
-                    spinner.succeeded()
-                    info(" Uploading: %s\n" % filename)
-                    try:
-                        try:
-                            rstat = self.sftp.lstat(rfile)
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            pass
-                        else:
-                            if rstat.st_mtime > s.st_mtime:
-                                raise ValueError("Conflict with file %s (remote file is newer)" % filename)
-
-                        start = time.time()
-
-                        def status(total, size):
-                            if size == 0:
-                                return
-
-                            speed = total / (time.time() - start) * 1.0
-                            if speed > 1024 ** 2:
-                                speeds = "%.2f MiByte/s" % (speed / 1024 ** 2,)
-                            elif speed > 1024:
-                                speeds = "%.2f KiByte/s" % (speed / 1024,)
-                            else:
-                                speeds = "%f Byte/s" % speed
-                            remaining = timedelta(seconds=int((size - total) / speed))
-
-                            sys.stdout.write("\r%02d%% %d/%d %s %s" % (
-                                total * 100 / size, total, size, speeds, remaining))
-                            sys.stdout.flush()
-
-                        if not self.dry_run:
-                            if stat.S_ISLNK(s.st_mode):
-                                target = os.readlink(lfile)
-                                print()
-                                info("Creating remote symlink %s -> %s\n" % (rfile, target))
-                                try:
-                                    self.sftp.symlink(target, rfile)
-                                except paramiko.SSHException as e:
-                                    error("Failed: %s\n" % (e,))
-                                except IOError:
-                                    pass
-
-                            else:
-                                self.sftp.put(lfile, rfile, status)
-                                f = self.sftp.file(rfile)
-                                f.utime((s.st_atime, s.st_mtime))
-                                f.close()
-                        spinner.waitfor('Testing')
-                    except ValueError:
-                        del local_files[filename]
-                        self.revision_file.update(local_files)
-                        if not self.dry_run:
-                            self.revision_file.save()
-                        raise
-                    except KeyboardInterrupt:
-                        del local_files[filename]
-                        if not self.dry_run:
-                            self.sftp.unlink(rfile)
-                        self.revision_file.update(local_files)
-                        if not self.dry_run:
-                            self.revision_file.save()
-                        exit(1)
-                    except Exception as e:
-                        del local_files[filename]
-                        if not self.dry_run and filename not in self.revision_file:
-                            self.sftp.unlink(rfile)
-                        if not self.skip_on_error:
-                            self.revision_file.update(local_files)
-                            if not self.dry_run:
-                                self.revision_file.save()
-                            raise
-                        else:
-                            if filename in self.revision_file:  # prevent deletion
-                                local_files[filename] = self.revision_file[filename]
-                            error("Error during upload of %s: %s\n" % (filename, str(e)))
-        spinner.succeeded()
+        revision_file = self.revision_file
+        for path, f in plan.updates.items():
+            revision_file.record(path, f)
 
-        for filename in self.revision_file.keys():
-            if self.subdir:
-                if not filename.startswith(self.subdir):
-                    continue
-            if filename not in local_files and not self._exclude(filename):
-                warning("Deleted file locally: %s\n" % filename)
-                print(" Last mod time: %d\n Size: %d\n Mode: %o" % self.revision_file[filename])
-                if not self.dry_run:
-                    try:
-                        self.sftp.lstat(os.path.join(self.remote_root, filename))
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                        warning("Can't stat remote file. Maybe already deleted?\n")
-                        del self.revision_file[filename]
-                        continue
-                    answer = prompt("Delete it on remote?[y/n]")
-                    if answer == 'y':
-                        self.sftp.unlink(os.path.join(self.remote_root, filename))
-                        del self.revision_file[filename]
+        for action in plan.by_kind(MKDIR_LOCAL):
+            lpath = os.path.join(self.local_root, action.path)
+            if not os.path.lexists(lpath):
+                os.mkdir(lpath)
 
-        self.revision_file.update(local_files)
-        if not self.dry_run:
-            self.revision_file.save()
+        self._mkdir_remote([action.path for action in plan.by_kind(MKDIR_REMOTE)])
+
+        if plan.by_kind(DOWNLOAD, UPLOAD):
+            self._tune()
+
+        pool = ChannelPool(self.sftp, self.jobs, self.stats)
+        try:
+            with self.stats.phase('transfers'):
+                for action in self._bundle(plan.by_kind(*TRANSFERS)):
+                    self._submit(pool, action)
+                    self._collect(pool)
+                self._collect(pool, wait=True)
+        except KeyboardInterrupt:
+            pool.abort()
+            revision_file.commit()
+            exit(1)
+        except Exception:
+            pool.abort()
+            revision_file.commit()
+            raise
+        finally:
+            pool.close()
+
+        conflicts = plan.conflicts
+        for action in conflicts:
+            error("%s\n" % action.reason)
+        if conflicts and not self.skip_on_error:
+            revision_file.commit()
+            raise ValueError(conflicts[0].reason if len(conflicts) == 1 else
+                             "%d conflicts" % len(conflicts))
+
+        with self.stats.phase('deletes'):
+            report = self._delete(plan)
+        report.show()
+
+        if self.bytes_saved:
+            info("Delta transfers saved %s\n" % format_size(self.bytes_saved))
+        with self.stats.phase('revision save'):
+            revision_file.commit()
+            if self.checksum:
+                self.hash_cache.save()
+
+        if report.problem is not None and not self.skip_on_error:
+            raise ValueError(report.problem)
+
+    def plan(self, direction):
+        if direction == 'down':
+            return self.plan_down()
+        elif direction == 'up':
+            return self.plan_up()
+        elif direction == 'both':
+            return self.plan_both()
+        raise ValueError("Can't plan a sync in direction %s" % direction)
+
+    def down(self):
+        return self.execute(self.plan_down())
+
+    def up(self):
+        return self.execute(self.plan_up())
+
+    def both(self):
+        return self.execute(self.plan_both())
 
 
 def sync(sftp, remote, local, direction='down', exclude=None,
-         dry_run=False, skip_on_error=False, subdir=None):
-    sync = Sync(sftp, remote, local, exclude, skip_on_error, subdir, dry_run)
+         dry_run=False, skip_on_error=False, subdir=None, jobs=1,
+         plan_file=None, save_plan=None, delta_threshold=None, checksum=False,
+         stats=None, streaming=None, bundle_threshold=None, compression=False,
+         debounce=watcher.DEBOUNCE, remote_scan=False, delete_policy=None, batch=False):
+    sync = Sync(sftp, remote, local, exclude, skip_on_error, subdir, dry_run, jobs,
+                delta_threshold, checksum, stats, streaming, bundle_threshold, compression,
+                remote_scan, delete_policy, batch)
+    try:
+        return _run(sync, remote, local, direction, subdir, plan_file, save_plan, debounce)
+    finally:
+        sync.stats.count('excluded', sync.exclude.hits)
+
+
+def _run(sync, remote, local, direction, subdir, plan_file, save_plan, debounce):
     if direction == 'check':
         sync.check_revision_against_remote()
         return
@@ -757,16 +2200,20 @@ def sync(sftp, remote, local, direction='down', exclude=None,
         info("Syncing %s <-> %s with subdir %s\n" % (remote, local, subdir))
     else:
         info("Syncing %s <-> %s\n" % (remote, local))
-    c = prompt("Continue?[y/n]").lower()
-    if c != 'y':
+    if not sync.batch and prompt("Continue?[y/n]").lower() != 'y':
         return False
 
-    if direction == 'both':
-        sync.down()
-        sync.up()
-    elif direction == 'down':
-        return sync.down()
-    elif direction == 'up':
-        return sync.up()
+    if direction in ('down', 'up', 'both'):
+        if plan_file:
+            plan = SyncPlan.load(plan_file)
+            if plan.direction != direction:
+                raise ValueError("Plan %s syncs %s, not %s" % (plan_file, plan.direction, direction))
+        else:
+            plan = sync.plan(direction)
+        if save_plan:
+            plan.save(save_plan)
+        return sync.execute(plan)
     elif direction == 'init':
         return sync.build_rev_file()
+    elif direction == 'watch':
+        return watcher.watch(sync, debounce)
@@ -0,0 +1,299 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from collections import namedtuple
+import errno
+import os
+import logging
+import stat
+import time
+
+from helperlib import info
+from paramiko.sftp import CMD_SETSTAT
+from paramiko.sftp_attr import SFTPAttributes
+
+from .sftp import RequestPipeline
+
+__author__ = 'bluec0re'
+
+log = logging.getLogger(__name__)
+
+PART_SUFFIX = '.sftpsync-part'
+# smaller files are written in place and simply resent after an interruption
+RESUME_THRESHOLD = 1024 ** 2
+# the request size every server has to support
+BLOCK_SIZE = 32768
+# channel window of paramiko, enough for about 20 MB/s at 100ms
+DEFAULT_WINDOW = 2 * 1024 ** 2
+MAX_WINDOW = 64 * 1024 ** 2
+# the window is sized to keep a link of this bandwidth busy
+TARGET_BANDWIDTH = 125 * 1024 ** 2
+MIN_REQUESTS = 16
+
+Streaming = namedtuple('Streaming', ('chunk_size', 'max_requests', 'window_size'))
+Streaming.__new__.__defaults__ = (None, None, None)
+
+
+def measure_rtt(sftp, path, samples=3):
+    """
+    Round trip time of the sftp connection in seconds, the fastest of a
+    few lstat requests
+    """
+    rtt = None
+    for _ in range(samples):
+        start = time.time()
+        sftp.lstat(path)
+        elapsed = time.time() - start
+        if rtt is None or elapsed < rtt:
+            rtt = elapsed
+    return rtt
+
+
+def tune(rtt, streaming=None):
+    """
+    Fills in the unset values of streaming for a link with the given
+    round trip time. The window covers the bandwidth-delay product of
+    TARGET_BANDWIDTH and is filled by read-ahead and pipelined writes.
+    """
+    streaming = streaming or Streaming()
+    chunk_size = streaming.chunk_size or BLOCK_SIZE
+    window_size = streaming.window_size
+    if window_size is None:
+        window_size = min(MAX_WINDOW, max(DEFAULT_WINDOW, int(rtt * TARGET_BANDWIDTH)))
+    max_requests = streaming.max_requests
+    if max_requests is None:
+        max_requests = max(MIN_REQUESTS, window_size // chunk_size)
+    return Streaming(chunk_size, max_requests, window_size)
+
+
+def part_name(path, mtime, size):
+    """
+    Name of the partial file for path. It contains the mtime and size of
+    the source, so a partial file of an outdated source is never resumed.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.%s.%d-%d%s' % (basename, mtime, size, PART_SUFFIX))
+
+
+def _stale_parts(names, path, current):
+    prefix = '.%s.' % os.path.basename(path)
+    current = os.path.basename(current)
+    return [name for name in names
+            if name.startswith(prefix) and name.endswith(PART_SUFFIX) and name != current]
+
+
+def _read(src, dst, offset, size, callback, streaming):
+    """
+    Copies the remote file src to the local file dst. Reads are sent
+    through a RequestPipeline ahead of the data written, at most
+    streaming.max_requests are in flight. The read at size has to find
+    the end of the file.
+    """
+    pipeline = RequestPipeline(src.sftp, streaming.max_requests)
+    chunks = {}
+    errors = []
+
+    def received(offset, data, e):
+        if e is not None:
+            errors.append(e)
+        else:
+            chunks[offset] = data
+
+    lengths = {}
+
+    def request(offset, length):
+        lengths[offset] = length
+        pipeline.read(src, offset, length, received)
+
+    total = offset
+    requested = offset
+    try:
+        while not errors:
+            while requested <= size and pipeline.outstanding < streaming.max_requests:
+                length = min(streaming.chunk_size, size - requested) or 1
+                request(requested, length)
+                requested += length
+            if total not in chunks:
+                if total > size or not pipeline.outstanding:
+                    break
+                pipeline.wait()
+                continue
+
+            data = chunks.pop(total)
+            length = lengths.pop(total)
+            if not data:
+                break
+            dst.write(data)
+            total += len(data)
+            if len(data) < length and total < size:
+                # a short read, the rest is requested again
+                request(total, length - len(data))
+            if callback is not None:
+                callback(min(total, size), size)
+    finally:
+        pipeline.flush()
+    if errors:
+        raise errors[0]
+    if total != size:
+        raise IOError("size mismatch in transfer!  %d != %d" % (total, size))
+
+
+def _write(src, dst, offset, size, callback, streaming):
+    """
+    Copies the local file src to the remote file dst. Writes are sent
+    through a RequestPipeline without waiting for the previous ones, at
+    most streaming.max_requests are unacknowledged.
+    """
+    pipeline = RequestPipeline(dst.sftp, streaming.max_requests)
+    errors = []
+
+    def written(offset, e):
+        if e is not None:
+            errors.append(e)
+
+    total = offset
+    try:
+        while not errors:
+            data = src.read(streaming.chunk_size)
+            if not data:
+                break
+            pipeline.write(dst, total, data, written)
+            total += len(data)
+            if callback is not None:
+                callback(total, size)
+    finally:
+        pipeline.flush()
+    if errors:
+        raise errors[0]
+    if total != size:
+        raise IOError("size mismatch in transfer!  %d != %d" % (total, size))
+
+
+def _open(sftp, path, mode, streaming):
+    fp = sftp.open(path, mode)
+    fp.MAX_REQUEST_SIZE = streaming.chunk_size
+    return fp
+
+
+def download(sftp, rpath, lpath, mtime, size, callback=None, streaming=None):
+    """
+    Downloads rpath to lpath and sets the mtime. Reads are pipelined,
+    streaming (a Streaming tuple) sets the request size and the number
+    of requests in flight.
+
+    Large files are written to a partial file first. An interrupted
+    download of an unchanged source continues at the end of it.
+    """
+    streaming = streaming or tune(0)
+    if size < RESUME_THRESHOLD:
+        try:
+            with _open(sftp, rpath, 'rb', streaming) as rf:
+                with open(lpath, 'wb') as lf:
+                    _read(rf, lf, 0, size, callback, streaming)
+        except BaseException:
+            try:
+                os.unlink(lpath)
+            except OSError:
+                pass
+            raise
+        os.utime(lpath, (mtime, mtime))
+        return
+
+    part = part_name(lpath, mtime, size)
+    dirname = os.path.dirname(part)
+    for stale in _stale_parts(os.listdir(dirname or os.curdir), lpath, part):
+        log.info("Removing outdated partial file %s", stale)
+        os.unlink(os.path.join(dirname, stale))
+
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        if offset > size:
+            offset = 0
+
+    with _open(sftp, rpath, 'rb', streaming) as rf:
+        with open(part, 'ab' if offset else 'wb') as lf:
+            if offset:
+                info("Resuming download of %s at %d/%d\n" % (rpath, offset, size))
+            _read(rf, lf, offset, size, callback, streaming)
+
+    os.utime(part, (mtime, mtime))
+    os.rename(part, lpath)
+
+
+def remote_rename(sftp, old, new):
+    try:
+        sftp.posix_rename(old, new)
+    except (AttributeError, IOError):
+        # server without posix-rename@openssh.com
+        try:
+            sftp.remove(new)
+        except IOError:
+            pass
+        sftp.rename(old, new)
+
+
+def set_remote_attributes(sftp, path, mtime, mode=None):
+    """
+    Sets the mtime and the permissions of path with a single setstat
+    request
+    """
+    attr = SFTPAttributes()
+    attr.st_atime = attr.st_mtime = mtime
+    if mode is not None:
+        attr.st_mode = stat.S_IMODE(mode)
+    sftp._request(CMD_SETSTAT, sftp._adjust_cwd(path), attr)
+
+
+def upload(sftp, lpath, rpath, mtime, size, callback=None, mode=None, streaming=None):
+    """
+    Uploads lpath to rpath and sets the mtime (and the permissions, if
+    mode is given). Writes are pipelined, streaming (a Streaming tuple)
+    sets the request size and the number of unacknowledged writes.
+
+    Files are written to a partial file which replaces rpath once it is
+    complete, so a failed upload leaves the old file in place. An
+    interrupted upload of a large unchanged source continues at the end
+    of it.
+    """
+    streaming = streaming or tune(0)
+    part = part_name(rpath, mtime, size)
+    if size < RESUME_THRESHOLD:
+        try:
+            with open(lpath, 'rb') as lf:
+                with _open(sftp, part, 'wb', streaming) as rf:
+                    _write(lf, rf, 0, size, callback, streaming)
+            set_remote_attributes(sftp, part, mtime, mode)
+        except BaseException:
+            # too small to be resumed
+            try:
+                sftp.remove(part)
+            except (IOError, EOFError):
+                pass
+            raise
+        remote_rename(sftp, part, rpath)
+        return
+
+    dirname = os.path.dirname(part)
+    for stale in _stale_parts(sftp.listdir(dirname or os.curdir), rpath, part):
+        log.info("Removing outdated partial file %s", stale)
+        sftp.remove(os.path.join(dirname, stale))
+
+    offset = 0
+    try:
+        offset = sftp.stat(part).st_size
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    if offset > size:
+        offset = 0
+
+    with open(lpath, 'rb') as lf:
+        with _open(sftp, part, 'ab' if offset else 'wb', streaming) as rf:
+            if offset:
+                info("Resuming upload of %s at %d/%d\n" % (rpath, offset, size))
+                lf.seek(offset)
+            _write(lf, rf, offset, size, callback, streaming)
+
+    set_remote_attributes(sftp, part, mtime, mode)
+    remote_rename(sftp, part, rpath)
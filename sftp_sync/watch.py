@@ -0,0 +1,232 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Continuous uploads of local changes, driven by Linux inotify.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from helperlib import info, error
+from helperlib.logging import scope_logger
+import paramiko
+
+__author__ = 'bluec0re'
+
+# seconds without events before a batch of changes is synced
+DEBOUNCE = 0.5
+# a batch is synced after this many seconds even if events keep coming
+MAX_DELAY = 5.0
+# seconds between keepalive messages on an idle connection
+KEEPALIVE = 30
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# written files are reported once they are closed
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT = struct.Struct('iIII')
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, "inotify is not available on this system")
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+    return libc
+
+
+@scope_logger
+class Inotify(object):
+    """
+    Watches a directory tree. Paths are relative to root, directories
+    for which skip_dir(path) is true aren't watched.
+    """
+    def __init__(self, root, skip_dir=None):
+        self.libc = _libc()
+        self.root = root
+        self.skip_dir = skip_dir or (lambda path: False)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def _add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.path.join(self.root, path).encode('utf-8'),
+                                         WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            # vanished in the meantime
+            if e not in (errno.ENOENT, errno.ENOTDIR):
+                self.log.warning("Can't watch %s: %s", path, os.strerror(e))
+            return
+        self.paths[wd] = path
+
+    def add_tree(self, path=''):
+        """
+        Watches the directory path and all directories below it. A
+        directory which moved within the tree loses its watches with the
+        old path (remove_tree()) and is watched again with this at the
+        new path.
+        """
+        if path and self.skip_dir(path):
+            return
+        self._add(path)
+        for root, dirs, _ in os.walk(os.path.join(self.root, path).encode('utf-8')):
+            root = os.path.relpath(root.decode('utf-8'), self.root)
+            if root == os.curdir:
+                root = ''
+            dirs[:] = [d for d in dirs if not self.skip_dir(os.path.join(root, d.decode('utf-8')))]
+            for d in dirs:
+                self._add(os.path.join(root, d.decode('utf-8')))
+
+    def remove_tree(self, path):
+        """
+        Stops watching path and the directories below it
+        """
+        for wd, watched in list(self.paths.items()):
+            if watched == path or watched.startswith(path + '/'):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def read(self):
+        """
+        Reads the pending events. Returns the changed paths, or None if
+        events were lost and everything has to be checked.
+        """
+        data = os.read(self.fd, 65536)
+        changed = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name.decode('utf-8')) if name else directory
+            changed.add(path)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.remove_tree(path)
+        if overflow:
+            self.log.warning("Too many changes at once, checking everything")
+            return None
+        return changed
+
+    def changes(self, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+        """
+        Yields batches of changed paths. A batch is complete once there
+        were no events for debounce seconds. None is yielded if events
+        were lost.
+        """
+        changed = set()
+        first = None
+        while True:
+            timeout = None
+            if first is not None:
+                timeout = max(0, min(debounce, first + max_delay - time.time()))
+            try:
+                ready = select.select([self.fd], [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if ready:
+                paths = self.read()
+                if first is None:
+                    first = time.time()
+                if paths is None:
+                    changed = None
+                elif changed is not None:
+                    changed.update(paths)
+                if time.time() - first < max_delay:
+                    continue
+
+            if first is not None:
+                yield changed
+                changed = set()
+                first = None
+
+
+def _sync(sync, paths=None):
+    """
+    Uploads the changes of paths, or all changes if paths is None.
+    Returns False if the connection failed, the state of the remote side
+    is unknown then.
+    """
+    if paths is not None:
+        paths = [path for path in paths if not sync.ignored(path)]
+        if not paths:
+            return True
+    try:
+        plan = sync.plan_up(paths)
+        sync.execute(plan)
+    except (IOError, OSError, ValueError) as e:
+        error("%s\n" % e)
+        return True
+    except (EOFError, paramiko.SSHException) as e:
+        error("Connection failed: %s\n" % e)
+        return False
+    if len(plan):
+        info("Synced %d changes\n" % len(plan))
+    return True
+
+
+def watch(sync, debounce=DEBOUNCE):
+    """
+    Uploads all local changes, then keeps uploading the paths changed
+    locally until interrupted. After a connection error, the next batch
+    compares everything again.
+    """
+    channel = sync.sftp.get_channel()
+    if isinstance(channel, paramiko.Channel):
+        channel.get_transport().set_keepalive(KEEPALIVE)
+
+    inotify = Inotify(sync.local_root, sync._exclude_dir)
+    try:
+        # watching starts first, so changes during the initial sync are caught
+        inotify.add_tree(sync.subdir)
+        synced = _sync(sync)
+        info("Watching %s for changes\n" % sync.local)
+        for changed in inotify.changes(debounce):
+            synced = _sync(sync, changed if synced else None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
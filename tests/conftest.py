@@ -0,0 +1,123 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+"""
+Fixtures running syncs against the in-process SFTP server of the
+benchmarks. The remote and the local project live in a temporary
+directory.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import sys
+
+import pytest
+
+from benchmarks.server import LocalSFTPServer
+import sftp_sync
+
+# the package exports the function sync, which hides the module
+sync_module = sys.modules['sftp_sync.sync']
+
+__author__ = 'bluec0re'
+
+MTIME = 1500000000
+
+
+def write(root, path, data, mtime=MTIME):
+    """
+    Creates root/path with data and the given mtime
+    """
+    fname = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    with open(fname, 'wb') as fp:
+        fp.write(data)
+    os.utime(fname, (mtime, mtime))
+    return fname
+
+
+def read(root, path):
+    with open(os.path.join(root, path), 'rb') as fp:
+        return fp.read()
+
+
+def tree(root):
+    """
+    Relative paths of all files below root, without the bookkeeping files
+    """
+    paths = set()
+    for directory, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.relpath(os.path.join(directory, name), root)
+            if os.path.basename(path) not in sync_module.METADATA_FILES:
+                paths.add(path)
+    return paths
+
+
+@pytest.fixture(scope='session')
+def server():
+    return LocalSFTPServer()
+
+
+@pytest.fixture
+def sftp(server):
+    client = server.connect()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    path = tmp_path / 'remote' / 'proj'
+    path.mkdir(parents=True)
+    return str(path)
+
+
+@pytest.fixture
+def local(tmp_path):
+    (tmp_path / 'local').mkdir()
+    return str(tmp_path / 'local' / 'proj')
+
+
+@pytest.fixture(autouse=True)
+def answers(monkeypatch):
+    """
+    Answers to the prompts of a sync, a prompt without an answer fails
+    """
+    replies = []
+
+    def prompt(question, *args, **kwargs):
+        assert replies, "Unexpected prompt: %s" % question
+        return replies.pop(0)
+
+    monkeypatch.setattr(sync_module, 'prompt', prompt)
+    return replies
+
+
+@pytest.fixture(autouse=True)
+def no_spinner(monkeypatch):
+    # helperlib's spinner fails if stderr isn't a terminal
+    for name in ('waitfor', 'status', 'succeeded', 'failed'):
+        monkeypatch.setattr(sync_module.spinner, name, lambda *args, **kwargs: None)
+
+
+@pytest.fixture
+def make_sync(sftp, remote, local):
+    """
+    Creates Sync instances for the remote and local project
+    """
+    def make(**kwargs):
+        return sync_module.Sync(sftp, remote, local, **kwargs)
+    return make
+
+
+@pytest.fixture
+def synced(make_sync, remote):
+    """
+    A project with a few files, downloaded once
+    """
+    write(remote, 'top.txt', b'top')
+    write(remote, 'a/one.txt', b'one')
+    write(remote, 'a/b/two.txt', b'two' * 1000)
+    write(remote, 'c/three.txt', b'three')
+    make_sync().down()
+    return make_sync
@@ -0,0 +1,99 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import shutil
+
+import pytest
+
+from sftp_sync.plan import DOWNLOAD, UPLOAD, MKDIR_LOCAL, MKDIR_REMOTE, DELETE_LOCAL, DELETE_REMOTE, CONFLICT
+
+from .conftest import MTIME, write, read, tree
+
+__author__ = 'bluec0re'
+
+
+def actions(plan):
+    return sorted((action.kind, action.path) for action in plan)
+
+
+def test_changes_on_both_sides(synced, remote, local):
+    write(remote, 'a/one.txt', b'remote change', MTIME + 10)
+    write(local, 'c/three.txt', b'local change', MTIME + 10)
+    write(remote, 'a/new_remote.txt', b'r')
+    write(local, 'a/b/new_local.txt', b'l')
+
+    plan = synced().plan('both')
+    assert actions(plan) == [(DOWNLOAD, 'a/new_remote.txt'), (DOWNLOAD, 'a/one.txt'),
+                             (UPLOAD, 'a/b/new_local.txt'), (UPLOAD, 'c/three.txt')]
+    synced().execute(plan)
+    assert tree(local) == tree(remote)
+    assert read(local, 'a/one.txt') == b'remote change'
+    assert read(remote, 'c/three.txt') == b'local change'
+    assert len(synced().plan('both')) == 0
+
+
+def test_deletions(synced, remote, local, answers):
+    os.unlink(os.path.join(remote, 'a/one.txt'))
+    os.unlink(os.path.join(local, 'c/three.txt'))
+    # deleted on both sides, executing it only drops the revision entry
+    os.unlink(os.path.join(remote, 'top.txt'))
+    os.unlink(os.path.join(local, 'top.txt'))
+
+    sync = synced()
+    plan = sync.plan('both')
+    assert actions(plan) == [(DELETE_LOCAL, 'a/one.txt'), (DELETE_LOCAL, 'top.txt'),
+                             (DELETE_REMOTE, 'c/three.txt')]
+    answers.extend(['y', 'y'])
+    sync.execute(plan)
+    assert tree(local) == tree(remote) == set(['a/b/two.txt'])
+    assert 'top.txt' not in synced().revision_file
+    assert len(synced().plan('both')) == 0
+
+
+def test_deleted_directories(synced, remote, local, answers):
+    shutil.rmtree(os.path.join(local, 'a'))
+    shutil.rmtree(os.path.join(remote, 'c'))
+    write(remote, 'new/x/file.txt', b'n')
+
+    plan = synced().plan('both')
+    assert actions(plan) == [(DELETE_LOCAL, 'c/three.txt'), (DELETE_REMOTE, 'a/b/two.txt'),
+                             (DELETE_REMOTE, 'a/one.txt'), (DOWNLOAD, 'new/x/file.txt'),
+                             (MKDIR_LOCAL, 'new'), (MKDIR_LOCAL, 'new/x')]
+    answers.extend(['y', 'y', 'y'])
+    synced().execute(plan)
+    assert tree(local) == tree(remote) == set(['top.txt', 'new/x/file.txt'])
+    assert not os.path.exists(os.path.join(remote, 'a'))
+    assert not os.path.exists(os.path.join(local, 'c'))
+    assert len(synced().plan('both')) == 0
+
+
+def test_conflicts(synced, remote, local):
+    write(remote, 'a/one.txt', b'remote', MTIME + 10)
+    write(local, 'a/one.txt', b'local!', MTIME + 20)
+    # the same change on both sides isn't a conflict
+    write(remote, 'top.txt', b'same', MTIME + 10)
+    write(local, 'top.txt', b'same', MTIME + 10)
+    # changed on one side, deleted on the other
+    os.unlink(os.path.join(remote, 'c/three.txt'))
+    write(local, 'c/three.txt', b'changed', MTIME + 10)
+
+    plan = synced().plan('both')
+    assert actions(plan) == [(CONFLICT, 'a/one.txt'), (CONFLICT, 'c/three.txt')]
+    with pytest.raises(ValueError):
+        synced().execute(plan)
+    assert read(local, 'a/one.txt') == b'local!'
+    assert read(remote, 'a/one.txt') == b'remote'
+
+    synced(skip_on_error=True).execute(synced().plan('both'))
+    assert synced().revision_file['top.txt'].mtime == MTIME + 10
+
+
+def test_new_empty_directories(synced, remote, local):
+    os.makedirs(os.path.join(local, 'empty/local'))
+    os.makedirs(os.path.join(remote, 'empty_remote'))
+
+    # no revision entries tell a new empty directory from a deleted one
+    assert len(synced().plan('both')) == 0
+    assert actions(synced().plan('up')) == [(MKDIR_REMOTE, 'empty'), (MKDIR_REMOTE, 'empty/local')]
+    assert actions(synced().plan('down')) == [(MKDIR_LOCAL, 'empty_remote')]
@@ -0,0 +1,116 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import pytest
+
+from sftp_sync import bundle
+from sftp_sync.stats import Stats
+
+from .conftest import MTIME, sync_module, tree, write
+
+__author__ = 'bluec0re'
+
+THRESHOLD = 1024
+
+
+def small_files(root, offset=0):
+    for i in range(20):
+        fname = write(root, 'd%d/f%d.txt' % (i % 3, i), b'%d' % i * (i + 1), MTIME + offset + i)
+        os.chmod(fname, 0o600 if i % 2 else 0o755)
+    write(root, 'big.bin', b'x' * 2 * THRESHOLD, MTIME + offset)
+
+
+def state(root):
+    """
+    Content, mtime and permissions of the files below root
+    """
+    result = {}
+    for path in tree(root):
+        fname = os.path.join(root, path)
+        s = os.lstat(fname)
+        with open(fname, 'rb') as fp:
+            result[path] = (fp.read(), int(s.st_mtime), s.st_mode)
+    return result
+
+
+def run(sftp, remote, local, direction, **kwargs):
+    sync = sync_module.Sync(sftp, remote, local, **kwargs)
+    sync.execute(sync.plan(direction))
+    return dict(sync_module.Sync(sftp, remote, local).revision_file)
+
+
+def test_bundled_downloads(sftp, remote, tmp_path):
+    small_files(remote)
+    stats = Stats()
+    bundled = run(sftp, remote, str(tmp_path / 'bundled'), 'down', bundle_threshold=THRESHOLD,
+                  stats=stats)
+    separate = run(sftp, remote, str(tmp_path / 'separate'), 'down')
+    assert stats.counters['bundled'] == 20
+    assert bundled == separate
+    assert state(str(tmp_path / 'bundled')) == state(str(tmp_path / 'separate'))
+
+
+def test_bundled_uploads(sftp, tmp_path):
+    roots = {}
+    for name in ('bundled', 'separate'):
+        roots[name] = str(tmp_path / name / 'local'), str(tmp_path / name / 'remote')
+        small_files(roots[name][0])
+        os.makedirs(roots[name][1])
+
+    stats = Stats()
+    local, remote = roots['bundled']
+    bundled = run(sftp, remote, local, 'up', bundle_threshold=THRESHOLD, stats=stats)
+    assert stats.counters['bundled'] == 20
+    local, remote = roots['separate']
+    separate = run(sftp, remote, local, 'up')
+    assert bundled == separate
+    assert state(roots['bundled'][1]) == state(roots['separate'][1]) == state(local)
+
+    # changed files are bundled again
+    for name in roots:
+        small_files(roots[name][0], 100)
+    local, remote = roots['bundled']
+    bundled = run(sftp, remote, local, 'up', bundle_threshold=THRESHOLD)
+    local, remote = roots['separate']
+    separate = run(sftp, remote, local, 'up')
+    assert bundled == separate
+    assert state(roots['bundled'][1]) == state(local)
+
+
+@pytest.mark.parametrize('command', [
+    # a tar without --null and -T
+    'echo "tar: unrecognized option \'--null\'" >&2; exit 64',
+    # a stream which breaks in the fifth member
+    '%s | head -c 5000',
+])
+def test_failed_bundled_downloads(sftp, remote, tmp_path, monkeypatch, command):
+    small_files(remote)
+    real = bundle.exec_remote
+    monkeypatch.setattr(bundle, 'exec_remote', lambda sftp, tar: real(sftp, command.replace('%s', tar)))
+    stats = Stats()
+    bundled = run(sftp, remote, str(tmp_path / 'bundled'), 'down', bundle_threshold=THRESHOLD,
+                  stats=stats)
+    separate = run(sftp, remote, str(tmp_path / 'separate'), 'down')
+    if 'exit' in command:
+        assert 'bundled' not in stats.counters
+    else:
+        assert 0 < stats.counters['bundled'] < 20
+    assert bundled == separate
+    assert state(str(tmp_path / 'bundled')) == state(str(tmp_path / 'separate'))
+
+
+def test_broken_stream_leaves_no_part_file(sftp, remote, local, monkeypatch):
+    small_files(remote)
+    real = bundle.exec_remote
+    monkeypatch.setattr(bundle, 'exec_remote', lambda sftp, tar: real(sftp, tar + ' | head -c 5000'))
+    files = {}
+    for path in tree(remote):
+        s = os.stat(os.path.join(remote, path))
+        files[path] = sync_module.File(int(s.st_mtime), s.st_size, s.st_mode)
+        if not os.path.isdir(os.path.join(local, os.path.dirname(path))):
+            os.makedirs(os.path.join(local, os.path.dirname(path)))
+    done = bundle.download(sftp, remote, local, files)
+    assert 0 < len(done) < len(files)
+    assert tree(local) == done
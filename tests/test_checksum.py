@@ -0,0 +1,115 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+from sftp_sync import checksum
+from sftp_sync.plan import UPLOAD
+
+from .conftest import MTIME, read, write
+
+__author__ = 'bluec0re'
+
+
+def failing_hash_file(broken):
+    real = checksum.hash_file
+
+    def hash_file(path):
+        if path.endswith(broken):
+            raise IOError("Permission denied")
+        return real(path)
+    return hash_file
+
+
+def test_revision_entries_without_hash(synced, remote, local):
+    # synced without checksums, the revision file has no hashes
+    write(remote, 'a/one.txt', b'new', MTIME + 10)
+    sync = synced(checksum=True)
+    sync.down()
+    assert read(local, 'a/one.txt') == b'new'
+    assert len(synced(checksum=True).plan('down')) == 0
+
+
+def test_unreadable_files(tmpdir, monkeypatch):
+    paths = [write(str(tmpdir), name, name.encode('ascii')) for name in ('a', 'b', 'c')]
+    monkeypatch.setattr(checksum, 'hash_file', failing_hash_file('b'))
+    cache = checksum.HashCache(os.path.join(str(tmpdir), '.hashes'))
+    hashes = cache.hash_files(paths)
+    assert sorted(hashes) == [paths[0], paths[2]]
+
+
+def test_unreadable_files_are_changed(synced, local, monkeypatch):
+    synced(checksum=True).up()
+    # touched, so it has to be hashed
+    write(local, 'c/three.txt', read(local, 'c/three.txt'), MTIME + 10)
+    monkeypatch.setattr(checksum, 'hash_file', failing_hash_file('three.txt'))
+    for direction in ('up', 'both'):
+        plan = synced(checksum=True).plan(direction)
+        assert [(action.kind, action.path) for action in plan] == [(UPLOAD, 'c/three.txt')]
+
+
+def test_only_changed_files_are_hashed(synced, remote, local, monkeypatch):
+    synced(checksum=True).down()
+    hashed = []
+    real = checksum.remote_hashes
+
+    def remote_hashes(sftp, root, filenames):
+        hashed.extend(filenames)
+        return real(sftp, root, filenames)
+
+    monkeypatch.setattr(checksum, 'remote_hashes', remote_hashes)
+    assert len(synced(checksum=True).plan('down')) == 0
+    assert hashed == []
+
+    write(remote, 'a/one.txt', b'new', MTIME + 10)
+    synced(checksum=True).down()
+    assert hashed == ['a/one.txt']
+    assert read(local, 'a/one.txt') == b'new'
+
+
+def cached_paths(fname):
+    cache = checksum.HashCache(fname)
+    cache.load()
+    return sorted(path for _, path in cache.hashes.values())
+
+
+def test_hash_cache_keeps_unused_entries(tmpdir):
+    root = str(tmpdir)
+    fname = os.path.join(root, '.files.hashes')
+    paths = dict((name, write(root, name, name.encode('ascii'))) for name in ('a/x', 'a/z', 'b/y'))
+    cache = checksum.HashCache(fname)
+    cache.hash_files(paths.values())
+    cache.save()
+
+    # a run in a: the changed a/z replaces its entry, b/y is out of scope
+    write(root, 'a/z', b'changed', MTIME + 10)
+    cache = checksum.HashCache(fname, 'a')
+    cache.load()
+    assert cache.hash_files([paths['a/z']]) == {paths['a/z']: checksum.hash_file(paths['a/z'])}
+    cache.save()
+    assert len(cache.hashes) == 3
+    assert cached_paths(fname) == ['a/x', 'a/z', 'b/y']
+
+    # files which are gone are dropped
+    os.unlink(paths['a/x'])
+    cache = checksum.HashCache(fname, 'a')
+    cache.load()
+    cache.hash_files([write(root, 'a/w', b'w')])
+    cache.save()
+    assert cached_paths(fname) == ['a/w', 'a/z', 'b/y']
+
+
+def test_hash_cache_without_paths(tmpdir, monkeypatch):
+    root = str(tmpdir)
+    fname = os.path.join(root, '.files.hashes')
+    path = write(root, 'x', b'x')
+    key = checksum._stat_key(os.stat(path))
+    with open(fname, 'wb') as fp:
+        fp.write(('%s\t%s\n' % (key, checksum.hash_file(path))).encode('ascii'))
+
+    monkeypatch.setattr(checksum, 'hash_file', failing_hash_file(''))
+    cache = checksum.HashCache(fname)
+    cache.load()
+    assert list(cache.hash_files([path])) == [path]
+    cache.save()
+    assert cached_paths(fname) == ['x']
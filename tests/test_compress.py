@@ -0,0 +1,76 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import errno
+import os
+
+import pytest
+
+from sftp_sync import compress
+
+from .conftest import MTIME, sync_module, read, write
+
+__author__ = 'bluec0re'
+
+TEXT = b''.join(b'line %d of a compressible file\n' % i for i in range(20000))
+
+
+def test_compressed_transfers(make_sync, remote, local):
+    write(remote, 'down.txt', TEXT)
+    sync = make_sync(compression=True)
+    sync.down()
+    assert read(local, 'down.txt') == TEXT
+
+    write(local, 'up.txt', TEXT[::-1], MTIME + 10)
+    sync = make_sync(compression=True)
+    sync.up()
+    assert read(remote, 'up.txt') == TEXT[::-1]
+    assert os.path.getmtime(os.path.join(remote, 'up.txt')) == MTIME + 10
+    assert sync.compression
+
+
+def test_file_errors_keep_compression(make_sync, sftp, remote, local):
+    os.makedirs(local)
+    sync = make_sync(compression=True)
+    f = sync_module.File(MTIME, len(TEXT), 0o100644)
+    missing = os.path.join(remote, 'missing.txt')
+    with pytest.raises(IOError) as e:
+        sync._compressed(lambda: compress.download(sftp, missing, os.path.join(local, 'x.txt'),
+                                                   MTIME, len(TEXT)), missing, f)
+    assert e.value.errno == errno.ENOENT
+
+    lpath = write(local, 'big.bin', os.urandom(8 * 1024 ** 2))
+    with pytest.raises(IOError) as e:
+        sync._compressed(lambda: compress.upload(sftp, lpath, os.path.join(remote, 'gone/big.bin'),
+                                                 MTIME, 8 * 1024 ** 2, 0o100644), lpath, f)
+    assert e.value.errno == errno.ENOENT
+    assert sync.compression
+
+
+def test_broken_helper_disables_compression(make_sync, remote, local, monkeypatch):
+    write(remote, 'a.txt', TEXT)
+    write(remote, 'b.txt', TEXT[::-1])
+    monkeypatch.setattr(compress, 'python_command', lambda script, *args: 'exit 127')
+    sync = make_sync(compression=True)
+    sync.down()
+    assert read(local, 'a.txt') == TEXT
+    assert read(local, 'b.txt') == TEXT[::-1]
+    assert not sync.compression
+
+
+def test_aborted_upload_leaves_no_part_file(sftp, remote, local):
+    lpath = write(local, 'big.txt', TEXT)
+    with pytest.raises(IOError):
+        compress.upload(sftp, lpath, os.path.join(remote, 'big.txt'), MTIME, len(TEXT) + 1, 0o100644)
+    assert os.listdir(remote) == []
+
+
+def test_broken_upload_leaves_no_part_file(sftp, remote):
+    rpath = os.path.join(remote, 'big.txt')
+    channel = compress._start(sftp, 'put', rpath, compress.part_name(rpath, MTIME, len(TEXT)),
+                              str(MTIME), '420')
+    channel.sendall(compress.FRAME.pack(b'r', len(TEXT)) + TEXT[:1000])
+    channel.shutdown_write()
+    assert channel.recv_exit_status() == compress.ABORTED
+    channel.close()
+    assert os.listdir(remote) == []
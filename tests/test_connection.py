@@ -0,0 +1,116 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import paramiko
+import pytest
+
+from sftp_sync import mux, sftp
+from sftp_sync.transfer import Streaming
+
+from .conftest import MTIME, sync_module, read, write
+
+__author__ = 'bluec0re'
+
+STREAMING = Streaming(4096, 4, 1024 ** 2)
+BIG = os.urandom(3 * 1024 ** 2 + 17)
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """
+    An empty home directory with the connection cache in it
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    cache_dir = str(tmp_path / '.cache' / 'sftpsync')
+    monkeypatch.setattr(sftp, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(sftp, 'CONNECTION_CACHE', os.path.join(cache_dir, 'connections.json'))
+    (tmp_path / '.ssh').mkdir()
+    return tmp_path
+
+
+def test_resolved_hosts_are_cached(home, monkeypatch):
+    key = str(home / '.ssh' / 'id_test')
+    config = home / '.ssh' / 'config'
+    config.write_text('Host alias\n  HostName real.example\n  Port 2222\n  User bob\n'
+                      '  IdentityFile %s\n' % key)
+    expected = ('real.example', 2222, 'bob', [key], None)
+    cache = sftp._load_cache()
+    assert sftp.resolve_host('alias', cache) == expected
+    assert sftp.resolve_host('joe@alias:23', cache) == ('real.example', 23, 'joe', [key], None)
+    sftp._save_cache(cache)
+
+    # the config isn't parsed again while it is unchanged
+    parser = paramiko.SSHConfig
+
+    class Unused(object):
+        def __init__(self):
+            pytest.fail("parsed the unchanged config")
+    monkeypatch.setattr(paramiko, 'SSHConfig', Unused)
+    assert sftp.resolve_host('alias', sftp._load_cache()) == expected
+
+    monkeypatch.setattr(paramiko, 'SSHConfig', parser)
+    config.write_text('Host alias\n  HostName other.example\n')
+    os.utime(str(config), (MTIME, MTIME))
+    assert sftp.resolve_host('alias', sftp._load_cache()) == ('other.example', 22, None, [], None)
+
+
+def test_key_types_are_cached(home, monkeypatch):
+    key = str(home / '.ssh' / 'id_ecdsa')
+    paramiko.ECDSAKey.generate().write_private_key_file(key)
+    cache = sftp._load_cache()
+    pkey = sftp.load_identity([str(home / 'missing'), key], cache)
+    assert isinstance(pkey, paramiko.ECDSAKey)
+    assert cache['keys'][key]['type'] == 'ECDSAKey'
+
+    # the cached type is tried first
+    for cls in sftp.KEY_CLASSES:
+        if cls is not paramiko.ECDSAKey:
+            monkeypatch.setattr(cls, 'from_private_key_file',
+                                classmethod(lambda *args: pytest.fail("tried another key type")))
+    assert isinstance(sftp.load_identity([key], cache), paramiko.ECDSAKey)
+
+
+def test_batch_mode_never_asks_for_the_username(monkeypatch):
+    monkeypatch.setattr(sftp, 'resolve_host', lambda host, cache: ('host', 22, None, [], None))
+    monkeypatch.setattr(sftp, 'input', lambda *args: pytest.fail("asked for the username"),
+                        raising=False)
+    assert sftp.setup_sftp(argparse.Namespace(HOST='host'), interactive=False) is False
+    assert mux.setup_mux(argparse.Namespace(HOST='host'), interactive=False) is False
+
+
+@pytest.fixture
+def mux_sftp(sftp):
+    """
+    A sftp client talking to an in-process master connection
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'mux.sock')
+    master = mux.Master(sftp.get_channel().get_transport(), path, 60)
+    thread = threading.Thread(target=master.serve)
+    thread.daemon = True
+    thread.start()
+    while not mux.ping(path):
+        time.sleep(0.01)
+    client = mux.MuxClient(path).open_sftp()
+    yield client
+    client.close()
+    shutil.rmtree(os.path.dirname(path))
+
+
+def test_through_master_connection(mux_sftp, remote, local):
+    write(local, 'big.bin', BIG)
+    write(local, 'small.txt', b'small')
+    sync = sync_module.Sync(mux_sftp, remote, local, streaming=STREAMING)
+    sync.up()
+    assert read(remote, 'big.bin') == BIG
+    assert read(remote, 'small.txt') == b'small'
+
+    write(remote, 'big.bin', BIG[::-1], MTIME + 10)
+    sync_module.Sync(mux_sftp, remote, local, streaming=STREAMING).down()
+    assert read(local, 'big.bin') == BIG[::-1]
@@ -0,0 +1,57 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+from sftp_sync.database import RevisionDatabase
+
+from .conftest import write
+from .test_revisions import PATHS, entry, fill
+
+__author__ = 'bluec0re'
+
+
+def test_sqlite_store(tmp_path):
+    fname = str(tmp_path / '.files.db')
+    db = RevisionDatabase(fname)
+    db.load()
+    assert not db
+    fill(db, PATHS)
+    db.save()
+
+    reader = RevisionDatabase(fname)
+    reader.load()
+    assert len(reader) == len(PATHS)
+    assert reader['a/y'] == entry(1)
+    assert sorted(reader.listdir('a')) == ['a/x', 'a/y']
+    assert set(reader.directories()) == set(['', 'a', 'b', 'b/c', 'ü'])
+
+    # batches of record() become visible to other connections
+    for i in range(RevisionDatabase.BATCH_SIZE):
+        db.record('many/%d' % i, entry(i))
+    reader.load()
+    assert len(reader) == len(PATHS) + RevisionDatabase.BATCH_SIZE
+    db.forget('a/x')
+    db.close()
+    reader.load()
+    assert 'a/x' not in reader
+
+
+def test_sqlite_migration(tmp_path, make_sync, remote, local):
+    write(remote, 'a/one.txt', b'one')
+    write(remote, 'two.txt', b'two')
+    make_sync().down()
+    assert os.path.exists(os.path.join(local, '.files'))
+
+    with open(os.path.join(local, '.sftpsync'), 'w') as fp:
+        fp.write('[general]\nrevision_store = sqlite\n')
+    sync = make_sync()
+    assert sorted(sync.revision_file) == ['a/one.txt', 'two.txt']
+    assert os.path.exists(os.path.join(local, '.files.db'))
+    assert os.path.exists(os.path.join(local, '.files.migrated'))
+    assert not os.path.exists(os.path.join(local, '.files'))
+    assert len(sync.plan('down')) == 0
+
+    write(remote, 'three.txt', b'three')
+    make_sync().down()
+    assert 'three.txt' in make_sync().revision_file
@@ -0,0 +1,122 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import shutil
+
+import pytest
+
+from sftp_sync.delete import DeletePolicy
+from sftp_sync.plan import DELETE_REMOTE
+
+from .conftest import MTIME, read, tree, write
+
+__author__ = 'bluec0re'
+
+
+def run(sync, direction):
+    sync.execute(sync.plan(direction))
+
+
+def delete_remote(remote):
+    os.unlink(os.path.join(remote, 'top.txt'))
+    shutil.rmtree(os.path.join(remote, 'a'))
+
+
+def test_never_is_the_batch_default(synced, remote, local):
+    delete_remote(remote)
+    run(synced(batch=True), 'down')
+    assert 'top.txt' in tree(local)
+    assert 'a/b/two.txt' in tree(local)
+    # still pending
+    assert len(synced().plan('down')) == 3
+
+
+def test_always(synced, remote, local):
+    delete_remote(remote)
+    run(synced(batch=True, delete_policy=DeletePolicy('always')), 'down')
+    assert tree(local) == set(['c/three.txt'])
+    # emptied directories go as well
+    assert not os.path.exists(os.path.join(local, 'a'))
+    assert len(synced().plan('down')) == 0
+
+    os.unlink(os.path.join(local, 'c/three.txt'))
+    run(synced(batch=True, delete_policy=DeletePolicy('always')), 'up')
+    assert os.listdir(remote) == []
+
+
+def test_trash(synced, remote, local):
+    os.unlink(os.path.join(local, 'a/one.txt'))
+    run(synced(batch=True, delete_policy=DeletePolicy('trash', 'old')), 'up')
+    assert 'a/one.txt' not in tree(remote)
+    trashed = [path for path in tree(remote) if path.startswith('old/')]
+    assert len(trashed) == 1 and trashed[0].endswith('/a/one.txt')
+    # the trash isn't synced
+    assert len(synced(delete_policy=DeletePolicy(trash_dir='old')).plan('down')) == 0
+
+    delete_remote(remote)
+    run(synced(batch=True, delete_policy=DeletePolicy('trash')), 'down')
+    assert set(path.split('/', 2)[2] for path in tree(local) if path.startswith('.sftpsync-trash/')) == \
+        set(['top.txt', 'a/b/two.txt'])
+
+
+def test_max_count(synced, remote, local):
+    delete_remote(remote)
+    with pytest.raises(ValueError):
+        run(synced(batch=True, delete_policy=DeletePolicy('always', max_count=2)), 'down')
+    assert 'top.txt' in tree(local)
+
+    run(synced(batch=True, delete_policy=DeletePolicy('always', max_count=3)), 'down')
+    assert tree(local) == set(['c/three.txt'])
+
+
+def test_ask(synced, remote, local, answers):
+    os.unlink(os.path.join(local, 'top.txt'))
+    os.unlink(os.path.join(local, 'c/three.txt'))
+    sync = synced()
+    plan = sync.plan('up')
+    first, second = [action.path for action in plan.by_kind(DELETE_REMOTE)]
+    answers.extend(['y', 'n'])
+    sync.execute(plan)
+    assert first not in tree(remote)
+    assert second in tree(remote)
+    assert not answers
+
+
+def test_settings(synced, local):
+    with open(os.path.join(local, '.sftpsync'), 'w') as fp:
+        fp.write('[general]\ndelete = trash\ntrash_dir = bin\nmax_delete = 5\n')
+    assert synced(batch=True).delete_policy == DeletePolicy('trash', 'bin', 5)
+    assert synced(batch=True, delete_policy=DeletePolicy('always')).delete_policy.mode == 'always'
+    with pytest.raises(ValueError):
+        synced(batch=True, delete_policy=DeletePolicy('ask'))
+    with pytest.raises(ValueError):
+        synced(delete_policy=DeletePolicy(trash_dir='../bin'))
+
+
+def test_locally_changed_files_are_kept(synced, remote, local):
+    os.unlink(os.path.join(remote, 'a/one.txt'))
+    write(local, 'a/one.txt', b'edited', MTIME + 10)
+    os.unlink(os.path.join(remote, 'top.txt'))
+    with pytest.raises(ValueError):
+        run(synced(batch=True, delete_policy=DeletePolicy('always')), 'down')
+    assert read(local, 'a/one.txt') == b'edited'
+    assert 'top.txt' not in tree(local)
+
+
+def test_remotely_changed_files_are_kept(synced, remote, local):
+    os.unlink(os.path.join(local, 'c/three.txt'))
+    write(remote, 'c/three.txt', b'edited', MTIME + 10)
+    os.unlink(os.path.join(local, 'top.txt'))
+    sync = synced(batch=True, delete_policy=DeletePolicy('trash'), skip_on_error=True)
+    run(sync, 'up')
+    assert read(remote, 'c/three.txt') == b'edited'
+    assert 'top.txt' not in tree(remote)
+    assert 'c/three.txt' in synced().revision_file
+
+
+def test_deleted_on_both_sides(synced, remote, local):
+    os.unlink(os.path.join(local, 'a/b/two.txt'))
+    os.unlink(os.path.join(remote, 'a/b/two.txt'))
+    run(synced(batch=True, delete_policy=DeletePolicy('always')), 'both')
+    assert 'a/b/two.txt' not in synced().revision_file
@@ -0,0 +1,54 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import re
+
+from sftp_sync.exclude import ExcludeMatcher
+
+from .conftest import write, tree
+
+__author__ = 'bluec0re'
+
+
+def test_default_rules():
+    matcher = ExcludeMatcher()
+    for path in ['a.swp', 'dir/file~', 'x/.~lock.doc#', 'x/~$doc.docx', 'm.pyc',
+                 'pkg/__pycache__/m.py', '.big.bin.1-2.sftpsync-part']:
+        assert matcher.match(path), path
+    for path in ['a.py', 'swp', 'dir~/file', 'notes.txt']:
+        assert not matcher.match(path), path
+
+
+def test_pattern_matches_at_start():
+    matcher = ExcludeMatcher(re.compile(r'build|.*\.log$'))
+    assert matcher.match('build/x')
+    assert matcher.match('a/b/debug.log')
+    assert not matcher.match('src/build/x')
+
+
+def test_directories():
+    matcher = ExcludeMatcher('node_modules/|cache$')
+    assert matcher.match_dir('node_modules')
+    assert matcher.match_dir('cache')
+    assert not matcher.match('node_modules')
+    assert matcher.excluded('node_modules/x/y.js')
+    assert not matcher.excluded('src/node_modules/y.js')
+    # cached results count once
+    hits = matcher.hits
+    assert matcher.match_dir('node_modules')
+    assert matcher.hits == hits
+
+
+def test_excluded_files_are_not_synced(make_sync, remote, local):
+    write(remote, 'keep/a.txt', b'a')
+    write(remote, 'node_modules/x/y.js', b'y')
+    write(remote, 'keep/b.pyc', b'b')
+    write(remote, 'logs/today.log', b'l')
+    sync = make_sync(exclude=re.compile(r'node_modules/|logs/'))
+    sync.down()
+    assert tree(local) == set(['keep/a.txt'])
+    assert sync.exclude.hits >= 3
+
+    write(local, 'logs/local.log', b'l')
+    write(local, 'keep/c.txt~', b'c')
+    assert len(make_sync(exclude=re.compile(r'node_modules/|logs/')).plan('up')) == 0
@@ -0,0 +1,71 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import pytest
+
+from sftp_sync.plan import SyncPlan, DOWNLOAD, MKDIR_LOCAL, DELETE_LOCAL
+
+from .conftest import MTIME, read, tree, write
+
+__author__ = 'bluec0re'
+
+
+def change_remote(remote):
+    write(remote, 'a/one.txt', b'changed', MTIME + 10)
+    write(remote, 'new/dir/file.txt', b'new')
+    os.unlink(os.path.join(remote, 'top.txt'))
+
+
+def test_plan(synced, remote, local):
+    change_remote(remote)
+    plan = synced().plan('down')
+    assert sorted((action.kind, action.path) for action in plan) == [
+        (DELETE_LOCAL, 'top.txt'),
+        (DOWNLOAD, 'a/one.txt'),
+        (DOWNLOAD, 'new/dir/file.txt'),
+        (MKDIR_LOCAL, 'new'),
+        (MKDIR_LOCAL, 'new/dir'),
+    ]
+    assert plan.download_bytes == len(b'changed') + len(b'new')
+    assert plan.upload_bytes == 0
+    # planning touches nothing
+    assert read(local, 'a/one.txt') == b'one'
+
+
+def test_saved_plan(synced, remote, local, tmp_path, answers):
+    change_remote(remote)
+    fname = str(tmp_path / 'plan.json')
+    synced().plan('down').save(fname)
+    loaded = SyncPlan.load(fname)
+    assert loaded.to_dict() == synced().plan('down').to_dict()
+
+    # the deletion of top.txt is confirmed
+    answers.append('y')
+    synced().execute(loaded)
+    assert not answers
+    assert tree(local) == tree(remote)
+    assert read(local, 'new/dir/file.txt') == b'new'
+    assert len(synced().plan('down')) == 0
+
+
+def test_plan_of_another_project(synced, remote, local, tmp_path):
+    change_remote(remote)
+    plan = synced().plan('down')
+    plan.local = str(tmp_path / 'other')
+    with pytest.raises(ValueError):
+        synced().execute(plan)
+    assert read(local, 'a/one.txt') == b'one'
+
+
+def test_dry_run(synced, remote, local, capsys):
+    change_remote(remote)
+    revisions = dict(synced().revision_file)
+    sync = synced(dry_run=True)
+    sync.execute(sync.plan('down'))
+    assert 'new/dir/file.txt' in capsys.readouterr().out
+    assert read(local, 'a/one.txt') == b'one'
+    assert 'top.txt' in tree(local)
+    assert 'new' not in os.listdir(local)
+    assert dict(synced().revision_file) == revisions
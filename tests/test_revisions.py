@@ -0,0 +1,162 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import pytest
+
+from .conftest import MTIME, sync_module
+
+__author__ = 'bluec0re'
+
+File = sync_module.File
+RevisionFile = sync_module.RevisionFile
+
+
+def entry(i, target=None):
+    return File(MTIME + i, i, 0o100644, None, target)
+
+
+def fill(store, paths):
+    for i, path in enumerate(paths):
+        store[path] = entry(i)
+
+
+PATHS = ['a/x', 'a/y', 'b/c/z', 'b/d', 'top', 'ü/ß']
+
+
+def test_file_round_trip(tmp_path):
+    fname = str(tmp_path / '.files')
+    files = RevisionFile(fname)
+    fill(files, PATHS)
+    files['link'] = entry(9, 'a/x')
+    files.save()
+
+    loaded = RevisionFile(fname)
+    loaded.load()
+    assert dict(loaded) == dict(files)
+    assert sorted(loaded.listdir('a')) == ['a/x', 'a/y']
+    assert sorted(loaded.directories()) == ['', 'a', 'b', 'b/c', 'ü']
+
+
+def test_compact_entries(tmp_path):
+    files = RevisionFile(str(tmp_path / '.files'))
+    fill(files, PATHS)
+    entries = {
+        'hashed': File(MTIME, 1, 0o100644, 'ab' * 32),
+        'upper': File(MTIME, 1, 0o100644, 'AB' * 32),
+        'short': File(MTIME, 1, 0o100644, 'abc'),
+        'link': File(MTIME, 1, 0o120777, None, 'a/x'),
+        'old': File(MTIME, 1, -1),
+    }
+    for path, data in entries.items():
+        files[path] = data
+    for path, data in entries.items():
+        assert files[path] == data
+
+    del files['b/c/z']
+    files.forget('a/x')
+    assert 'b/c/z' not in files
+    assert files.get('a/x') is None
+    assert sorted(files.directories()) == ['', 'a', 'b', 'ü']
+    assert files.listdir('a') == ['a/y']
+    # rows of removed entries are reused
+    files['new/one'] = entry(40)
+    files['hashed'] = entry(41)
+    assert files['new/one'] == entry(40)
+    assert files['hashed'] == entry(41)
+    assert len(files) == len(PATHS) - 2 + len(entries) + 1
+    assert len(list(files)) == len(files)
+
+
+def test_journal_survives_crash(tmp_path):
+    fname = str(tmp_path / '.files')
+    files = RevisionFile(fname)
+    fill(files, PATHS)
+    files.save()
+
+    files.record('new', entry(20))
+    files.forget('a/x')
+    # no commit, as after a crash
+    with open(files.journal, 'ab') as fp:
+        fp.write(b'+\ttorn\t1')
+
+    loaded = RevisionFile(fname)
+    loaded.load()
+    assert loaded['new'] == entry(20)
+    assert 'a/x' not in loaded
+    assert 'torn' not in loaded
+
+    loaded.save()
+    assert not os.path.exists(loaded.journal)
+    again = RevisionFile(fname)
+    again.load()
+    assert dict(again) == dict(loaded)
+
+
+def test_columns_snapshot(tmp_path):
+    fname = str(tmp_path / '.files')
+    files = RevisionFile(fname)
+    fill(files, PATHS)
+    files['hashed'] = File(MTIME, 1, 0o100644, 'ab' * 32)
+    files['other'] = File(MTIME, 1, 0o100644, 'AB' * 32)
+    files['old'] = File(MTIME, 1, -1)
+    del files['a/y']
+    files['reused'] = entry(7)
+    files.save()
+    assert os.path.exists(files.columns)
+
+    loaded = RevisionFile(fname)
+    loaded.load()
+    assert dict(loaded) == dict(files)
+
+    # a stale or broken snapshot is ignored
+    with open(files.columns, 'r+b') as fp:
+        fp.truncate(os.path.getsize(files.columns) - 8)
+    loaded.load()
+    assert dict(loaded) == dict(files)
+    scoped = RevisionFile(fname, 'b')
+    scoped.load()
+    scoped.record('b/new', entry(30))
+    scoped.save()
+    assert not os.path.exists(files.columns)
+    loaded.load()
+    assert loaded['b/new'] == entry(30)
+
+
+@pytest.mark.parametrize('store', ['file', 'sqlite'])
+def test_scope(tmp_path, store):
+    root = str(tmp_path)
+    full = sync_module.REVISION_STORES[store](root, '')
+    fill(full, PATHS)
+    full.save()
+
+    scoped = sync_module.REVISION_STORES[store](root, 'b')
+    scoped.load()
+    assert sorted(scoped) == ['b/c/z', 'b/d']
+    assert 'a/x' not in scoped
+    scoped.record('b/new', entry(30))
+    scoped.forget('b/d')
+    scoped.save()
+
+    full = sync_module.REVISION_STORES[store](root, '')
+    full.load()
+    assert set(full) == set(PATHS) - set(['b/d']) | set(['b/new'])
+    assert full['a/y'] == entry(1)
+    assert full['b/new'] == entry(30)
+
+
+@pytest.mark.parametrize('store', ['file', 'sqlite'])
+def test_subtree(tmp_path, store):
+    files = sync_module.REVISION_STORES[store](str(tmp_path), '')
+    files.load()
+    fill(files, PATHS + ['b-c/x', 'b0'])
+    assert sorted(files.subtree('b')) == ['b/c/z', 'b/d']
+    assert sorted(files.subtree('b/d')) == ['b/d']
+    assert sorted(files.subtree('')) == sorted(PATHS + ['b-c/x', 'b0'])
+    assert files.subtree('missing') == []
+
+    # directories added and removed later are found
+    files.record('b/e/f/g', entry(30))
+    del files['b/c/z']
+    assert sorted(files.subtree('b')) == ['b/d', 'b/e/f/g']
@@ -0,0 +1,120 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import pytest
+
+from sftp_sync.local import LocalScanner
+
+from .conftest import write
+
+__author__ = 'bluec0re'
+
+
+def make_tree(root):
+    for i in range(30):
+        write(root, 'd%d/e%d/f%d.txt' % (i % 3, i % 4, i), b'x' * i)
+    write(root, 'top.txt', b'top')
+    write(root, 'skip/hidden.txt', b'hidden')
+    write(root, 'd1/skip.txt', b'kept, only the top level is excluded')
+    write(root, 'd2/e2/editor.swp', b'excluded by default')
+    write(root, 'd2/__pycache__/x.pyc', b'excluded by default')
+    os.makedirs(os.path.join(root, 'empty/inner'))
+    os.symlink('../top.txt', os.path.join(root, 'd0/link'))
+
+
+def listings(walk):
+    roots = []
+    result = {}
+    for root, dirs, files in walk:
+        roots.append(root)
+        result[root] = (sorted(d.filename for d in dirs),
+                        sorted((f.filename, f.st_size, f.st_mtime, f.st_mode) for f in files))
+    # parents come before their children
+    for i, root in enumerate(roots[1:]):
+        assert os.path.dirname(root) in roots[:i + 1]
+    return result
+
+
+@pytest.mark.parametrize('subdir, exclude', [
+    (None, None),
+    (None, 'skip'),
+    ('d2', None),
+    ('d2/e2', 'd2/e2/f'),
+    ('skip', 'skip'),
+])
+def test_remote_scan_matches_sftp_walk(make_sync, remote, subdir, exclude):
+    make_tree(remote)
+    scanned = make_sync(subdir=subdir, exclude=exclude, remote_scan=True)
+    result = listings(scanned.walk())
+    # the helper did the listing
+    assert scanned.remote_scan
+    assert result == listings(make_sync(subdir=subdir, exclude=exclude).walk())
+
+
+def test_remote_scan_reads_link_targets(make_sync, remote):
+    make_tree(remote)
+    for root, dirs, files in make_sync(remote_scan=True).walk():
+        if root == 'd0':
+            links = [f for f in files if f.filename == 'link']
+    assert links[0].target == '../top.txt'
+
+
+def os_walk(root, skip_dir, skip_file):
+    """
+    The local listing with os.walk() and lstat()
+    """
+    result = {}
+    for directory, dirs, files in os.walk(root):
+        rel = os.path.relpath(directory, root)
+        rel = '' if rel == os.curdir else rel
+        dirs[:] = [name for name in dirs if not skip_dir(os.path.join(rel, name))
+                   and not os.path.islink(os.path.join(directory, name))]
+        names = files + [name for name in os.listdir(directory)
+                         if os.path.islink(os.path.join(directory, name)) and
+                         os.path.isdir(os.path.join(directory, name))]
+        result[rel] = (sorted(dirs), sorted((name, os.lstat(os.path.join(directory, name)).st_ino)
+                                            for name in names if not skip_file(os.path.join(rel, name))))
+    return result
+
+
+@pytest.mark.parametrize('workers', [1, 8])
+def test_local_scanner(tmp_path, workers):
+    root = str(tmp_path)
+    make_tree(root)
+    os.symlink('d1', os.path.join(root, 'dirlink'))
+
+    def skip_dir(path):
+        return path in ('skip', 'd2/e2')
+
+    def skip_file(path):
+        return path.endswith('.swp') or path == 'd1/skip.txt'
+
+    scanner = LocalScanner(root, skip_dir, skip_file, workers)
+    roots = []
+    result = {}
+    for directory, dirs, files in scanner.walk():
+        roots.append(directory)
+        result[directory] = (sorted(dirs), sorted((name, s.st_ino) for name, s in files.items()))
+    scanner.close()
+
+    assert result == os_walk(root, skip_dir, skip_file)
+    # sorted depth first, so parents come before their children
+    assert roots == sorted(roots, key=lambda path: path.split('/'))
+    assert 'dirlink' in dict(result[''][1])
+
+
+def test_local_scanner_pruning(tmp_path):
+    root = str(tmp_path)
+    make_tree(root)
+    scanner = LocalScanner(root, lambda path: False, lambda path: False, 4)
+    roots = []
+    for directory, dirs, files in scanner.walk():
+        roots.append(directory)
+        # like os.walk(), removed names aren't visited
+        dirs[:] = [name for name in dirs if name != 'd0']
+    scanner.close()
+    assert not [path for path in roots if path.startswith('d0')]
+    assert 'd1/e1' in roots
+    assert list(LocalScanner(root, None, None).walk('missing')) == []
@@ -0,0 +1,47 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import json
+
+from sftp_sync.stats import Stats
+
+from .conftest import MTIME, sync_module, write
+
+__author__ = 'bluec0re'
+
+
+def test_counters(synced, sftp, remote, local, tmp_path):
+    write(remote, 'a/one.txt', b'changed!', MTIME + 10)
+    write(remote, 'skipped.txt', b'excluded')
+    stats = Stats()
+    sync_module.sync(sftp, remote, local, 'down', exclude='skip', stats=stats, batch=True)
+
+    counters = stats.counters
+    assert counters['examined'] == 4
+    assert counters['unchanged'] == 3
+    assert counters['transferred'] == 1
+    assert counters['bytes down'] == len(b'changed!')
+    assert counters['excluded'] >= 1
+    assert 'conflicts' not in counters
+    # one listing per directory, one download
+    assert stats.requests['opendir'] == 4
+    assert stats.requests['open'] == 1
+    assert stats.bytes_received > len(b'changed!')
+    for phase in ('remote walk', 'transfers', 'revision save'):
+        assert phase in stats.phases
+
+    fname = str(tmp_path / 'stats.json')
+    stats.save(fname)
+    with open(fname) as fp:
+        data = json.load(fp)
+    assert data['counters'] == counters
+    assert data['total_requests'] == sum(stats.requests.values())
+
+
+def test_conflicts_are_counted(synced, remote, local):
+    write(remote, 'a/one.txt', b'remote', MTIME + 10)
+    write(local, 'a/one.txt', b'local', MTIME + 20)
+    stats = Stats()
+    synced(stats=stats, skip_on_error=True).down()
+    assert stats.counters['conflicts'] == 1
+    assert 'transferred' not in stats.counters
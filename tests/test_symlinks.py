@@ -0,0 +1,64 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+from sftp_sync.plan import SYMLINK_LOCAL, SYMLINK_REMOTE
+from sftp_sync.stats import Stats
+
+from .conftest import MTIME, write
+
+__author__ = 'bluec0re'
+
+
+def symlink(root, path, target, mtime=MTIME):
+    fname = os.path.join(root, path)
+    if os.path.lexists(fname):
+        os.unlink(fname)
+    os.symlink(target, fname)
+    os.utime(fname, (mtime, mtime), follow_symlinks=False)
+
+
+def kinds(plan):
+    return [(action.kind, action.path) for action in plan]
+
+
+def test_targets_are_stored(make_sync, remote, local):
+    write(remote, 'top.txt', b'top')
+    symlink(remote, 'link', 'top.txt')
+    make_sync().down()
+    assert os.readlink(os.path.join(local, 'link')) == 'top.txt'
+    assert make_sync().revision_file['link'].target == 'top.txt'
+
+    # unchanged links aren't read again
+    stats = Stats()
+    assert len(make_sync(stats=stats).plan('down')) == 0
+    assert 'readlink' not in stats.requests
+
+
+def test_targets_are_compared(make_sync, remote, local):
+    write(remote, 'a.txt', b'a')
+    write(remote, 'b.txt', b'b')
+    symlink(remote, 'link', 'a.txt')
+    make_sync().down()
+
+    symlink(remote, 'link', 'b.txt', MTIME + 10)
+    assert kinds(make_sync().plan('down')) == [(SYMLINK_LOCAL, 'link')]
+    make_sync().down()
+    assert os.readlink(os.path.join(local, 'link')) == 'b.txt'
+
+    # recreated with the same target, only the revision entry changes
+    symlink(remote, 'link', 'b.txt', MTIME + 20)
+    plan = make_sync().plan('down')
+    assert kinds(plan) == []
+    assert plan.updates['link'].target == 'b.txt'
+    make_sync().execute(plan)
+    assert make_sync().revision_file['link'].mtime == MTIME + 20
+
+    symlink(local, 'link', 'a.txt', MTIME + 30)
+    plan = make_sync().plan('up')
+    assert kinds(plan) == [(SYMLINK_REMOTE, 'link')]
+    assert plan.actions[0].file.target == 'a.txt'
+    make_sync().execute(plan)
+    assert os.readlink(os.path.join(remote, 'link')) == 'a.txt'
+    assert make_sync().revision_file['link'].target == 'a.txt'
@@ -0,0 +1,223 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import shutil
+import threading
+
+from paramiko.sftp import CMD_READ, CMD_WRITE
+import paramiko
+import pytest
+
+from sftp_sync import delta, sftp as sftp_module, transfer
+from sftp_sync.stats import Stats
+from sftp_sync.transfer import Streaming
+
+from .conftest import MTIME, write, read, tree
+
+__author__ = 'bluec0re'
+
+# small requests and a short pipeline, so a few MB take many round trips
+STREAMING = Streaming(4096, 4, 1024 ** 2)
+BIG = os.urandom(3 * 1024 ** 2 + 17)
+
+
+def test_down_and_up_pipelined(make_sync, remote, local):
+    write(remote, 'big.bin', BIG)
+    for i in range(30):
+        write(remote, 'd%d/e/f%d.txt' % (i % 4, i), b'x' * i)
+    make_sync(streaming=STREAMING, jobs=3).down()
+    assert tree(local) == tree(remote)
+    assert read(local, 'big.bin') == BIG
+    assert os.path.getmtime(os.path.join(local, 'big.bin')) == MTIME
+
+    write(local, 'new/big.bin', BIG[::-1], MTIME + 10)
+    write(local, 'd1/e/f1.txt', b'changed', MTIME + 10)
+    make_sync(streaming=STREAMING).up()
+    assert read(remote, 'new/big.bin') == BIG[::-1]
+    assert read(remote, 'd1/e/f1.txt') == b'changed'
+    assert os.path.getmtime(os.path.join(remote, 'new/big.bin')) == MTIME + 10
+    assert len(make_sync().plan('up')) == 0
+    assert len(make_sync().plan('down')) == 0
+
+
+def test_without_pipelining(make_sync, sftp, remote, local, monkeypatch):
+    # a paramiko version without the internals pipelining is built on
+    monkeypatch.setattr(sftp_module, 'PIPELINE_INTERNALS', ('_missing',))
+    monkeypatch.setattr(sftp_module, 'WINDOW_INTERNALS', ('_missing',))
+    assert not sftp_module.can_pipeline(sftp)
+    sftp_module.set_window(sftp, 8 * 1024 ** 2)
+
+    write(remote, 'big.bin', BIG)
+    write(remote, 'a/b/small.txt', b'small')
+    os.symlink('big.bin', os.path.join(remote, 'link'))
+    make_sync(streaming=STREAMING, jobs=2).down()
+    assert tree(local) == tree(remote)
+    assert read(local, 'big.bin') == BIG
+    assert os.readlink(os.path.join(local, 'link')) == 'big.bin'
+
+    write(local, 'new/big.bin', BIG[::-1], MTIME + 10)
+    make_sync(streaming=STREAMING).up()
+    assert read(remote, 'new/big.bin') == BIG[::-1]
+    assert len(make_sync().plan('up')) == 0
+    assert len(make_sync().plan('down')) == 0
+
+
+def _progress():
+    totals = []
+    return totals, lambda total, size: totals.append(total)
+
+
+def test_download_resumes_partial_file(sftp, remote, local):
+    rpath = write(remote, 'big.bin', BIG)
+    os.makedirs(local)
+    lpath = os.path.join(local, 'big.bin')
+    part = transfer.part_name(lpath, MTIME, len(BIG))
+    with open(part, 'wb') as fp:
+        fp.write(BIG[:len(BIG) // 2])
+    # partial files of other versions are removed
+    stale = transfer.part_name(lpath, MTIME - 1, len(BIG))
+    open(stale, 'wb').close()
+
+    totals, callback = _progress()
+    transfer.download(sftp, rpath, lpath, MTIME, len(BIG), callback, STREAMING)
+    assert read(local, 'big.bin') == BIG
+    assert totals[0] > len(BIG) // 2
+    assert not os.path.exists(part)
+    assert not os.path.exists(stale)
+
+
+def test_upload_resumes_partial_file(sftp, remote, local):
+    lpath = write(local, 'big.bin', BIG)
+    rpath = os.path.join(remote, 'big.bin')
+    with open(transfer.part_name(rpath, MTIME, len(BIG)), 'wb') as fp:
+        fp.write(BIG[:len(BIG) // 3])
+
+    totals, callback = _progress()
+    transfer.upload(sftp, lpath, rpath, MTIME, len(BIG), callback, 0o600, STREAMING)
+    assert read(remote, 'big.bin') == BIG
+    assert totals[0] > len(BIG) // 3
+    assert os.stat(rpath).st_mode & 0o777 == 0o600
+    assert os.listdir(remote) == ['big.bin']
+
+
+@pytest.mark.parametrize('size', [100000, 8 * 1024 ** 2])
+def test_download_reads(sftp, remote, local, monkeypatch, size):
+    data = os.urandom(size)
+    rpath = write(remote, 'big.bin', data)
+    os.makedirs(local)
+    lpath = os.path.join(local, 'big.bin')
+    stats = Stats()
+    stats.instrument(sftp)
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    threads = set(threading.enumerate())
+
+    transfer.download(sftp, rpath, lpath, MTIME, size, None, Streaming(32768, 16))
+    assert read(local, 'big.bin') == data
+    # one read per chunk and one finding the end of the file
+    assert stats.requests['read'] == -(-size // 32768) + 1
+    assert set(threading.enumerate()) <= threads
+    sftp.close()
+    assert not errors
+
+
+def test_short_reads(sftp, remote, local, monkeypatch):
+    rpath = write(remote, 'big.bin', BIG)
+    os.makedirs(local)
+    real = sftp._async_request
+
+    def short(fileobj, t, *args):
+        # the server returns less than asked for
+        if t == CMD_READ:
+            args = args[:2] + (min(args[2], 1000),)
+        return real(fileobj, t, *args)
+
+    monkeypatch.setattr(sftp, '_async_request', short)
+    transfer.download(sftp, rpath, os.path.join(local, 'big.bin'), MTIME, len(BIG), None, STREAMING)
+    assert read(local, 'big.bin') == BIG
+
+    # a file which grew since it was listed
+    with pytest.raises(IOError):
+        transfer.download(sftp, rpath, os.path.join(local, 'small.bin'), MTIME, 1000, None, STREAMING)
+    assert not os.path.exists(os.path.join(local, 'small.bin'))
+
+
+def test_delta_transfers(make_sync, remote, local):
+    write(remote, 'big.bin', BIG)
+    make_sync().down()
+
+    changed = bytearray(BIG)
+    changed[100000:100010] = b'0123456789'
+    write(remote, 'big.bin', bytes(changed), MTIME + 10)
+    sync = make_sync(delta_threshold=1024)
+    sync.down()
+    assert read(local, 'big.bin') == bytes(changed)
+    assert sync.bytes_saved > len(BIG) // 2
+
+    changed[2000000:2000003] = b'abc'
+    write(local, 'big.bin', bytes(changed), MTIME + 20)
+    sync = make_sync(delta_threshold=1024)
+    sync.up()
+    assert read(remote, 'big.bin') == bytes(changed)
+    assert sync.bytes_saved > len(BIG) // 2
+    assert os.path.getmtime(os.path.join(remote, 'big.bin')) == MTIME + 20
+
+
+def test_failed_delta_download(make_sync, sftp, remote, local, monkeypatch):
+    write(remote, 'big.bin', BIG)
+    make_sync().down()
+    changed = bytearray(BIG)
+    changed[100000:100010] = b'0123456789'
+    changed[2000000:2000003] = b'abc'
+    rpath = write(remote, 'big.bin', bytes(changed), MTIME + 10)
+    real = paramiko.SFTPFile.readv
+
+    def broken(self, chunks, *args, **kwargs):
+        blocks = real(self, chunks, *args, **kwargs)
+        yield next(blocks)
+        raise IOError("Connection lost")
+
+    monkeypatch.setattr(paramiko.SFTPFile, 'readv', broken)
+    names = sorted(os.listdir(local))
+    with pytest.raises(IOError):
+        delta.delta_download(sftp, rpath, os.path.join(local, 'big.bin'), MTIME + 10, len(BIG))
+    # nothing is left behind for a resumed download
+    assert sorted(os.listdir(local)) == names
+    assert read(local, 'big.bin') == BIG
+
+    sync = make_sync(delta_threshold=1024)
+    sync.down()
+    assert read(local, 'big.bin') == bytes(changed)
+    assert sync.bytes_saved == 0
+    assert not [name for name in os.listdir(local) if name.endswith(transfer.PART_SUFFIX)]
+
+
+def test_failed_write_is_reported(sftp, remote, local, monkeypatch):
+    lpath = write(local, 'small.txt', b'x' * 100000)
+    rpath = write(remote, 'small.txt', b'old')
+    real = sftp._async_request
+
+    def failing(fileobj, t, *args):
+        # a write to an invalid handle fails on the server
+        if t == CMD_WRITE and args[1] == 40960:
+            args = (b'invalid',) + args[1:]
+        return real(fileobj, t, *args)
+
+    monkeypatch.setattr(sftp, '_async_request', failing)
+    with pytest.raises(IOError):
+        transfer.upload(sftp, lpath, rpath, MTIME, 100000, None, None, STREAMING)
+    # the old version is kept
+    assert os.listdir(remote) == ['small.txt']
+    assert read(remote, 'small.txt') == b'old'
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_upload_into_removed_directories(synced, remote, local, jobs):
+    # removed on the remote side behind our back, the revision file still knows them
+    shutil.rmtree(os.path.join(remote, 'a'))
+    write(local, 'a/new.txt', b'new', MTIME + 10)
+    write(local, 'a/b/new/deep.txt', b'deep', MTIME + 10)
+    synced(jobs=jobs).up()
+    assert read(remote, 'a/new.txt') == b'new'
+    assert read(remote, 'a/b/new/deep.txt') == b'deep'
@@ -0,0 +1,81 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import stat
+
+import pytest
+
+from .conftest import write
+
+__author__ = 'bluec0re'
+
+
+def old_walk(sync):
+    """
+    The walk before the listings were pipelined, one listdir_attr() at
+    a time
+    """
+    directory_stack = [sync.remote]
+    while directory_stack:
+        directory = directory_stack.pop()
+        entries = sync.sftp.listdir_attr(directory)
+        files = []
+        directories = []
+        for entry in entries:
+            if sync._exclude(os.path.relpath(os.path.join(directory, entry.filename), sync.remote)):
+                continue
+            if stat.S_ISDIR(entry.st_mode):
+                directories.append(entry)
+            else:
+                files.append(entry)
+
+        relative_dir = os.path.relpath(directory, sync.remote)
+        yield '' if relative_dir == os.path.curdir else relative_dir, directories, files
+
+        for current_dir in directories:
+            directory_stack.append(os.path.join(directory, current_dir.filename))
+
+
+def listings(walk):
+    roots = []
+    result = {}
+    for root, dirs, files in walk:
+        roots.append(root)
+        result[root] = (sorted(d.filename for d in dirs),
+                        sorted((f.filename, f.st_size, f.st_mtime) for f in files))
+    return roots, result
+
+
+@pytest.fixture
+def deep_tree(remote):
+    for i in range(40):
+        write(remote, 'd%d/e%d/f%d/file%d.txt' % (i % 3, i % 5, i, i), b'x' * i)
+    write(remote, 'top.txt', b'top')
+    write(remote, 'skip/hidden.txt', b'hidden')
+    write(remote, 'd1/skip.txt', b'kept, only the top level is excluded')
+    write(remote, 'd2/editor.swp', b'excluded by default')
+    os.makedirs(os.path.join(remote, 'empty/inner'))
+    os.symlink('top.txt', os.path.join(remote, 'link'))
+
+
+@pytest.mark.parametrize('window', [1, 3, 64])
+def test_walk_matches_old_walk(make_sync, deep_tree, window):
+    sync = make_sync(exclude='skip')
+    sync.walk_window = window
+    roots, result = listings(sync.walk())
+    old_roots, old_result = listings(old_walk(make_sync(exclude='skip')))
+    assert result == old_result
+    assert sorted(roots) == sorted(old_roots)
+    assert 'skip' not in result
+    # parents come before their children
+    for i, root in enumerate(roots[1:]):
+        assert os.path.dirname(root) in roots[:i + 1]
+
+
+def test_stopped_walk_leaves_the_channel_usable(make_sync, deep_tree, sftp):
+    sync = make_sync()
+    sync.walk_window = 4
+    for root, dirs, files in sync.walk():
+        break
+    assert 'top.txt' in sftp.listdir(sync.remote)
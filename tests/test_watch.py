@@ -0,0 +1,102 @@
+# vim: set ts=8 sw=4 tw=0 fileencoding=utf-8 filetype=python expandtab:
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import sys
+
+import paramiko
+import pytest
+
+from sftp_sync import watch
+from sftp_sync.delete import DeletePolicy
+from sftp_sync.plan import UPLOAD, MKDIR_REMOTE, DELETE_REMOTE
+from sftp_sync.stats import Stats
+
+from .conftest import MTIME, read, tree, write
+
+__author__ = 'bluec0re'
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux only")
+
+
+def test_moved_directories_are_watched_again(tmpdir):
+    root = str(tmpdir)
+    write(root, 'old/sub/a.txt', b'a')
+    inotify = watch.Inotify(root)
+    try:
+        inotify.add_tree()
+        os.rename(os.path.join(root, 'old'), os.path.join(root, 'new'))
+        assert inotify.read() == set(['old', 'new'])
+        assert sorted(inotify.paths.values()) == ['', 'new', 'new/sub']
+
+        write(root, 'new/sub/b.txt', b'b')
+        assert inotify.read() == set(['new/sub/b.txt'])
+    finally:
+        inotify.close()
+
+
+def kinds(plan):
+    return sorted((action.kind, action.path) for action in plan)
+
+
+def test_batches_of_paths(synced, remote, local):
+    stats = Stats()
+    sync = synced(stats=stats, batch=True, delete_policy=DeletePolicy('always'))
+    watch._sync(sync)
+
+    os.unlink(os.path.join(local, 'a/b/two.txt'))
+    os.unlink(os.path.join(local, 'c/three.txt'))
+    os.makedirs(os.path.join(local, 'a/new'))
+    plan = sync.plan_up(['a/b/two.txt', 'a/new'])
+    # c/three.txt wasn't reported
+    assert kinds(plan) == [(DELETE_REMOTE, 'a/b/two.txt'), (MKDIR_REMOTE, 'a/new')]
+    sync.execute(plan)
+
+    # the directory created by the last batch is known to exist, only the
+    # root and the new file are checked
+    write(local, 'a/new/x.txt', b'x')
+    before = stats.requests.get('lstat', 0)
+    assert kinds(sync.plan_up(['a/new/x.txt'])) == [(UPLOAD, 'a/new/x.txt')]
+    assert stats.requests['lstat'] - before == 2
+    watch._sync(sync, ['a/new/x.txt'])
+    assert tree(remote) == set(['top.txt', 'a/one.txt', 'a/new/x.txt', 'c/three.txt'])
+
+
+class FakeInotify(object):
+    """
+    Reports the given batches of changed paths
+    """
+    batches = []
+
+    def __init__(self, root, skip_dir=None):
+        pass
+
+    def add_tree(self, path=''):
+        pass
+
+    def changes(self, debounce):
+        return iter(self.batches)
+
+    def close(self):
+        pass
+
+
+def test_connection_errors_keep_watching(synced, remote, local, monkeypatch):
+    sync = synced()
+    calls = []
+    real = sync.plan_up
+
+    def plan_up(paths=None):
+        calls.append(paths and sorted(paths))
+        if len(calls) == 2:
+            write(local, 'top.txt', b'new top', MTIME + 10)
+            raise paramiko.SSHException("Server connection dropped")
+        return real(paths)
+
+    monkeypatch.setattr(sync, 'plan_up', plan_up)
+    monkeypatch.setattr(watch, 'Inotify', FakeInotify)
+    monkeypatch.setattr(FakeInotify, 'batches', [set(['top.txt']), set(['a/one.txt']), set(['c/three.txt'])])
+    watch.watch(sync)
+    # the batch after the failed one compares everything and catches up
+    assert calls == [None, ['top.txt'], None, ['c/three.txt']]
+    assert read(remote, 'top.txt') == b'new top'